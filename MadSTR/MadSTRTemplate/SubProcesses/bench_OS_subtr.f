@@ -0,0 +1,151 @@
+      program bench_OS_subtr
+c*****************************************************************************
+c     Measures the time per phase-space point of smatrix_real (the real
+c     emission with the OS subtraction terms) for each FKS configuration
+c     and each value of istr. istr=0 (no OS subtraction) is the reference
+c     for the overhead of the other strategies.
+c     Usage: ./bench_OS_subtr [npoints [energy]]
+c     (default 1000 points, energy: twice the sum of the final-state
+c     masses, at least 1 TeV and at most the collider energy).
+c     The time of smatrix_real_multi, which evaluates all the strategies
+c     at once, is compared with the sum of the ones of the strategies.
+c     The fraction of failed reshufflings of each strategy is printed
+c     at the end. The results are written to bench_OS_subtr.json
+c*****************************************************************************
+      implicit none
+      include 'nexternal.inc'
+      include 'fks_info.inc'
+      include 'coupl.inc'
+      include 'run.inc'
+      integer junit
+      parameter (junit=12)
+      integer nistr
+      parameter (nistr=8)
+      INTEGER NFKSPROCESS
+      COMMON/C_NFKSPROCESS/NFKSPROCESS
+      integer os_countall, os_countbad
+      common /to_os_count/ os_countall, os_countbad
+      integer os_countall_str(0:nistr), os_countbad_str(0:nistr)
+      common /to_os_count_str/ os_countall_str, os_countbad_str
+      double precision pmass(nexternal)
+      double precision, allocatable :: p(:,:,:)
+      double precision energy, wgt, time(0:nistr), ratio(0:nistr)
+      double precision wgt_str(0:nistr)
+      double precision, allocatable :: tmulti(:), tsum(:)
+      integer npoints, nconf, is, ipt, i, istr_save
+      integer nall, nbad
+      real t0, t1
+      character*40 buffer
+      logical first
+c-----
+c  Begin Code
+c-----
+      npoints = 1000
+      energy = -1d0
+      if (command_argument_count().ge.1) then
+        call get_command_argument(1, buffer)
+        read(buffer,*) npoints
+      endif
+      if (command_argument_count().ge.2) then
+        call get_command_argument(2, buffer)
+        read(buffer,*) energy
+      endif
+
+      call setrun               !Sets up run parameters
+      call setpara('param_card.dat') !Sets up couplings and masses
+      call setcuts              !Sets up cuts
+
+      include 'pmass.inc'
+
+      if (energy.lt.0d0) then
+        energy = 0d0
+        do i = nincoming+1, nexternal
+          energy = energy + pmass(i)
+        enddo
+        energy = min(max(2d0 * energy, 1000d0), ebeam(1)+ebeam(2))
+      endif
+      write(*,*) 'Timing', npoints, 'points at c.o.m. energy', energy
+
+C the same points are used for all configurations and strategies
+      allocate(p(0:3,nexternal,npoints))
+      allocate(tmulti(fks_configs), tsum(fks_configs))
+      do ipt = 1, npoints
+        call generate_momenta_rambo(energy, pmass, p(0,1,ipt))
+      enddo
+
+      open(unit=junit, file='bench_OS_subtr.json', status='unknown')
+      write(junit,'(a,i0,a,i0,a,i0,a,es23.15e3,a)') '{"nexternal": ',
+     $ nexternal, ', "fks_configs": ', fks_configs, ', "npoints": ',
+     $ npoints, ', "energy": ', energy, ', "results": ['
+
+      istr_save = istr
+      first = .true.
+      do nconf = 1, fks_configs
+        nfksprocess = nconf
+        do is = 0, nistr
+          istr = is
+          ! the first call does the helicity filtering and the checks
+          call smatrix_real(p(0,1,1), wgt)
+          nall = os_countall
+          nbad = os_countbad
+          call cpu_time(t0)
+          do ipt = 1, npoints
+            call smatrix_real(p(0,1,ipt), wgt)
+          enddo
+          call cpu_time(t1)
+          time(is) = dble(t1 - t0) / dble(npoints)
+          nall = os_countall - nall
+          nbad = os_countbad - nbad
+          ratio(is) = 0d0
+          if (time(0).gt.0d0) ratio(is) = time(is) / time(0)
+
+          if (.not.first) write(junit,'(a)') ','
+          first = .false.
+          write(junit,100) nconf, is, time(is), ratio(is),
+     $     nall, nbad
+        enddo
+        write(*,'(a,i4,a,9(f8.3))') ' FKS configuration', nconf,
+     $   ' time(istr)/time(0), istr=0...8:',
+     $   (ratio(is), is = 0, nistr)
+
+        ! all the strategies at once
+        istr = istr_save
+        call smatrix_real_multi(p(0,1,1), wgt, wgt_str)
+        call cpu_time(t0)
+        do ipt = 1, npoints
+          call smatrix_real_multi(p(0,1,ipt), wgt, wgt_str)
+        enddo
+        call cpu_time(t1)
+        tmulti(nconf) = dble(t1 - t0) / dble(npoints)
+        tsum(nconf) = 0d0
+        do is = 0, nistr
+          tsum(nconf) = tsum(nconf) + time(is)
+        enddo
+        write(*,'(a,i4,a,f8.3)') ' FKS configuration', nconf,
+     $   ' time(all istr at once)/sum(time(istr)):',
+     $   tmulti(nconf) / max(tsum(nconf), 1d-30)
+      enddo
+      istr = istr_save
+
+      write(junit,'(a)') '], "multi": ['
+      do nconf = 1, fks_configs
+        if (nconf.gt.1) write(junit,'(a)') ','
+        write(junit,200) nconf, tmulti(nconf), tsum(nconf)
+      enddo
+      write(junit,'(a)') '], "os_counts": ['
+      do is = 2, nistr
+        if (is.gt.2) write(junit,'(a)') ','
+        write(junit,300) is, os_countall_str(is), os_countbad_str(is)
+      enddo
+      write(junit,'(a)') ']}'
+      close(junit)
+      call madstr_write_os_counts(6)
+
+ 100  format('{"fks_conf": ',i0,', "istr": ',i0,
+     $ ', "time_per_point": ',es23.15e3,', "ratio_to_istr0": ',
+     $ es23.15e3,', "os_calls": ',i0,', "os_failed": ',i0,'}')
+ 200  format('{"fks_conf": ',i0,', "time_per_point": ',es23.15e3,
+     $ ', "sum_time_per_point_istr": ',es23.15e3,'}')
+ 300  format('{"istr": ',i0,', "os_calls": ',i0,', "os_failed": ',
+     $ i0,'}')
+      end
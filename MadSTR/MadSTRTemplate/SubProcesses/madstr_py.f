@@ -0,0 +1,72 @@
+C Interface of the OS-subtracted real-emission matrix elements to
+C Python. It is compiled into the madstr_py extension module with
+C 'make madstr_py' (standalone output only), and it is meant to be used
+C through bin/internal/madstr_standalone.py.
+C Momenta are passed as p(0:3,nexternal,npts), i.e. a C-ordered NumPy
+C array of shape (npts,nexternal,4) transposed, so that no copy is made.
+C NOTE: f2py wraps all the common blocks it finds, so the routines here
+C must not use any: the actual work is done in transform_os.f
+
+
+      subroutine madstr_py_init()
+C reads the cards and sets up parameters, couplings, cuts and PDFs.
+C It must be called from inside the P* directory
+      implicit none
+      call madstr_standalone_init()
+      return
+      end
+
+
+      subroutine madstr_py_info(nexp, nconf, maxthreads, incpdf,
+     $ incflux)
+C returns the number of external particles, of FKS configurations,
+C of the threads the matrix elements can be called from, and whether
+C the PDF and flux ratios are included (from the run_card)
+      implicit none
+      integer nexp, nconf, maxthreads
+      logical incpdf, incflux
+Cf2py intent(out) nexp, nconf, maxthreads, incpdf, incflux
+      call madstr_standalone_info(nexp, nconf, maxthreads, incpdf,
+     $ incflux)
+      return
+      end
+
+
+      subroutine madstr_py_eval(npts, nexp, nconf, istr_in, p, x1, x2,
+     $ wgt, wgt_re, wgt_os)
+C evaluates, for the FKS configuration nconf and the OS-subtraction
+C strategy istr_in, the real matrix element (wgt_re), the OS counterterm
+C (wgt_os) and their difference (wgt) on npts phase-space points.
+C x1, x2 are the Bjorken x's of each point, used by the PDF and flux
+C ratios of the strategies with initial-state reshuffling
+      implicit none
+      integer npts, nexp, nconf, istr_in
+      double precision p(0:3, nexp, npts), x1(npts), x2(npts)
+      double precision wgt(npts), wgt_re(npts), wgt_os(npts)
+Cf2py intent(in) istr_in, nconf, p, x1, x2
+Cf2py integer intent(hide), depend(p) :: nexp = shape(p, 1)
+Cf2py integer intent(hide), depend(p) :: npts = shape(p, 2)
+Cf2py intent(out) wgt, wgt_re, wgt_os
+      call madstr_standalone_eval(npts, nexp, nconf, istr_in, p,
+     $ x1, x2, wgt, wgt_re, wgt_os)
+      return
+      end
+
+
+      subroutine madstr_py_eval_multi(npts, nexp, nconf, p, x1, x2,
+     $ wgt_str)
+C as madstr_py_eval, for all the strategies at once: wgt_str(istr,ipt)
+C is the subtracted weight of the point ipt with istr=0...8. The
+C real and OS matrix elements are shared among the strategies
+      implicit none
+      integer npts, nexp, nconf
+      double precision p(0:3, nexp, npts), x1(npts), x2(npts)
+      double precision wgt_str(0:8, npts)
+Cf2py intent(in) nconf, p, x1, x2
+Cf2py integer intent(hide), depend(p) :: nexp = shape(p, 1)
+Cf2py integer intent(hide), depend(p) :: npts = shape(p, 2)
+Cf2py intent(out) wgt_str
+      call madstr_standalone_eval_multi(npts, nexp, nconf, p,
+     $ x1, x2, wgt_str)
+      return
+      end
@@ -0,0 +1,74 @@
+      program madstr_reweight
+c*****************************************************************************
+c     Evaluates smatrix_real_multi (the real emission with the OS
+c     subtraction for all the strategies, istr=0...8) on the phase-space
+c     points of the real-emission contributions of the events, so that
+c     the event weights for the other strategies can be computed
+c     (see add_strategy_weights in bin/internal/common_run_interface.py).
+c     Usage: ./madstr_reweight input output
+c     For each point, the input has a line with
+c       nFKSprocess x1 x2 muF1^2 muF2^2 g_strong
+c     followed by nexternal lines with E px py pz. For each point, a line
+c     with the 9 weights wgt_str(0...8) is written to output
+c*****************************************************************************
+      implicit none
+      include 'nexternal.inc'
+      include 'fks_info.inc'
+      include 'coupl.inc'
+      include 'run.inc'
+      integer iunit, junit
+      parameter (iunit=11, junit=12)
+      INTEGER NFKSPROCESS
+      COMMON/C_NFKSPROCESS/NFKSPROCESS
+      logical softtest,colltest
+      common/sctests/softtest,colltest
+      double precision p(0:3, nexternal)
+      double precision wgt, wgt_str(0:8)
+      double precision gs
+      integer nconf, i, j, npoints, iostatus
+      character*512 infile, outfile
+c-----
+c  Begin Code
+c-----
+      if (command_argument_count().lt.2) then
+        write(*,*) 'Usage: ./madstr_reweight input output'
+        stop 1
+      endif
+      call get_command_argument(1, infile)
+      call get_command_argument(2, outfile)
+
+      softtest = .false.
+      colltest = .false.
+      call setrun               !Sets up run parameters
+      call setpara('param_card.dat') !Sets up couplings and masses
+      call setcuts              !Sets up cuts
+
+      open(unit=iunit, file=infile, status='old')
+      open(unit=junit, file=outfile, status='unknown')
+      npoints = 0
+      do
+        read(iunit,*,iostat=iostatus) nconf, xbk(1), xbk(2),
+     $   q2fact(1), q2fact(2), gs
+        if (iostatus.ne.0) exit
+        do i = 1, nexternal
+          read(iunit,*) (p(j,i), j = 0, 3)
+        enddo
+        if (nconf.lt.1.or.nconf.gt.fks_configs) then
+          write(*,*) 'ERROR in madstr_reweight: invalid FKS '//
+     $     'configuration', nconf
+          stop 1
+        endif
+        nfksprocess = nconf
+        if (gs.ne.g) then
+          g = gs
+          call update_as_param()
+        endif
+        call smatrix_real_multi(p, wgt, wgt_str)
+        write(junit,'(9(1x,es23.15e3))') (wgt_str(i), i = 0, 8)
+        npoints = npoints + 1
+      enddo
+      close(iunit)
+      close(junit)
+      write(*,*) 'madstr_reweight:', npoints, 'points evaluated'
+      call madstr_write_os_counts(6)
+      end
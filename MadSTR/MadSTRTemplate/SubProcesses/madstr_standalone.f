@@ -0,0 +1,127 @@
+C Routines behind the Python interface of the OS-subtracted real-emission
+C matrix elements (madstr_py.f), for the standalone output
+
+
+      subroutine madstr_standalone_init()
+C reads the cards and sets up parameters, couplings, cuts and PDFs,
+C as done by test_OS_subtr. It must be called from inside the P* dir
+      implicit none
+      logical softtest,colltest
+      common/sctests/softtest,colltest
+
+      softtest = .false.
+      colltest = .false.
+      call setrun               !Sets up run parameters
+      call setpara('param_card.dat') !Sets up couplings and masses
+      call setcuts              !Sets up cuts
+      return
+      end
+
+
+      subroutine madstr_standalone_info(nexp, nconf, maxthreads,
+     $ incpdf, incflux)
+C returns the number of external particles, of FKS configurations,
+C of the threads the matrix elements can be called from, and whether
+C the PDF and flux ratios are included (from the run_card)
+      implicit none
+      include 'nexternal.inc'
+      include 'fks_info.inc'
+      include 'madstr_threads.inc'
+      integer nexp, nconf, maxthreads
+      logical incpdf, incflux
+      logical str_include_pdf, str_include_flux
+      integer istr
+      common /to_os_reshuf/ str_include_pdf, str_include_flux, istr
+      nexp = nexternal
+      nconf = fks_configs
+      maxthreads = madstr_maxthreads
+      incpdf = str_include_pdf
+      incflux = str_include_flux
+      return
+      end
+
+
+      subroutine madstr_standalone_eval(npts, nexp, nconf, istr_in, p,
+     $ x1, x2, wgt, wgt_re, wgt_os)
+C evaluates smatrix_real for the FKS configuration nconf and the
+C OS-subtraction strategy istr_in on npts phase-space points, with
+C Bjorken x's x1, x2. The value of istr from the run_card is restored
+C on exit
+      implicit none
+      include 'nexternal.inc'
+      include 'fks_info.inc'
+      include 'madstr_threads.inc'
+      include 'run.inc'
+      integer npts, nexp, nconf, istr_in
+      double precision p(0:3, nexp, npts), x1(npts), x2(npts)
+      double precision wgt(npts), wgt_re(npts), wgt_os(npts)
+      double precision wgt_re_th(madstr_maxthreads)
+      double precision wgt_os_th(madstr_maxthreads)
+      common /to_real_wgts/wgt_re_th, wgt_os_th
+      integer nfksprocess
+      common/c_nfksprocess/nfksprocess
+      integer ipt, ith, istr_save
+      integer madstr_thread_id
+
+      if (nexp.ne.nexternal) then
+        write(*,*) 'ERROR in madstr_standalone_eval: wrong number '//
+     $   'of particles', nexp, nexternal
+        stop 1
+      endif
+      if (nconf.lt.1.or.nconf.gt.fks_configs) then
+        write(*,*) 'ERROR in madstr_standalone_eval: invalid FKS '//
+     $   'configuration', nconf
+        stop 1
+      endif
+
+      istr_save = istr
+      istr = istr_in
+      nfksprocess = nconf
+      ith = madstr_thread_id()
+      do ipt = 1, npts
+        xbk(1) = x1(ipt)
+        xbk(2) = x2(ipt)
+        call smatrix_real(p(0,1,ipt), wgt(ipt))
+        wgt_re(ipt) = wgt_re_th(ith)
+        wgt_os(ipt) = wgt_os_th(ith)
+      enddo
+      istr = istr_save
+      return
+      end
+
+
+      subroutine madstr_standalone_eval_multi(npts, nexp, nconf, p,
+     $ x1, x2, wgt_str)
+C evaluates smatrix_real_multi for the FKS configuration nconf on npts
+C phase-space points, with Bjorken x's x1, x2
+      implicit none
+      include 'nexternal.inc'
+      include 'fks_info.inc'
+      include 'run.inc'
+      integer npts, nexp, nconf
+      double precision p(0:3, nexp, npts), x1(npts), x2(npts)
+      double precision wgt_str(0:8, npts)
+      double precision wgt
+      integer nfksprocess
+      common/c_nfksprocess/nfksprocess
+      integer ipt
+
+      if (nexp.ne.nexternal) then
+        write(*,*) 'ERROR in madstr_standalone_eval_multi: wrong '//
+     $   'number of particles', nexp, nexternal
+        stop 1
+      endif
+      if (nconf.lt.1.or.nconf.gt.fks_configs) then
+        write(*,*) 'ERROR in madstr_standalone_eval_multi: invalid '//
+     $   'FKS configuration', nconf
+        stop 1
+      endif
+
+      nfksprocess = nconf
+      do ipt = 1, npts
+        xbk(1) = x1(ipt)
+        xbk(2) = x2(ipt)
+        call smatrix_real_multi(p(0,1,ipt), wgt, wgt_str(0,ipt))
+      enddo
+      return
+      end
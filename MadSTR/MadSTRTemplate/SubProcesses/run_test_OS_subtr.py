@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+#####################################################
+#                                                   #
+#  Runs test_OS_subtr for all the on-shell          #
+#  configurations of the P* directories in          #
+#  parallel (MadSTR plugin of MG5aMC)               #
+#                                                   #
+#####################################################
+
+""" Usage (from the SubProcesses directory):
+      ./run_test_OS_subtr.py [-j NJOBS] [P0_xxx P0_yyy ...]
+Each on-shell configuration listed in the osinfo.dat of the P* directories
+(all of them if none is given) is tested by a separate test_OS_subtr job.
+The results are merged into P*/test_OS_subtr.json, and a summary with the
+largest deviation between the real matrix element and the OS subtraction
+term in the window closest to the pole is printed.
+"""
+
+from __future__ import print_function
+
+import os
+import glob
+import json
+import argparse
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+pjoin = os.path.join
+
+
+def count_os_confs(pdir):
+    """ the number of on-shell configurations in pdir/osinfo.dat """
+    return len([l for l in open(pjoin(pdir, 'osinfo.dat')) \
+                if l.startswith('O')])
+
+
+def run_one(job):
+    """ run test_OS_subtr for the ios-th on-shell configuration of pdir """
+    pdir, ios = job
+    log = open(pjoin(pdir, 'test_OS_subtr_%d.log' % ios), 'w')
+    status = subprocess.call(['./test_OS_subtr', str(ios)], cwd=pdir,
+                             stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    return pdir, ios, status
+
+
+def merge(pdir, nos, failed):
+    """ merge the output of the jobs of pdir into test_OS_subtr.json.
+    The logs are kept only for the failed jobs """
+    records = []
+    for ios in range(1, nos + 1):
+        jsonl = pjoin(pdir, 'test_OS_subtr_%d.jsonl' % ios)
+        if not os.path.exists(jsonl):
+            continue
+        records += [json.loads(l) for l in open(jsonl) if l.strip()]
+        os.remove(jsonl)
+        if (pdir, ios) not in failed:
+            os.remove(pjoin(pdir, 'test_OS_subtr_%d.log' % ios))
+    with open(pjoin(pdir, 'test_OS_subtr.json'), 'w') as out:
+        json.dump(records, out, indent=1)
+    return records
+
+
+def summary(pdir, records):
+    """ print, for each configuration, the largest |1 - real/OS| among the
+    points of the window closest to the pole """
+    print(pdir)
+    for ios in sorted(set(r['os_conf'] for r in records)):
+        recs = [r for r in records if r['os_conf'] == ios]
+        last = max(r['step'] for r in recs)
+        devs = [abs(1. - r['wgt_re'] / r['wgt_os']) for r in recs \
+                if r['step'] == last and r['wgt_os'] != 0.]
+        print('  OS conf %3d (FKS conf %3d, %d -> %d %d): max |1-real/OS| = %s '
+              '(|m-M|/W in [%g, %g])' % (ios, recs[0]['fks_conf'],
+              recs[0]['mother'], recs[0]['daughters'][0], recs[0]['daughters'][1],
+              '%.3e' % max(devs) if devs else '-',
+              recs[-1]['bw_min'], recs[-1]['bw_max']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('pdirs', nargs='*')
+    args = parser.parse_args(argv)
+
+    pdirs = args.pdirs or sorted(os.path.dirname(f) \
+                                 for f in glob.glob(pjoin('P*', 'osinfo.dat')))
+
+    jobs = []
+    nos = {}
+    for pdir in pdirs:
+        if subprocess.call(['make', 'test_OS_subtr'], cwd=pdir):
+            print('Compilation of test_OS_subtr failed in %s' % pdir)
+            continue
+        nos[pdir] = count_os_confs(pdir)
+        jobs += [(pdir, ios) for ios in range(1, nos[pdir] + 1)]
+
+    # the jobs are separate processes, threads are enough to drive them
+    pool = ThreadPool(max(args.jobs, 1))
+    failed = set()
+    for pdir, ios, status in pool.imap_unordered(run_one, jobs):
+        if status:
+            failed.add((pdir, ios))
+            print('WARNING: test_OS_subtr %d failed in %s, see %s' % \
+                  (ios, pdir, pjoin(pdir, 'test_OS_subtr_%d.log' % ios)))
+    pool.close()
+    pool.join()
+
+    for pdir in sorted(nos):
+        summary(pdir, merge(pdir, nos[pdir], failed))
+
+
+if __name__ == '__main__':
+    main()
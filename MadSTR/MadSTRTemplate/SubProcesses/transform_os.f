@@ -647,7 +647,9 @@ C This is also the case when one does soft/collinear tests
       endif
 
 c the xbk corresponding to the os kinematics are choosen in order
-c to have the same ratio as the original ones
+c to have the same ratio as the original ones.
+c xbk is shared (run.inc), so only one thread at a time can change it
+!$OMP CRITICAL (MADSTR_XBK)
       xbk_save(1) = xbk(1)
       xbk_save(2) = xbk(2)
 
@@ -671,6 +673,7 @@ C the whole on-shell subtraction term will be set to zero as well
 C finally, restore the bjorken X's to the original values
       xbk(1) = xbk_save(1)
       xbk(2) = xbk_save(2)
+!$OMP END CRITICAL (MADSTR_XBK)
       return
       end
 
@@ -1025,3 +1028,204 @@ c back-to-back, i.e., we are in the restframe of their mother.
       enddo
       return
       end
+
+
+      integer function madstr_thread_id()
+C returns the index (starting from 1) of the calling thread, which 
+C labels the per-thread copies of the MadSTR saved variables.
+C Without OpenMP it is always 1
+      implicit none
+      include 'madstr_threads.inc'
+!$    integer omp_get_thread_num
+      madstr_thread_id = 1
+!$    madstr_thread_id = omp_get_thread_num() + 1
+      if (madstr_thread_id.gt.madstr_maxthreads) then
+        write(*,*) 'ERROR in madstr_thread_id: too many threads',
+     $   madstr_thread_id, madstr_maxthreads
+        write(*,*) 'Regenerate the output with --reentrant=N'
+        stop 1
+      endif
+      return
+      end
+
+
+      logical function madstr_in_parallel()
+C true inside an OpenMP parallel region. The commons of MG5_aMC which
+C are shared among threads (amp_split, c_wgt_ME_tree) are only filled
+C outside of them
+      implicit none
+!$    logical omp_in_parallel
+      madstr_in_parallel = .false.
+!$    madstr_in_parallel = omp_in_parallel()
+      return
+      end
+
+
+      subroutine madstr_count_os(is, ibad)
+C increments the counters of the OS subtractions: the total one
+C if ibad=0, the one of the failed reshufflings otherwise.
+C The same counters for the strategy is (the value of istr) are
+C incremented as well, see madstr_write_os_counts
+      implicit none
+      integer is, ibad
+      integer os_countall, os_countbad
+      common /to_os_count/ os_countall, os_countbad
+      integer os_countall_str(0:8), os_countbad_str(0:8)
+      common /to_os_count_str/ os_countall_str, os_countbad_str
+      if (ibad.eq.0) then
+!$OMP ATOMIC
+        os_countall = os_countall + 1
+!$OMP ATOMIC
+        os_countall_str(is) = os_countall_str(is) + 1
+      else
+!$OMP ATOMIC
+        os_countbad = os_countbad + 1
+!$OMP ATOMIC
+        os_countbad_str(is) = os_countbad_str(is) + 1
+      endif
+      return
+      end
+
+
+      logical function madstr_same_point(p, p_last, xbk_last,
+     $ scales_last, istr_last)
+C true if the momenta, the Bjorken x's, the scales and istr are the
+C ones of the last point (p_last, xbk_last, scales_last, istr_last) for
+C which the OS counterterms of a real matrix element have been computed,
+C so that they can be reused. The scales are G, mu_R and the two
+C factorization scales (q2fact), which enter the matrix elements and
+C the PDF ratio. Otherwise the last point is set to the current one.
+C The number of calls and of reused points is counted
+      implicit none
+      include 'nexternal.inc'
+      include 'run.inc'
+      include 'coupl.inc'
+      double precision p(0:3, nexternal), p_last(0:3, nexternal)
+      double precision xbk_last(2), scales_last(4)
+      integer istr_last
+      integer os_cache_calls, os_cache_hits
+      common /to_os_count_cache/ os_cache_calls, os_cache_hits
+      integer i, j
+      integer madstr_istr
+      double precision x1, x2
+
+C xbk may be changed by other threads in get_pdf_flux_ratio
+!$OMP CRITICAL (MADSTR_XBK)
+      x1 = xbk(1)
+      x2 = xbk(2)
+!$OMP END CRITICAL (MADSTR_XBK)
+!$OMP ATOMIC
+      os_cache_calls = os_cache_calls + 1
+      madstr_same_point = istr_last.eq.madstr_istr().and.
+     $ xbk_last(1).eq.x1.and.xbk_last(2).eq.x2.and.
+     $ scales_last(1).eq.G.and.scales_last(2).eq.MU_R.and.
+     $ scales_last(3).eq.q2fact(1).and.scales_last(4).eq.q2fact(2)
+      do j = 1, nexternal
+        if (.not.madstr_same_point) exit
+        do i = 0, 3
+          if (p_last(i,j).ne.p(i,j)) then
+            madstr_same_point = .false.
+            exit
+          endif
+        enddo
+      enddo
+
+      if (madstr_same_point) then
+!$OMP ATOMIC
+        os_cache_hits = os_cache_hits + 1
+      else
+        istr_last = madstr_istr()
+        xbk_last(1) = x1
+        xbk_last(2) = x2
+        scales_last(1) = G
+        scales_last(2) = MU_R
+        scales_last(3) = q2fact(1)
+        scales_last(4) = q2fact(2)
+        p_last(0:3,1:nexternal) = p(0:3,1:nexternal)
+      endif
+      return
+      end
+
+
+      subroutine madstr_write_os_counts(iunit)
+C writes on iunit the number of OS subtractions and the fraction of
+C failed reshufflings for each strategy which has been used, and the
+C fraction of the points whose OS counterterms have been reused
+      implicit none
+      integer iunit, is
+      integer os_countall_str(0:8), os_countbad_str(0:8)
+      common /to_os_count_str/ os_countall_str, os_countbad_str
+      integer os_cache_calls, os_cache_hits
+      common /to_os_count_cache/ os_cache_calls, os_cache_hits
+      do is = 2, 8
+        if (os_countall_str(is).eq.0) cycle
+        write(iunit,'(a,i2,a,i12,a,f8.5)') ' MadSTR istr=', is,
+     $   ' OS subtractions:', os_countall_str(is),
+     $   ' failed fraction:', dble(os_countbad_str(is)) /
+     $   dble(os_countall_str(is))
+      enddo
+      if (os_cache_calls.gt.0) then
+        write(iunit,'(a,i12,a,f8.5)') ' MadSTR OS counterterm sums:',
+     $   os_cache_calls, ' reused fraction:', dble(os_cache_hits) /
+     $   dble(os_cache_calls)
+      endif
+      return
+      end
+
+
+      block data madstr_count_data
+C the counters of the OS subtractions start from zero
+      implicit none
+      integer os_countall, os_countbad
+      common /to_os_count/ os_countall, os_countbad
+      integer os_countall_str(0:8), os_countbad_str(0:8)
+      common /to_os_count_str/ os_countall_str, os_countbad_str
+      integer os_cache_calls, os_cache_hits
+      common /to_os_count_cache/ os_cache_calls, os_cache_hits
+      data os_countall, os_countbad /0, 0/
+      data os_countall_str, os_countbad_str /9*0, 9*0/
+      data os_cache_calls, os_cache_hits /0, 0/
+      end
+
+
+      block data madstr_istr_data
+C no override of istr at the beginning
+      implicit none
+      include 'madstr_threads.inc'
+      integer istr_override(madstr_maxthreads)
+      common /to_istr_override/ istr_override
+      data istr_override /madstr_maxthreads*-1/
+      end
+
+
+      integer function madstr_istr()
+C returns the value of istr seen by the real matrix elements: the one
+C of the run_card, unless it has been overridden for the calling
+C thread by madstr_set_istr
+      implicit none
+      include 'madstr_threads.inc'
+      logical str_include_pdf, str_include_flux
+      integer istr
+      common /to_os_reshuf/ str_include_pdf, str_include_flux, istr
+      integer istr_override(madstr_maxthreads)
+      common /to_istr_override/ istr_override
+      integer madstr_thread_id
+      madstr_istr = istr_override(madstr_thread_id())
+      if (madstr_istr.lt.0) madstr_istr = istr
+      return
+      end
+
+
+      subroutine madstr_set_istr(iover)
+C overrides istr for the calling thread (iover<0 removes the override).
+C The common block to_os_reshuf is shared among threads, hence it must
+C not be modified during the run
+      implicit none
+      include 'madstr_threads.inc'
+      integer iover
+      integer istr_override(madstr_maxthreads)
+      common /to_istr_override/ istr_override
+      integer madstr_thread_id
+      istr_override(madstr_thread_id()) = iover
+      return
+      end
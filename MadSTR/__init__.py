@@ -26,6 +26,7 @@ import MadSTR.madstr_exporter as madstr_exporter
 #    example: new_output = {'myformat': MYCLASS}
 #    madgraph will then allow the command "output myformat PATH"
 #    MYCLASS should inherated of the class madgraph.iolibs.export_v4.VirtualExporter 
+#    The standalone output is 'output madstr --standalone'
 new_output = {'madstr': madstr_exporter.MadSTRExporter}
 
 # 2. Define new way to handle the cluster.
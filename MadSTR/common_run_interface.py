@@ -5,13 +5,12 @@
 #                                                   #
 #####################################################
 
-import copy
 import os 
 import logging
+import shutil
+import subprocess
 pjoin = os.path.join
 
-import internal.check_param_card as param_card_mod
-
 from internal.common_run_interface_MG import *
 
 #===============================================================================
@@ -20,9 +19,18 @@ from internal.common_run_interface_MG import *
 # overwrite the class from the common_run_interface_MG with some extra functions
 class CommonRunCmd(CommonRunCmd):
 
+    # the types of the contributions to the events (store_rwgt_info) which
+    # are real emissions, whose weight depends on istr
+    real_types = [1, 11]
+
     def do_treatcards(self, line, amcatnlo=False):
-        """ call the mother, then, if the param_card has to be updated, write it again
+        """ call the mother, then, if the param_card has to be updated, write it again.
+        The include files of Source which end up identical to the ones before
+        the call get back their modification time, so that repeated launches
+        (e.g. in a scan) do not trigger any recompilation
         """
+        old_incs = self.get_include_snapshot()
+
         super(CommonRunCmd, self).do_treatcards(line, amcatnlo)
 
         keepwidth = False
@@ -32,69 +40,293 @@ class CommonRunCmd(CommonRunCmd):
         args = self.split_arg(line)
         mode,  opt  = self.check_treatcards(args)
 
+        os_pids = set()
         if amcatnlo and mode in ['all', 'param'] and not keepwidth:
-
-            if os.path.exists(pjoin(self.me_dir, 'Source', 'MODEL', 'mp_coupl.inc')):
-                param_card = param_card_mod.ParamCardMP(opt['param_card'])
-            else:
-                param_card = param_card_mod.ParamCard(opt['param_card'])
-
             os_pids = self.get_os_pids()
-            if not os_pids: return # nothing else to do here
-
-            # append to the param_card.inc  lines with 
-            #'MDL_WX_KEEP = VALUE' for each particle that can go onshell
-            import ufomodel as ufomodel
-            zero = ufomodel.parameters.ZERO
 
-            parts_keep = [p for p in ufomodel.all_particles if p.pdg_code in os_pids or -p.pdg_code in os_pids]
-            decay_to_keep = [(part.get('width'), copy.copy(param_card['decay'].get((abs(part.pdg_code),)))) for part in parts_keep]
+        if os_pids:
+            widths_to_zero = self.get_os_widths(os_pids)
             # Force these widths to be set to zero in param_card.inc
             # to ensure gauge / pole cancelation
             param_inc = pjoin(self.me_dir, 'Source', 'param_card.inc')
 
-            self.replace_widths_in_paramcard_inc(decay_to_keep, param_inc)
+            forced = self.replace_widths_in_paramcard_inc(widths_to_zero, param_inc)
+
+            # the widths with _keep, which enter only the resonant diagrams
+            # and the OS counterterms, are read from the param_card at run time
+            # (MADSTR_READ_KEEP_WIDTHS in MODEL), so that they can be changed
+            # without recompiling
+            if forced and old_incs.get(param_inc, (None,))[0] != open(param_inc).read():
+                logger.info('MadSTR: Forcing widths %s to zero inside param_card.inc' % \
+                        ', '.join(forced))
+                logger.warning('The replacements above ensure poles cancelation, and affect all widths\n' + 
+                        '   EXCEPT those which enter the resonance-treatment counterterms, which\n' +
+                        '   are taken from the param_card.\n' +
+                        '   Do NOT set these widths to zero in the param_card.')
+
+        self.restore_unchanged_includes(old_incs)
+
+
+    ############################################################################
+    def do_reweight(self, line):
+        """ if str_multi_weights is set in the run_card, add to the events the
+        weights of all the OS-subtraction strategies before calling the mother
+        (reweight -from_cards is called after each run which writes events)
+        """
+        if '-from_cards' in line and self.run_card.get('str_multi_weights', False):
+            self.add_strategy_weights()
+        return super(CommonRunCmd, self).do_reweight(line)
+
+
+    ############################################################################
+    def add_strategy_weights(self):
+        """add to the events of the current run the weights madstr_istr_N,
+        N=0...8, obtained with istr=N. The real-emission contributions of each
+        event (stored with store_rwgt_info) are evaluated again with
+        smatrix_real_multi by madstr_reweight in their P* dir, and the event
+        weight is rescaled by the change of the sum of the contributions"""
+        import internal.lhe_parser as lhe_parser
+
+        if not self.run_card['store_rwgt_info']:
+            logger.warning('MadSTR: str_multi_weights needs store_rwgt_info = True.\n' +
+                    '   The weights of the OS-subtraction strategies are not added to the events')
+            return
+        evt_path = pjoin(self.me_dir, 'Events', self.run_name, 'events.lhe.gz')
+        if not os.path.exists(evt_path):
+            evt_path = evt_path[:-3]
+        if not os.path.exists(evt_path):
+            return
+
+        reals = self.get_reals_table()
+        subproc = pjoin(self.me_dir, 'SubProcesses')
+        # the points of the real emissions, written to the input of
+        # madstr_reweight of each P* dir
+        inputs = {}
+        nmissing = 0
+        for event in lhe_parser.EventFile(evt_path):
+            for wgt, cevent, pdir, nfks in self.get_nlo_contributions(event, reals):
+                if pdir is None:
+                    nmissing += wgt.type in self.real_types
+                    continue
+                if pdir not in inputs:
+                    inputs[pdir] = open(pjoin(subproc, pdir, 'madstr_reweight_in.dat'), 'w')
+                inputs[pdir].write('%d %.16e %.16e %.16e %.16e %.16e\n' % \
+                        tuple([nfks] + wgt.bjks + wgt.scales2[1:] + [wgt.gs]))
+                inputs[pdir].write(''.join(['%.16e %.16e %.16e %.16e\n' % \
+                        (p.E, p.px, p.py, p.pz) for p in cevent]))
+        for pdir in inputs:
+            inputs[pdir].close()
+        if nmissing:
+            logger.warning('MadSTR: %d real-emission contributions do not match any process, ' % nmissing +
+                    'their weight is the same for all the strategies')
+
+        results = self.run_madstr_reweight(list(inputs.keys()))
+        if results is None:
+            return
+
+        # write the events with the new weights
+        istr = self.run_card['istr']
+        ids = ['madstr_istr_%d' % i for i in range(9)]
+        used = dict((pdir, 0) for pdir in results)
+        evt_in = lhe_parser.EventFile(evt_path)
+        banner = evt_in.get_banner()
+        if 'madstr_istr_0' not in banner.get('initrwgt', ''):
+            text = "<weightgroup name='MadSTR_strategies' combine='none'>\n" + \
+                   ''.join(["<weight id='%s'> istr=%d </weight>\n" % (id, i) for i, id in enumerate(ids)]) + \
+                   "</weightgroup>\n"
+            banner['initrwgt'] = banner.get('initrwgt', '') + text
+        out_path = pjoin(os.path.dirname(evt_path), 'madstr_' + os.path.basename(evt_path))
+        evt_out = lhe_parser.EventFile(out_path, 'w')
+        banner.write(evt_out, close_tag=False)
+        for event in evt_in:
+            event.parse_reweight()
+            tot = 0.
+            tot_str = [0.] * 9
+            for wgt, cevent, pdir, nfks in self.get_nlo_contributions(event, reals):
+                tot += wgt.ref_wgt
+                ratios = [1.] * 9
+                if pdir is not None:
+                    wgt_str = results[pdir][used[pdir]]
+                    used[pdir] += 1
+                    if wgt_str[istr]:
+                        ratios = [w / wgt_str[istr] for w in wgt_str]
+                for i in range(9):
+                    tot_str[i] += wgt.ref_wgt * ratios[i]
+            for i, id in enumerate(ids):
+                event.reweight_data[id] = event.wgt * tot_str[i] / tot if tot else event.wgt
+                if id not in event.reweight_order:
+                    event.reweight_order.append(id)
+            evt_out.write(str(event))
+        evt_out.write('</LesHouchesEvents>\n')
+        evt_out.close()
+        evt_in.close()
+        shutil.move(out_path, evt_path)
+        logger.info('MadSTR: weights for istr=0...8 added to %s' % evt_path)
 
-            # finally append the width with _keep, which will enter only
-            # the resonant diagrams and the OS counterterms
-            incfile = open(param_inc, 'a')
-            for width, param in decay_to_keep:
-                incfile.write('      mdl_%s_keep = %s\n' % (width, ('%e'%float(param.value)).replace('e','d')))
-            incfile.close()
 
+    ############################################################################
+    def get_nlo_contributions(self, event, reals):
+        """yields the contributions to event stored with store_rwgt_info, with
+        their momenta, and the P* dir and FKS configuration where the real
+        emissions are evaluated (None if they are not real emissions, or
+        if their process is not found in reals)"""
+        if '<mgrwgt>' not in event.tag:
+            return
+        for cevent in event.parse_nlo_weight(real_type=self.real_types).cevents:
+            for wgt in cevent.wgts:
+                pdir, nfks = None, None
+                if wgt.type in self.real_types and tuple(wgt.pdgs) in reals:
+                    confs = reals[tuple(wgt.pdgs)]
+                    # the FKS configuration of the event if it has the process
+                    pdir, nfks = ([c for c in confs if c[1] == wgt.nfks] + confs)[0]
+                yield wgt, cevent, pdir, nfks
+
+
+    ############################################################################
+    def get_reals_table(self):
+        """returns a dictionary with the PDG codes of the real-emission
+        processes as keys and the list of the (P* dir, FKS configuration)
+        where they are as values, read from the madstr_reals.dat files
+        written at output time"""
+        reals = {}
+        subproc = pjoin(self.me_dir, 'SubProcesses')
+        for pdir in sorted(os.listdir(subproc)):
+            filename = pjoin(subproc, pdir, 'madstr_reals.dat')
+            if not pdir.startswith('P') or not os.path.exists(filename):
+                continue
+            for l in open(filename):
+                if not l.strip():
+                    continue
+                data = [int(v) for v in l.split()]
+                reals.setdefault(tuple(data[1:]), []).append((pdir, data[0]))
+        return reals
 
 
     ############################################################################
-    def replace_widths_in_paramcard_inc(self, decay_to_keep, param_inc):
-        """replace the widths passed in decay_to_keep inside param_inc and
-        force them to be zero"""
-        widths = [('MDL_%s' % d[0]).upper() for d in decay_to_keep]
-        lines = open(param_inc).read().split('\n')
+    def run_madstr_reweight(self, pdirs):
+        """compiles and runs madstr_reweight in the P* dirs, nb_core at a time.
+        Returns a dictionary with the list of the weights wgt_str(0...8)
+        of each point for each P* dir, or None if one of them fails"""
+        import internal.misc as misc
+
+        subproc = pjoin(self.me_dir, 'SubProcesses')
+        nb_core = max(int(self.options.get('nb_core') or 1), 1)
+        results = {}
+        for istart in range(0, len(pdirs), nb_core):
+            running = []
+            for pdir in pdirs[istart:istart + nb_core]:
+                cwd = pjoin(subproc, pdir)
+                try:
+                    misc.compile(['madstr_reweight'], cwd=cwd)
+                except Exception as error:
+                    logger.warning('MadSTR: madstr_reweight cannot be compiled in %s (%s).\n' % (pdir, error) +
+                            '   The weights of the OS-subtraction strategies are not added to the events')
+                    return None
+                log = open(pjoin(cwd, 'madstr_reweight.log'), 'w')
+                running.append((pdir, log, subprocess.Popen(
+                    ['./madstr_reweight', 'madstr_reweight_in.dat', 'madstr_reweight_out.dat'],
+                    cwd=cwd, stdout=log, stderr=subprocess.STDOUT)))
+            for pdir, log, proc in running:
+                status = proc.wait()
+                log.close()
+                if status:
+                    logger.warning('MadSTR: madstr_reweight failed in %s, see %s.\n' % \
+                            (pdir, pjoin(subproc, pdir, 'madstr_reweight.log')) +
+                            '   The weights of the OS-subtraction strategies are not added to the events')
+                    return None
+                results[pdir] = [[float(v) for v in l.split()] for l in \
+                        open(pjoin(subproc, pdir, 'madstr_reweight_out.dat')) if l.strip()]
+                for name in ['madstr_reweight_in.dat', 'madstr_reweight_out.dat']:
+                    os.remove(pjoin(subproc, pdir, name))
+        return results
+
 
-        replaced = False
+    ############################################################################
+    def replace_widths_in_paramcard_inc(self, widths_to_zero, param_inc):
+        """replace the widths passed in widths_to_zero (e.g. MDL_WT) inside 
+        param_inc and force them to be zero, in a single pass over the file. 
+        The original value is not kept, so that param_card.inc does not 
+        change with these widths. Returns the list of the forced parameters"""
+        widths = set([w.upper() for w in widths_to_zero])
 
-        for l in lines:
-            if not l: continue
+        lines = []
+        forced = []
+        for l in open(param_inc):
             param = l.split('=')[0].strip()
             if param in widths: # widths with standard precision
-                replaced = True
-                lines[lines.index(l)]=l.replace('=', '= 0D0 !! MadSTR Forced !! ')
-                logger.info('MadSTR: Forcing width %s to zero inside param_card.inc' % param) 
-            if param.startswith('MP__') and param[4:] in widths: # widths in quadruple precision 
-                lines[lines.index(l)]=l.replace('=', '= 0E+00_16 !! MadSTR Forced !! ')
-                logger.info('MadSTR: Forcing width %s to zero inside param_card.inc' % param) 
-
-        if replaced:
+                l = '%s= 0D0 !! MadSTR Forced%s' % (l.split('=')[0], l[len(l.rstrip('\n')):])
+                forced.append(param)
+            elif param.startswith('MP__') and param[4:] in widths: # widths in quadruple precision 
+                l = '%s= 0E+00_16 !! MadSTR Forced%s' % (l.split('=')[0], l[len(l.rstrip('\n')):])
+                forced.append(param)
+            lines.append(l)
+
+        if forced:
             outfile = open(param_inc, 'w')
-            outfile.write('\n'.join(lines))
+            outfile.write(''.join(lines))
             outfile.close()
-            logger.warning('The replacements above ensure poles cancelation, and affect all widths\n' + 
-                        '   EXCEPT those which enter the resonance-treatment counterterms, which\n' +
-                        '   are taken from the param_card.\n' +
-                        '   Do NOT set these widths to zero in the param_card.')
+
+        return forced
 
 
+    ############################################################################
+    def get_include_snapshot(self):
+        """returns a dictionary with the content and the stat of the include
+        files in Source and Source/MODEL, which are (re)written by treatcards"""
+        snapshot = {}
+        for dirname in [pjoin(self.me_dir, 'Source'), pjoin(self.me_dir, 'Source', 'MODEL')]:
+            if not os.path.isdir(dirname):
+                continue
+            for name in os.listdir(dirname):
+                if not name.endswith('.inc'):
+                    continue
+                path = pjoin(dirname, name)
+                try:
+                    snapshot[path] = (open(path).read(), os.stat(path))
+                except (IOError, OSError):
+                    continue
+        return snapshot
+
+
+    ############################################################################
+    def restore_unchanged_includes(self, snapshot):
+        """set back the modification time of the files in snapshot whose
+        content has not changed, so that make does not consider them as new"""
+        nrestored = 0
+        for path, (content, stat) in snapshot.items():
+            try:
+                if os.stat(path).st_mtime == stat.st_mtime or open(path).read() != content:
+                    continue
+                os.utime(path, (stat.st_atime, stat.st_mtime))
+                nrestored += 1
+            except (IOError, OSError):
+                continue
+        if nrestored:
+            logger.debug('MadSTR: %d include files unchanged by treatcards' % nrestored)
+
+
+
+
+
+    ############################################################################
+    def get_os_widths(self, os_pids):
+        """returns the names of the width parameters, as in param_card.inc,
+        of the particles in os_pids. They are read from the table written
+        at output time, or from the UFO model for outputs without it"""
+        table = pjoin(self.me_dir, 'SubProcesses', 'madstr_os_widths.dat')
+        if not os.path.exists(table):
+            import ufomodel as ufomodel
+            parts_keep = [p for p in ufomodel.all_particles if p.pdg_code in os_pids or -p.pdg_code in os_pids]
+            return [('MDL_%s' % part.get('width')).upper() for part in parts_keep]
 
+        widths = []
+        for l in open(table):
+            if not l.strip() or l.startswith('#'):
+                continue
+            pdg, width = l.split()[:2]
+            if (int(pdg) in os_pids or -int(pdg) in os_pids) and width.upper() not in widths:
+                widths.append(width.upper())
+        return widths
 
 
     ############################################################################
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+###################################################
+#                                                   #
+#  Build cache of the object files of the           #
+#  MadSTR plugin of MG5aMC.                          #
+#                                                   #
+#####################################################
+""" Compiles a Fortran file, taking the object from a cache shared among
+process directories if the same file has already been compiled.
+The key of the cache is the hash of the compiler command (without the
+names of the files), of the compiler executable, of the source and of
+all the files it includes, recursively. When the cache is larger than
+its size limit, the least recently used objects are removed.
+Usage (from the makefiles, see update_fks_makefile in madstr_exporter.py):
+  madstr_build_cache.py --cache DIR [--size MB] FC FLAGS... -c -o X.o X.f
+It is enabled by setting MADSTR_BUILD_CACHE (e.g. with output
+--build_cache, or in the environment); MADSTR_BUILD_CACHE_SIZE is the
+size limit in MB (default 1024).
+This script only depends on the Python standard library.
+"""
+
+import os
+import re
+import sys
+import shutil
+import hashlib
+import subprocess
+
+include_re = re.compile(r'''^\s*(?:#\s*)?include\s*['"<]([^'">]+)['">]''', re.IGNORECASE)
+
+
+def find_include(name, dirs):
+    """the path of the included file name, in the first of dirs where it is"""
+    for dirname in dirs:
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def hash_sources(source, dirs, key):
+    """updates key (a hashlib object) with the names and the content of
+    source and of the files it includes, recursively, looked for in dirs.
+    Only the base names enter the key, so that the same file in different
+    directories has the same key"""
+    done = set()
+    to_hash = [source]
+    while to_hash:
+        path = to_hash.pop(0)
+        key.update(os.path.basename(path).encode())
+        if path in done:
+            continue
+        done.add(path)
+        content = open(path, 'rb').read()
+        key.update(content)
+        for line in content.decode('latin-1').split('\n'):
+            match = include_re.match(line)
+            if not match:
+                continue
+            included = find_include(match.group(1), [os.path.dirname(path) or '.'] + dirs)
+            if included:
+                to_hash.append(included)
+            else:
+                # e.g. a system include, the compiler will tell
+                key.update(match.group(1).encode())
+
+
+def get_key(command):
+    """the key of the object compiled by command, a list with the compiler,
+    the flags, -o object and the source (the last argument)"""
+    key = hashlib.sha256()
+    source = command[-1]
+    options = []
+    dirs = []
+    skip = False
+    for i, arg in enumerate(command[:-1]):
+        if skip:
+            skip = False
+            continue
+        if arg == '-o':
+            skip = True
+            continue
+        if arg.startswith('-I'):
+            dirs.append(arg[2:] or command[i + 1])
+        options.append(arg)
+    key.update(' '.join(options).encode())
+    # the compiler executable, in case it changes with the same name
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        compiler = os.path.join(dirname, command[0])
+        if os.path.isfile(compiler) and os.access(compiler, os.X_OK):
+            stat = os.stat(os.path.realpath(compiler))
+            key.update(('%s %d %d' % (os.path.realpath(compiler), stat.st_size, stat.st_mtime)).encode())
+            break
+    hash_sources(source, dirs, key)
+    return key.hexdigest()
+
+
+def get_object(command):
+    """the object file written by command"""
+    if '-o' in command:
+        return command[command.index('-o') + 1]
+    return os.path.splitext(os.path.basename(command[-1]))[0] + '.o'
+
+
+def evict(cache, size_limit):
+    """removes the least recently used objects until the cache is below
+    90% of size_limit (in bytes)"""
+    entries = []
+    for root, dirs, filenames in os.walk(cache):
+        for name in filenames:
+            if not name.endswith('.o'):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum([entry[1] for entry in entries])
+    if total <= size_limit:
+        return
+    for mtime, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= 0.9 * size_limit:
+            break
+
+
+def compile_with_cache(cache, size_limit, command):
+    """compiles with command, unless its object is in cache. Returns the
+    exit status of the compiler"""
+    try:
+        key = get_key(command)
+    except (IOError, OSError):
+        return subprocess.call(command)
+    obj = get_object(command)
+    cached = os.path.join(cache, key[:2], key + '.o')
+
+    if os.path.exists(cached):
+        try:
+            shutil.copyfile(cached, obj)
+            # the time of the last use, for the eviction
+            os.utime(cached, None)
+            return 0
+        except (IOError, OSError):
+            pass
+
+    status = subprocess.call(command)
+    if status == 0:
+        try:
+            if not os.path.isdir(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached))
+            # several make may store the same object at the same time
+            tmp = '%s.%d.tmp' % (cached, os.getpid())
+            shutil.copyfile(obj, tmp)
+            os.rename(tmp, cached)
+            evict(cache, size_limit)
+        except (IOError, OSError):
+            pass
+    return status
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    cache = None
+    size_limit = 1024
+    while args and args[0].startswith('--'):
+        arg = args.pop(0)
+        if arg == '--cache':
+            cache = os.path.expanduser(args.pop(0))
+        elif arg == '--size':
+            size_limit = float(args.pop(0))
+        else:
+            sys.exit('Unknown option %s' % arg)
+    if not args:
+        sys.exit(__doc__)
+    if not cache:
+        sys.exit(subprocess.call(args))
+    sys.exit(compile_with_cache(cache, size_limit * 1024**2, args))
@@ -13,17 +13,21 @@ import copy
 from math import fmod
 import subprocess
 import re
+import sys
 
 plugin_path = os.path.dirname(os.path.realpath( __file__ ))
 
 from madgraph import MadGraph5Error, InvalidCmd, MG5DIR
 import madgraph.iolibs.export_fks as export_fks
+import madgraph.fks.fks_common as fks_common
 import madgraph.iolibs.file_writers as writers
 import madgraph.various.misc as misc
 import madgraph.various.banner as banner_mod
 import madgraph.iolibs.helas_call_writers as helas_call_writers
 import madgraph.iolibs.files as files
 import madgraph.iolibs.drawing_eps as draw
+import madgraph.core.color_amp as color_amp
+import MadSTR.madstr_fks as madstr_fks
 
 logger = logging.getLogger('MadSTR_plugin.MEExporter')
 
@@ -50,6 +54,10 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
     
     def __init__(self, *args, **opts):
         """ Possibly define extra instance attribute for this daughter class."""
+        # the colour bases and matrices, the colour data and the JAMP 
+        # lines already computed in the output, see process_color
+        self.color_cache = {'signatures': [], 'bases': [], 'matrices': [],
+                            'data_lines': [], 'jamp_lines': {}, 'nme': 0}
         return super(MadSTRExporter, self).__init__(*args, **opts)
     
     def read_template_file(self, name):
@@ -67,6 +75,10 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         to_copy_from_madstr_templates = \
                        [ pjoin('SubProcesses','transform_os.f'),
                          pjoin('SubProcesses','test_OS_subtr.f'),
+                         pjoin('SubProcesses','bench_OS_subtr.f'),
+                         pjoin('SubProcesses','madstr_reweight.f'),
+                         pjoin('SubProcesses','madstr_test_utils.f'),
+                         pjoin('SubProcesses','run_test_OS_subtr.py'),
                          ]
         
         for path in to_copy_from_madstr_templates:
@@ -79,6 +91,8 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
 
         self.update_fks_makefile(pjoin(self.dir_path, 'SubProcesses', 'makefile_fks_dir'))
         self.update_run_inc(pjoin(self.dir_path, 'Source', 'run.inc'))
+        self.write_threads_inc(pjoin(self.dir_path, 'SubProcesses', 'madstr_threads.inc'))
+        self.update_make_opts(pjoin(self.dir_path, 'Source', 'make_opts'))
         
         # Write makefile
 
@@ -97,7 +111,14 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         version = misc.get_pkg_info()['version'].split('.')
         if int(version[0]) == 3:
             filename = pjoin(self.dir_path, 'SubProcesses', 'P%s' % matrix_elements.born_me.get('processes')[0].shell_string(), 'real_me_chooser.f')
-            self.write_real_me_wrapper(writers.FortranWriter(filename), matrix_elements, fortran_model)
+            writer = writers.FortranWriter(filename)
+            self.write_real_me_wrapper(writer, matrix_elements, fortran_model)
+            writer.close()
+            # the batched entry points have OpenMP directives, which
+            # FortranWriter would indent (and make them comments)
+            outfile = open(filename, 'a')
+            outfile.write(self.get_real_me_batch_lines())
+            outfile.close()
 
         Pdir = pjoin(self.dir_path, 'SubProcesses', \
                        "P%s" % matrix_elements.get('processes')[0].shell_string())
@@ -105,9 +126,14 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         # the file with the informations for on-shell subtraction
         filename = pjoin(Pdir, 'osinfo.dat')
         self.write_osinfo_file(matrix_elements, filename)
+        # and the one with the real processes of each FKS configuration,
+        # used to find the P* dir of the real emissions in the events
+        filename = pjoin(Pdir, 'madstr_reals.dat')
+        self.write_reals_file(matrix_elements, filename)
 
         # link extra files
-        linkfiles = ['transform_os.f', 'test_OS_subtr.f']
+        linkfiles = ['transform_os.f', 'test_OS_subtr.f', 'bench_OS_subtr.f',
+                     'madstr_reweight.f', 'madstr_test_utils.f', 'madstr_threads.inc']
         for f in linkfiles:
             files.ln('../%s' % f, cwd=Pdir)
         # Add the os_ids to os_ids.mg
@@ -120,6 +146,18 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         return calls
 
     
+    def write_threads_inc(self, filename):
+        """write the include file with the maximum number of threads
+        which can call the OS-subtracted matrix elements at the same time.
+        It is 1 unless the output has been generated with --reentrant"""
+        nthreads = self.opt.get('madstr_max_threads', 1)
+        text = "      integer madstr_maxthreads\n" + \
+               "      parameter (madstr_maxthreads=%d)\n" % nthreads
+        outfile = open(filename, 'w')
+        outfile.write(text)
+        outfile.close()
+
+
     def write_osinfo_file(self,matrix_element,outfilename):
         """write a .dat file with the on-shell informations
         """
@@ -128,11 +166,27 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         for i, fksinfo in enumerate(matrix_element.get_fks_info_list()):
             content += "F %3d " % (i+1)
             real = matrix_element.real_processes[fksinfo['n_me'] - 1]
-            content += " %3d\n" % len(real.os_ids)
-            for os_id, dau_pos in zip(real.os_ids, real.os_daughter_pos):
+            content += " %3d\n" % len(real.os_configurations)
+            for conf in real.os_configurations:
                 content += "O "
-                content += " ".join(["%3d" % v for v in os_id]) +  "     "
-                content += " ".join(["%3d" % (v+1) for v in dau_pos]) +  "\n"
+                content += " ".join(["%3d" % v for v in conf.ids]) +  "     "
+                content += " ".join(["%3d" % (v+1) for v in conf.daughter_pos]) +  "\n"
+        outfile.write(content)
+        outfile.close()
+
+
+    def write_reals_file(self, matrix_element, outfilename):
+        """write a .dat file with, for each FKS configuration, the PDG codes
+        of the real-emission processes, in the order of the momenta passed
+        to smatrix_real
+        """
+        outfile = open(outfilename, 'w')
+        content = ""
+        for i, fksinfo in enumerate(matrix_element.get_fks_info_list()):
+            real = matrix_element.real_processes[fksinfo['n_me'] - 1]
+            for proc in real.matrix_element.get('processes'):
+                content += "%3d " % (i+1)
+                content += " ".join(["%d" % leg.get('id') for leg in proc.get('legs')]) + "\n"
         outfile.write(content)
         outfile.close()
 
@@ -143,7 +197,7 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         os_ids = []
         for real in matrix_element.real_processes:
             # append only the mother particle, i.e. the 1st particle in each list of ids
-            os_ids += [ids[0] for ids in real.os_ids]
+            os_ids += [conf.ids[0] for conf in real.os_configurations]
         return set(os_ids)
 
 
@@ -173,10 +227,12 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
         else:
             model = matrix_element.born_me.get('processes')[0].get('model')
         for n, fksreal in enumerate(matrix_element.real_processes):
-            for nos, os_me in enumerate(fksreal.os_matrix_elements):
-                suffix = '%d_os_%d' % (n + 1, nos + 1)
+            for nos, conf, nrep in madstr_fks.get_os_terms(fksreal):
+                if nrep != nos:
+                    continue
+                suffix = '%d_os_%d' % (n + 1, nos)
                 filename = 'matrix_%s.ps' % suffix
-                plot = draw.MultiEpsDiagramDrawer(os_me.\
+                plot = draw.MultiEpsDiagramDrawer(conf.matrix_element.\
                                         get('base_amplitude').get('diagrams'),
                                         filename,
                                         model=model,
@@ -193,46 +249,49 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
 
         for n, fksreal in enumerate(matrix_element.real_processes):
             filename = 'matrix_%d.f' % (n + 1)
+            os_ids = [list(conf.ids) for conf in fksreal.os_configurations]
             self.write_matrix_element_fks(writers.FortranWriter(filename),
                                           fksreal.matrix_element, n + 1, 
                                           fortran_model, 
-                                          os_info = {'diags': fksreal.os_diagrams,
-                                                     'ids': fksreal.os_ids,
-                                                     'dau_pos': fksreal.os_daughter_pos})
-
-            for nos, os_me in enumerate(fksreal.os_matrix_elements):
-                suffix = '%d_os_%d' % (n + 1, nos + 1)
-                filename = 'matrix_%s.f' % suffix
-                self.write_matrix_element_fks(writers.FortranWriter(filename),
-                                            os_me, suffix, fortran_model, 
-                                            os_info = {'diags': [], 'ids': fksreal.os_ids, 'dau_pos': []})
+                                          os_info = {'diags': [list(conf.diagrams) for conf in fksreal.os_configurations],
+                                                     'ids': os_ids,
+                                                     'dau_pos': [list(conf.daughter_pos) for conf in fksreal.os_configurations]})
+
+            # the OS terms which are permutations of another one (see
+            # find_os_divergences) only have the wrapper, which evaluates
+            # the matrix element of the representative
+            for nos, conf, nrep in madstr_fks.get_os_terms(fksreal):
+                os_me = fksreal.os_configurations[nrep - 1].matrix_element
+                me_suffix = '%d_os_%d' % (n + 1, nrep)
+                if nrep == nos:
+                    filename = 'matrix_%s.f' % me_suffix
+                    self.write_matrix_element_fks(writers.FortranWriter(filename),
+                                                os_me, me_suffix, fortran_model, 
+                                                os_info = {'diags': [], 'ids': os_ids, 'dau_pos': []})
+                suffix = '%d_os_%d' % (n + 1, nos)
                 filename = 'wrapper_matrix_%s.f' % suffix
                 self.write_os_wrapper(writers.FortranWriter(filename),
-                        fksreal.matrix_element, os_me, suffix, fortran_model)
+                        fksreal.matrix_element, os_me, suffix, fortran_model,
+                        conf.daughter_pos, me_suffix)
 
 
-    def write_os_wrapper(self, writer, real_me, os_me, suffix, fortran_model):
+    def write_os_wrapper(self, writer, real_me, os_me, suffix, fortran_model,
+                         daughter_pos=None, me_suffix=None):
         """write the wrapper for the on shell subtraction matrix-elements
         which takes care of reordering the momenta and of knowing which is the 
-        mother particle"""
+        mother particle.
+        daughter_pos are the positions of the daughters in real_me, which are
+        needed if os_me is the matrix element of the representative of the
+        OS term. me_suffix is the suffix of os_me (default: suffix)"""
         replace_dict = {}
         replace_dict['suffix'] = suffix
+        replace_dict['me_suffix'] = me_suffix or suffix
 
         # find the permutation of the final state legs to map real_me onto os_me. 
         # look only at final state legs (initial state legs are not touched)
         real_ids = [l['id'] for l in real_me.get_base_amplitude()['process']['legs'] if l['state']]
         os_ids = os_me.get_base_amplitude()['process'].get_final_ids_after_decay()
         nexternal,ninitial = real_me.get_nexternal_ninitial()
-        permutation = []
-        #initial state legs are trivial
-        for i in range(ninitial):
-            permutation.append(i)
-        for os_id in os_ids:
-            permutation.append(ninitial + real_ids.index(os_id))
-            # don't remove from the list, otherwise the position is
-            # not correcly returned, just replace it by an 'x' 
-            real_ids[real_ids.index(os_id)] = 'x'
-        replace_dict['mom_perm'] = ', '.join([str(pp + 1) for pp in permutation])
         # find decay mother and daughter id's
         mother = [l['id'] \
                 for l in os_me.get_base_amplitude()['process']['decay_chains'][0]['legs'] \
@@ -270,18 +329,50 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
             replace_dict['idau2'] = os_ids.index(daughters[1]) + ninitial + 1
         else:
             # otherwise, assign the position of the mother and the next one
-            real_ids = [l['id'] for l in os_me.get_base_amplitude()['process']['legs'] if l['state']]
-            replace_dict['idau1'] = real_ids.index(mother[0]) + ninitial + 1
-            replace_dict['idau2'] = real_ids.index(mother[0]) + ninitial + 2
+            os_proc_ids = [l['id'] for l in os_me.get_base_amplitude()['process']['legs'] if l['state']]
+            replace_dict['idau1'] = os_proc_ids.index(mother[0]) + ninitial + 1
+            replace_dict['idau2'] = os_proc_ids.index(mother[0]) + ninitial + 2
 
-        # find the spectator (needed by the function which put momenta on-shell)
-        # by default choose the first final state particle which is not a daughter
-        for i in range(ninitial,nexternal):
-            if i + 1 not in [replace_dict['idau1'], replace_dict['idau2']]:
-                spectator = i + 1
-                break
-        replace_dict['ispect'] = spectator 
-        replace_dict['spect_mass'] = model.get_particle(spectator)['mass']
+        permutation = []
+        #initial state legs are trivial
+        for i in range(ninitial):
+            permutation.append(i)
+        os_dau_pos = {replace_dict['idau1'] - ninitial - 1: daughters[0],
+                      replace_dict['idau2'] - ninitial - 1: daughters[1]}
+        if daughter_pos is not None:
+            # the daughters of the OS term go where os_me has its daughters,
+            # the pdg codes are enough for the other legs
+            real_dau_pos = list(daughter_pos)
+            real_dau_ids = [real_ids[pos - ninitial] for pos in real_dau_pos]
+            for pos in real_dau_pos:
+                real_ids[pos - ninitial] = 'x'
+        for i, os_id in enumerate(os_ids):
+            if daughter_pos is not None and i in os_dau_pos:
+                k = real_dau_ids.index(os_dau_pos[i])
+                real_dau_ids.pop(k)
+                permutation.append(real_dau_pos.pop(k))
+                continue
+            permutation.append(ninitial + real_ids.index(os_id))
+            # don't remove from the list, otherwise the position is
+            # not correcly returned, just replace it by an 'x' 
+            real_ids[real_ids.index(os_id)] = 'x'
+        replace_dict['mom_perm'] = ', '.join([str(pp + 1) for pp in permutation])
+
+        # find the spectators (needed by the function which put momenta on-shell
+        # with istr=7,8): all the final state particles which are not daughters.
+        # At each point the wrapper uses the first one which can absorb the
+        # recoil, so that the reshuffling fails only if none of them can
+        spectators = [i + 1 for i in range(ninitial, nexternal) \
+                if i + 1 not in [replace_dict['idau1'], replace_dict['idau2']]]
+        if not spectators:
+            raise fks_common.FKSProcessError(
+                    'No spectator available for the OS reshuffling')
+        replace_dict['nspect'] = len(spectators)
+        replace_dict['ispect'] = ', '.join(['%d' % i for i in spectators])
+        # the momenta passed to the reshuffling follow os_ids
+        replace_dict['spect_mass_lines'] = '\n'.join(['spect_mass(%d) = %s' % \
+                (k + 1, model.get_particle(os_ids[i - ninitial - 1])['mass']) \
+                for k, i in enumerate(spectators)])
 
 
         version = misc.get_pkg_info()['version'].split('.')
@@ -289,10 +380,15 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
             replace_dict['amp_split_decl'] = ''
             replace_dict['amp_split_add'] = ''
             replace_dict['amp_split_init'] = ''
+            replace_dict['amp_split_nom_add'] = ''
+            replace_dict['amp_split_nom_init'] = ''
         elif int(version[0]) == 3:
-            replace_dict['amp_split_decl'] = 'include "orders.inc"\n double precision amp_split_os(amp_split_size)\n common /to_amp_split_os/amp_split_os\n' 
-            replace_dict['amp_split_add'] = '\namp_split_os(:) = amp_split_os(:) * pdfratio * bwratio * fluxratio' 
-            replace_dict['amp_split_init'] = 'amp_split_os(:) = 0d0'
+            replace_dict['amp_split_decl'] = 'include "orders.inc"\n double precision amp_split_os(amp_split_size, madstr_maxthreads)\n common /to_amp_split_os/amp_split_os\n' + \
+                                             ' double precision amp_split_os_nom(amp_split_size, madstr_maxthreads)\n common /to_amp_split_os_nom/amp_split_os_nom\n'
+            replace_dict['amp_split_add'] = '\namp_split_os(:, ith) = amp_split_os(:, ith) * pdfratio * bwratio * fluxratio' 
+            replace_dict['amp_split_init'] = 'amp_split_os(:, ith) = 0d0'
+            replace_dict['amp_split_nom_add'] = '\namp_split_os_nom(:, ith) = amp_split_os_nom(:, ith) + amp_split_os(:, ith) * ratio_nom'
+            replace_dict['amp_split_nom_init'] = 'amp_split_os_nom(:, ith) = 0d0'
 
         # finally write out the file
         file = open(os.path.join(self.template_path, 'os_wrapper_fks.inc')).read()
@@ -310,14 +406,23 @@ class MadSTRExporter(export_fks.ProcessOptimizedExporterFortranFKS):
 """subroutine smatrix_real(p, wgt)
 implicit none
 include 'nexternal.inc'
+include 'madstr_threads.inc'
 double precision p(0:3, nexternal)
-double precision wgt, wgt_re, wgt_os, wgt_os_this
-double precision iden_comp
-common /to_real_wgts/wgt_re, wgt_os
+double precision wgt, wgt_re, wgt_os
+C real and OS weights of the last point, for each thread
+double precision wgt_re_th(madstr_maxthreads), wgt_os_th(madstr_maxthreads)
+common /to_real_wgts/wgt_re_th, wgt_os_th
+integer ith
+integer madstr_thread_id
 integer nfksprocess
 common/c_nfksprocess/nfksprocess
+logical madstr_in_parallel
 %(amp_split_decl)s
 
+C the widths of the OS particles are read from the param_card at the first call
+call madstr_read_keep_widths()
+
+ith = madstr_thread_id()
 wgt_re=0d0
 wgt_os=0d0
 
@@ -325,13 +430,8 @@ wgt_os=0d0
         # subtract here the on shell matrix-elements if any is there
         for n, info in enumerate(matrix_element.get_fks_info_list()):
             os_lines = '%(amp_split_copy)s'
-            iden_re = matrix_element.real_processes[info['n_me'] - 1].matrix_element.get('identical_particle_factor') 
-            for i, os_me in \
-              enumerate(matrix_element.real_processes[info['n_me'] - 1].os_matrix_elements):
-                iden_os = os_me.get('identical_particle_factor') 
-                os_lines += '\n iden_comp=dble(%d)/dble(%d)\ncall smatrix_%d_os_%d_wrapper(p, wgt_os_this)\n wgt_os = wgt_os + wgt_os_this*iden_comp' \
-                        % (iden_os, iden_re, info['n_me'] , i + 1)
-                os_lines +="%(amp_split_add)s"
+            if madstr_fks.get_os_terms(matrix_element.real_processes[info['n_me'] - 1]):
+                os_lines += '\ncall smatrix_%d_os_sum(p, wgt_os)' % info['n_me']
 
             file += \
 """if (nfksprocess.eq.%(n)d) then
@@ -345,6 +445,8 @@ write(*,*) 'ERROR: invalid n in real_matrix :', nfksprocess
 stop
 endif
 wgt = wgt_re - wgt_os
+wgt_re_th(ith) = wgt_re
+wgt_os_th(ith) = wgt_os %(amp_split_out)s
 return
 end
 """
@@ -353,23 +455,323 @@ end
 """
 wgt=0d0
 %(amp_split_zero)s
+wgt_re_th(ith) = wgt_re
+wgt_os_th(ith) = wgt_os %(amp_split_out)s
 return
 end
 """
+        file += self.get_os_sum_lines(matrix_element)
+        file += self.get_real_me_multi_lines(matrix_element)
+
+        # the batched version which returns also the split orders only 
+        # exists in v3 (the other ones are added by get_real_me_batch_lines)
+        file += '%(batch_split)s'
+
         version = misc.get_pkg_info()['version'].split('.')
         if int(version[0]) == 2:
-            amp_split_dict = {'amp_split_decl': '', 'amp_split_copy': '', 'amp_split_add': '', 'amp_split_zero': ''}
+            amp_split_dict = {'amp_split_decl': '', 'amp_split_copy': '', 'amp_split_add': '', 'amp_split_zero': '',
+                              'amp_split_out': '', 'amp_split_nom_sub': '',
+                              'amp_split_last_decl': '', 'amp_split_reuse': '', 'amp_split_last_init': '',
+                              'batch_split': ''}
         elif int(version[0]) == 3:
-            amp_split_dict = {'amp_split_decl': 'include "orders.inc"\n double precision amp_split_os(amp_split_size)\n common /to_amp_split_os/amp_split_os\n', 
-                              'amp_split_copy': '\namp_split(:) = amp_split_os(:)', 
-                              'amp_split_add': '\namp_split(:) = amp_split(:) - amp_split_os(:)*iden_comp', 
-                              'amp_split_zero': 'amp_split(:)=0d0'}
+            # the split orders are accumulated per thread in amp_split_real,
+            # and copied to amp_split (shared) outside of parallel regions
+            amp_split_dict = {'amp_split_decl': 'include "orders.inc"\n double precision amp_split_os(amp_split_size, madstr_maxthreads)\n common /to_amp_split_os/amp_split_os\n' + \
+                                                ' double precision amp_split_real(amp_split_size, madstr_maxthreads)\n common /to_amp_split_real/amp_split_real\n' + \
+                                                ' double precision amp_split_os_nom(amp_split_size, madstr_maxthreads)\n common /to_amp_split_os_nom/amp_split_os_nom\n',
+                              'amp_split_copy': '\namp_split_real(:, ith) = amp_split_os(:, ith)',
+                              'amp_split_add': '\namp_split_real(:, ith) = amp_split_real(:, ith) - amp_split_os(:, ith)*iden_comp' + \
+                                               '\namp_split_last(:, ith) = amp_split_last(:, ith) + amp_split_os(:, ith)*iden_comp',
+                              'amp_split_zero': 'amp_split_real(:, ith) = 0d0',
+                              'amp_split_out': '\nif (.not.madstr_in_parallel()) amp_split(:) = amp_split_real(:, ith)',
+                              'amp_split_nom_sub': '\namp_split_real(:, ith) = amp_split_real(:, ith) - amp_split_os_nom(:, ith)*iden_comp',
+                              'amp_split_last_decl': 'double precision amp_split_last(amp_split_size, madstr_maxthreads)\nsave amp_split_last',
+                              'amp_split_reuse': '\namp_split_real(:, ith) = amp_split_real(:, ith) - amp_split_last(:, ith)',
+                              'amp_split_last_init': '\namp_split_last(:, ith) = 0d0',
+                              'batch_split': self.get_real_me_batch_split_lines()}
 
         # Write the file
         writer.writelines(file % amp_split_dict)
         return 0
 
 
+    def get_os_sum_lines(self, matrix_element):
+        """returns, for each real matrix element with OS counterterms, the
+        routine smatrix_N_os_sum which sums them. Several FKS configurations
+        share the same real matrix element, hence the same counterterms: the
+        sum (and its split-order components) of the last point is kept for
+        each thread, and it is reused if the same point is evaluated again
+        (see madstr_same_point)"""
+        file = ''
+        done_me = []
+        for info in matrix_element.get_fks_info_list():
+            n_me = info['n_me']
+            if n_me in done_me:
+                continue
+            done_me.append(n_me)
+            real = matrix_element.real_processes[n_me - 1]
+            os_terms = madstr_fks.get_os_terms(real)
+            if not os_terms:
+                continue
+            iden_re = real.matrix_element.get('identical_particle_factor')
+            os_lines = ''
+            for nos, conf, nrep in os_terms:
+                iden_os = real.os_configurations[nrep - 1].matrix_element.get('identical_particle_factor')
+                os_lines += '\n iden_comp=dble(%d)/dble(%d)\ncall smatrix_%d_os_%d_wrapper(p, wgt_os_this)\n wgt_os = wgt_os + wgt_os_this*iden_comp' \
+                        % (iden_os, iden_re, n_me, nos)
+                os_lines += '%(amp_split_add)s'
+
+            file += \
+"""
+subroutine smatrix_%(n_me)d_os_sum(p, wgt_os)
+C the sum of the OS counterterms of the real matrix element %(n_me)d
+implicit none
+include 'nexternal.inc'
+include 'madstr_threads.inc'
+double precision p(0:3, nexternal)
+double precision wgt_os, wgt_os_this
+double precision iden_comp
+C the last point of each thread and its result
+double precision p_last(0:3, nexternal, madstr_maxthreads)
+double precision xbk_last(2, madstr_maxthreads)
+double precision scales_last(4, madstr_maxthreads)
+double precision wgt_os_last(madstr_maxthreads)
+integer istr_last(madstr_maxthreads)
+save p_last, xbk_last, scales_last, wgt_os_last, istr_last
+data istr_last / madstr_maxthreads*-1 /
+integer ith
+integer madstr_thread_id
+logical madstr_same_point
+%%(amp_split_decl)s
+%%(amp_split_last_decl)s
+
+ith = madstr_thread_id()
+if (madstr_same_point(p, p_last(0,1,ith), xbk_last(1,ith), scales_last(1,ith), istr_last(ith))) then
+wgt_os = wgt_os_last(ith) %%(amp_split_reuse)s
+return
+endif
+
+wgt_os = 0d0 %%(amp_split_last_init)s %(os_lines)s
+wgt_os_last(ith) = wgt_os
+return
+end
+""" % {'n_me': n_me, 'os_lines': os_lines}
+        return file
+
+
+    def get_real_me_multi_lines(self, matrix_element):
+        """returns smatrix_real_multi, which computes on a phase-space point
+        the subtracted weight for all the strategies (istr=0...8).
+        The real matrix element is evaluated twice (with and without
+        the resonant diagrams), and the OS matrix elements once for each
+        reshuffling. The nominal strategy (istr of the run_card) is taken
+        from the same evaluations, and wgt, the split-order information and
+        the weights in to_real_wgts are set as smatrix_real does.
+        It is the entry point of the standalone output, of the
+        benchmarks and of madstr_reweight, which gives the weights of all
+        the strategies written in the events with str_multi_weights"""
+
+        file = \
+"""
+subroutine smatrix_real_multi(p, wgt, wgt_str)
+C on exit wgt_str(i) is the subtracted weight with istr=i, wgt the
+C one with the istr of the run_card (as returned by smatrix_real)
+implicit none
+include 'nexternal.inc'
+include 'madstr_threads.inc'
+double precision p(0:3, nexternal)
+double precision wgt, wgt_str(0:8)
+double precision wgt_re, wgt_os, wgt_re_dr, wgt_re_full, wgt_re_other
+double precision wgt_os_str(2:8), wgt_os_this(2:8)
+double precision iden_comp
+double precision wgt_re_th(madstr_maxthreads), wgt_os_th(madstr_maxthreads)
+common /to_real_wgts/wgt_re_th, wgt_os_th
+logical str_include_pdf, str_include_flux
+integer istr
+common /to_os_reshuf/ str_include_pdf, str_include_flux, istr
+integer is, ith
+integer madstr_thread_id
+integer nfksprocess
+common/c_nfksprocess/nfksprocess
+logical madstr_in_parallel
+%(amp_split_decl)s
+
+call madstr_read_keep_widths()
+
+ith = madstr_thread_id()
+do is = 2, 8
+wgt_os_str(is) = 0d0
+enddo
+C the real matrix element which is not the nominal one
+if (istr.eq.1) then
+call madstr_set_istr(0)
+else
+call madstr_set_istr(1)
+endif
+
+"""
+        for n, info in enumerate(matrix_element.get_fks_info_list()):
+            os_lines = ''
+            real = matrix_element.real_processes[info['n_me'] - 1]
+            iden_re = real.matrix_element.get('identical_particle_factor') 
+            for nos, conf, nrep in madstr_fks.get_os_terms(real):
+                iden_os = real.os_configurations[nrep - 1].matrix_element.get('identical_particle_factor') 
+                os_lines += '\n iden_comp=dble(%d)/dble(%d)\ncall smatrix_%d_os_%d_wrapper_multi(p, wgt_os_this)\n wgt_os_str(:) = wgt_os_str(:) + wgt_os_this(:)*iden_comp' \
+                        % (iden_os, iden_re, info['n_me'] , nos)
+                os_lines += '%(amp_split_nom_sub)s'
+
+            file += \
+"""if (nfksprocess.eq.%(n)d) then
+call smatrix_%(n_me)d(p, wgt_re_other)
+C the nominal one
+call madstr_set_istr(-1)
+call smatrix_%(n_me)d(p, wgt_re) %%(amp_split_copy)s %(os_lines)s
+else""" % {'n': n + 1, 'n_me' : info['n_me'], 'os_lines': os_lines}
+
+        if matrix_element.real_processes:
+            file += \
+"""
+write(*,*) 'ERROR: invalid n in real_matrix_multi :', nfksprocess
+stop
+endif
+"""
+        else:
+            file += \
+"""
+wgt_re_other=0d0
+wgt_re=0d0
+call madstr_set_istr(-1)
+%(amp_split_zero)s
+"""
+        file += \
+"""
+if (istr.eq.1) then
+wgt_re_dr = wgt_re
+wgt_re_full = wgt_re_other
+else
+wgt_re_dr = wgt_re_other
+wgt_re_full = wgt_re
+endif
+
+wgt_str(0) = wgt_re_full
+wgt_str(1) = wgt_re_dr
+do is = 2, 8
+wgt_str(is) = wgt_re_full - wgt_os_str(is)
+enddo
+
+C the nominal strategy
+wgt_os = 0d0
+if (istr.ge.2) wgt_os = wgt_os_str(istr)
+wgt = wgt_re - wgt_os
+wgt_re_th(ith) = wgt_re
+wgt_os_th(ith) = wgt_os %(amp_split_out)s
+return
+end
+"""
+        return file
+
+
+    def get_real_me_batch_lines(self):
+        """returns the batched entry points to smatrix_real and to
+        smatrix_real_multi, in fixed form since they are not written with
+        FortranWriter. Momenta are stored point after point, 
+        p(0:3,nexternal,npts), so that each point is handed to the scalar
+        code without copies"""
+        return \
+"""
+
+      subroutine smatrix_real_batch(npts, p, wgt, wgt_re_b, wgt_os_b)
+C evaluates smatrix_real on npts phase-space points.
+C On exit wgt = wgt_re_b - wgt_os_b for each point.
+C Momenta are stored point after point, p(0:3,nexternal,npts).
+C If the output has been generated with --reentrant and the code is
+C compiled with OpenMP, the points are distributed among the threads
+      implicit none
+      include 'nexternal.inc'
+      include 'madstr_threads.inc'
+      integer npts
+      double precision p(0:3, nexternal, npts)
+      double precision wgt(npts), wgt_re_b(npts), wgt_os_b(npts)
+      double precision wgt_re(madstr_maxthreads), wgt_os(madstr_maxthreads)
+      common /to_real_wgts/wgt_re, wgt_os
+      integer ipt, ith
+      integer madstr_thread_id
+
+C the widths of the OS particles are read before the parallel region
+      call madstr_read_keep_widths()
+!$OMP PARALLEL DO IF(madstr_maxthreads.gt.1) PRIVATE(ith)
+      do ipt = 1, npts
+        call smatrix_real(p(0,1,ipt), wgt(ipt))
+        ith = madstr_thread_id()
+        wgt_re_b(ipt) = wgt_re(ith)
+        wgt_os_b(ipt) = wgt_os(ith)
+      enddo
+!$OMP END PARALLEL DO
+      return
+      end
+
+
+      subroutine smatrix_real_multi_batch(npts, p, wgt_str_b)
+C evaluates smatrix_real_multi on npts phase-space points.
+C On exit wgt_str_b(istr,ipt) is the subtracted weight of the point
+C ipt for the strategy istr (0...8).
+C Momenta are stored point after point, p(0:3,nexternal,npts)
+      implicit none
+      include 'nexternal.inc'
+      include 'madstr_threads.inc'
+      integer npts
+      double precision p(0:3, nexternal, npts)
+      double precision wgt_str_b(0:8, npts)
+      double precision wgt
+      integer ipt
+
+      call madstr_read_keep_widths()
+!$OMP PARALLEL DO IF(madstr_maxthreads.gt.1) PRIVATE(wgt)
+      do ipt = 1, npts
+        call smatrix_real_multi(p(0,1,ipt), wgt, wgt_str_b(0,ipt))
+      enddo
+!$OMP END PARALLEL DO
+      return
+      end
+"""
+
+
+    def get_real_me_batch_split_lines(self):
+        """returns the batched entry point to smatrix_real which also
+        returns the (OS-subtracted) split-order components of each point.
+        Momenta are stored point after point, p(0:3,nexternal,npts), so that
+        each point is handed to the scalar code without copies"""
+        return \
+"""
+subroutine smatrix_real_batch_split(npts, p, wgt, wgt_re_b, wgt_os_b, amp_split_b)
+C as smatrix_real_batch, and in addition returns, for each point,
+C the content of amp_split after the on-shell subtraction.
+C amp_split is shared among threads, so this routine is always serial
+implicit none
+include 'nexternal.inc'
+include 'madstr_threads.inc'
+include 'orders.inc'
+integer npts
+double precision p(0:3, nexternal, npts)
+double precision wgt(npts), wgt_re_b(npts), wgt_os_b(npts)
+double precision amp_split_b(amp_split_size, npts)
+double precision wgt_re(madstr_maxthreads), wgt_os(madstr_maxthreads)
+common /to_real_wgts/wgt_re, wgt_os
+integer ipt, ith
+integer madstr_thread_id
+
+ith = madstr_thread_id()
+do ipt = 1, npts
+call smatrix_real(p(0,1,ipt), wgt(ipt))
+wgt_re_b(ipt) = wgt_re(ith)
+wgt_os_b(ipt) = wgt_os(ith)
+amp_split_b(:, ipt) = amp_split(:)
+enddo
+return
+end
+"""
+
+
     #===========================================================================
     # write_os_ids
     #===========================================================================
@@ -401,9 +803,13 @@ end
         tag = '\nFILES= '
         content=content.replace(tag, tag + to_add)
 
-        to_add = """\n# Files for testOS
-TESTOS= $(FILES) test_OS_subtr.o BinothLHADummy.o cuts.o                \\
-      pythia_unlops.o recluster.o
+        to_add = """\n# Files for testOS, benchOS and madstr_reweight
+TESTOS= $(FILES) test_OS_subtr.o madstr_test_utils.o BinothLHADummy.o    \\
+      cuts.o pythia_unlops.o recluster.o
+BENCHOS= $(FILES) bench_OS_subtr.o madstr_test_utils.o BinothLHADummy.o  \\
+      cuts.o pythia_unlops.o recluster.o
+REWGTOS= $(FILES) madstr_reweight.o madstr_test_utils.o BinothLHADummy.o \\
+      cuts.o pythia_unlops.o recluster.o
 
 """
         tag = """# Files for tests"""
@@ -415,6 +821,14 @@ test_OS_subtr: $(TESTOS)
 	rm test_OS_subtr.o
 	strip test_OS_subtr
 
+bench_OS_subtr: $(BENCHOS)
+	$(FC) $(LDFLAGS) -o bench_OS_subtr $(BENCHOS) $(APPLLIBS) $(LINKLIBS) $(FJLIBS)
+	rm bench_OS_subtr.o
+
+madstr_reweight: $(REWGTOS)
+	$(FC) $(LDFLAGS) -o madstr_reweight $(REWGTOS) $(APPLLIBS) $(LINKLIBS) $(FJLIBS)
+	rm madstr_reweight.o
+
 """
         tag = """\n
 test_soft_col_limits: $(TEST)
@@ -424,11 +838,115 @@ test_soft_col_limits: $(TEST)
 """
         content=content.replace(tag, tag + to_add)
 
+        # the objects which do not depend on the run mode, compiled in
+        # the background at output time with output --compile
+        content += """
+madstr_objects: $(FILES)
+"""
+        content += self.get_build_cache_rule(
+                '$(patsubst %.f,%.o,$(wildcard matrix_*.f wrapper_matrix_*.f transform_os.f))')
+
+        # with --reentrant=N (N>1), only the MadSTR objects are compiled 
+        # with OpenMP and with their local variables on the stack, so that
+        # the threads do not share them. The other objects keep the flags
+        # of make_opts (e.g. -fno-automatic)
+        if self.opt.get('madstr_max_threads', 1) > 1:
+            content += """
+# MadSTR --reentrant
+MADSTR_OMP= $(patsubst %.f,%.o,$(wildcard matrix_*.f wrapper_matrix_*.f)) transform_os.o real_me_chooser.o
+$(MADSTR_OMP): FFLAGS := $(filter-out -fno-automatic,$(FFLAGS)) -fopenmp
+LDFLAGS += -fopenmp
+"""
+
         out = open(makefile, 'w')
         out.write(content)
         out.close()
 
 
+    def get_build_cache_rule(self, objects):
+        """the makefile rule which compiles objects (a make expression)
+        from their .f source through the build cache, bin/internal/madstr_build_cache.py
+        (from the P directories and from Source/MODEL). The rule is only
+        there if MADSTR_BUILD_CACHE is set, in make_opts or in the environment
+        """
+        return """
+# build cache of the objects, shared among process directories
+MADSTR_PYTHON ?= python
+MADSTR_BUILD_CACHE_SIZE ?= 1024
+ifneq ($(MADSTR_BUILD_CACHE),)
+MADSTR_CACHED= %s
+$(MADSTR_CACHED): %%.o: %%.f $(wildcard *.inc)
+	$(MADSTR_PYTHON) ../../bin/internal/madstr_build_cache.py --cache $(MADSTR_BUILD_CACHE) \\
+	  --size $(MADSTR_BUILD_CACHE_SIZE) $(FC) $(FFLAGS) -c -o $@ $<
+endif
+""" % objects
+
+
+    def update_build_cache(self):
+        """set up the build cache: copy its driver to bin/internal, and 
+        compile the model through it. The cache directory is set in 
+        make_opts by update_make_opts"""
+        files.cp(pjoin(plugin_path, 'madstr_build_cache.py'),
+                 pjoin(self.dir_path, 'bin', 'internal'))
+
+        # only the objects of the model library with a .f source
+        if self.has_lines(pjoin(self.dir_path, 'Source', 'MODEL', 'makefile'), 'MADSTR_CACHED'):
+            return
+        makefile = open(pjoin(self.dir_path, 'Source', 'MODEL', 'makefile'), 'a')
+        makefile.write(self.get_build_cache_rule(
+                '$(filter $(MODEL),$(patsubst %.f,%.o,$(wildcard *.f)))'))
+        makefile.close()
+
+
+    def update_driver_os_counts(self, filename):
+        """add to the driver of MG5_aMC the call to madstr_write_os_counts,
+        which writes in the log of each channel the number of OS subtractions,
+        the failed fraction for each strategy and the fraction of the
+        reused OS counterterms. The call is added before the final report
+        of the driver"""
+        if not os.path.exists(filename):
+            return
+        content = open(filename).read()
+        if 'madstr_write_os_counts' in content:
+            return
+        pattern = re.compile(r'^([ \t]+)if\s*\(\s*i_momcmp_count\s*\.ne\.\s*0\s*\)\s*then', re.M | re.I)
+        match = pattern.search(content)
+        if not match:
+            logger.warning('MadSTR: the OS subtraction counters will not be written by %s' % \
+                    os.path.basename(filename))
+            return
+        content = content[:match.start()] + \
+                '%scall madstr_write_os_counts(6)\n' % match.group(1) + \
+                content[match.start():]
+        out = open(filename, 'w')
+        out.write(content)
+        out.close()
+
+
+    def update_make_opts(self, make_opts):
+        """the MadSTR settings in make_opts: the directory of the build
+        cache if output --build_cache was used (the OpenMP flags of 
+        --reentrant are set for the MadSTR objects only, in the makefile
+        of the P directories, see update_fks_makefile).
+        This is done when the template is copied, so that the objects 
+        compiled while the output is written (output --compile) have the 
+        final flags, and again by finalize. It can be done more than once"""
+        lines = self.get_make_opts_lines(make_opts)
+        out = open(make_opts, 'w')
+        out.write('\n'.join(lines))
+        out.close()
+
+
+    def get_make_opts_lines(self, make_opts):
+        """the lines of make_opts with the settings of update_make_opts"""
+        lines = open(make_opts).read().split('\n')
+        cache = self.opt.get('madstr_build_cache', '')
+        if cache and '# MadSTR build cache' not in lines:
+            lines += ['# MadSTR build cache', 'MADSTR_BUILD_CACHE ?= %s' % cache, 
+                      'MADSTR_PYTHON ?= %s' % sys.executable, '']
+        return lines
+
+
     def update_run_inc(self, runinc):
         """add extra files related to OS to the standard aMC@NLO makefile
         """
@@ -497,13 +1015,19 @@ C for the OS subtraction
         replace_dict['ngraphs'] = ngraphs
     
         # Extract ncolor
+        icolor = None
         if not matrix_element.get('color_basis'):
-            matrix_element.process_color()
+            icolor = self.process_color(matrix_element)
         ncolor = max(1, len(matrix_element.get('color_basis')))
         replace_dict['ncolor'] = ncolor
     
         # Extract color data lines
-        color_data_lines = self.get_color_data_lines(matrix_element)
+        if icolor is None:
+            color_data_lines = self.get_color_data_lines(matrix_element)
+        else:
+            if self.color_cache['data_lines'][icolor] is None:
+                self.color_cache['data_lines'][icolor] = self.get_color_data_lines(matrix_element)
+            color_data_lines = self.color_cache['data_lines'][icolor]
         replace_dict['color_data_lines'] = "\n".join(color_data_lines)
     
         # Extract helas calls
@@ -557,10 +1081,17 @@ C for the OS subtraction
         # has changed in v 2.9
         
         version = misc.get_pkg_info()['version'].split('.')
+        # the JAMP lines are the same for the matrix elements with the same
+        # colour structure and the same amplitudes
+        jamp_key = None
+        if icolor is not None:
+            jamp_key = (icolor, repr(matrix_element.get_color_amplitudes()))
         if int(version[0]) == 2:
             # v2
             realfile = open(os.path.join(self.template_path, 'realmatrix_madstr.inc')).read()
-            if int(version[1]) < 9:
+            if jamp_key in self.color_cache['jamp_lines']:
+                jamp_lines, nb_tmp_jamp = self.color_cache['jamp_lines'][jamp_key]
+            elif int(version[1]) < 9:
                 jamp_lines = self.get_JAMP_lines(matrix_element)
                 nb_tmp_jamp = 1
             elif int(version[1]) >= 9: 
@@ -586,10 +1117,17 @@ C for the OS subtraction
             replace_dict['sqsplitorders']= \
     'C the values listed below are for %s\n' % ', '.join(split_orders_name)
             replace_dict['sqsplitorders']+='\n'.join(sqamp_so)           
-            jamp_lines, nb_tmp_jamp = self.get_JAMP_lines_split_order(\
+            if jamp_key is not None:
+                jamp_key += (repr(amp_orders), repr(split_orders))
+            if jamp_key in self.color_cache['jamp_lines']:
+                jamp_lines, nb_tmp_jamp = self.color_cache['jamp_lines'][jamp_key]
+            else:
+                jamp_lines, nb_tmp_jamp = self.get_JAMP_lines_split_order(\
                        matrix_element,amp_orders,split_order_names=split_orders)
         else:
             raise MadSTRExporterError("Wrong version: %s" % '.'.join(version))
+        if jamp_key is not None:
+            self.color_cache['jamp_lines'][jamp_key] = (jamp_lines, nb_tmp_jamp)
     
         replace_dict['jamp_lines'] = '\n'.join(jamp_lines)
         replace_dict['nb_temp_jamp'] = nb_tmp_jamp
@@ -602,6 +1140,32 @@ C for the OS subtraction
         return len([call for call in helas_calls if call.find('#') != 0]), ncolor
 
 
+    def process_color(self, matrix_element):
+        """sets the colour basis and matrix of matrix_element (the OS ones,
+        whose colour is not processed at generation). As in HelasMultiProcess
+        of MG5_aMC, they are computed only once for each colour signature of
+        the diagrams, and shared among the matrix elements of the output.
+        Returns the index of the colour structure in self.color_cache"""
+        cache = self.color_cache
+        cache['nme'] += 1
+        col_basis = color_amp.ColorBasis()
+        new_amp = matrix_element.get_base_amplitude()
+        matrix_element.set('base_amplitude', new_amp)
+        signature = col_basis.create_color_dict_list(new_amp)
+        try:
+            icolor = cache['signatures'].index(signature)
+        except ValueError:
+            col_basis.build()
+            cache['signatures'].append(signature)
+            cache['bases'].append(col_basis)
+            cache['matrices'].append(color_amp.ColorMatrix(col_basis))
+            cache['data_lines'].append(None)
+            icolor = len(cache['signatures']) - 1
+        matrix_element.set('color_basis', cache['bases'][icolor])
+        matrix_element.set('color_matrix', cache['matrices'][icolor])
+        return icolor
+
+
     def get_os_diagrams_lines(self, matrix_element, os_diagrams, os_ids):
         """ add the lines which set the diagrams used with
         diagram-removal techniques to zero or to the value including
@@ -611,7 +1175,7 @@ C for the OS subtraction
 
         text = ''
         for diags, ids in zip(os_diagrams, os_ids): 
-            text += 'if (%s.gt.(%s+%s)) then\nif (istr.eq.1) then\n' % \
+            text += 'if (%s.gt.(%s+%s)) then\nif (istr_me.eq.1) then\n' % \
                     tuple([particle_dict[idd].get('mass') for idd in ids])
             for diag in diags:
                 for amp in matrix_element['diagrams'][diag]['amplitudes']:
@@ -696,7 +1260,9 @@ C for the OS subtraction
   2 = istr ! strategy to be used to remove resonances 
                          ! appearing in real emissions
  True = str_include_pdf ! compensate for PDFs when doing reshuffling
- True = str_include_flux ! compensate for flux when doing reshuffling"""
+ True = str_include_flux ! compensate for flux when doing reshuffling
+ False = str_multi_weights ! add to the events the weights for
+                         ! istr=0...8 (needs store_rwgt_info = True)"""
 
         run_card_lines = open(pjoin(self.dir_path, 'Cards', 'run_card_default.dat')).read().split('\n')
         # look for the line which contains 'store_rwgt_info', after which we will insert
@@ -716,7 +1282,8 @@ C for the OS subtraction
         banner_text = \
 """        self.add_param('istr', 2)
         self.add_param('str_include_pdf', True)
-        self.add_param('str_include_flux', True)"""
+        self.add_param('str_include_flux', True)
+        self.add_param('str_multi_weights', False, include=False)"""
 
         banner_lines = open(pjoin(self.dir_path, 'bin', 'internal', 'banner.py')).read().split('\n')
         for isplit, line in enumerate(banner_lines):
@@ -729,10 +1296,16 @@ C for the OS subtraction
 
     def finalize(self, matrix_elements, history, mg5options, flaglist):
         """call the mother class, and do a couple of other things relevant 
-        to OS subtraction
+        to OS subtraction. What is done here can be done again (e.g. if an
+        output which has been interrupted while finalizing is resumed): the
+        lines added to the files of the output are not added twice
         """
         super(MadSTRExporter, self).finalize(matrix_elements, history, mg5options, flaglist)
 
+        if self.color_cache['nme']:
+            logger.debug('MadSTR: %d colour structures computed for %d OS matrix elements' % \
+                    (len(self.color_cache['signatures']), self.color_cache['nme']))
+
         os_ids = self.get_os_ids_from_file(pjoin(self.dir_path, 'SubProcesses', 'os_ids.mg'))
 
         # add the widths corresponding to the os_ids to coupl.inc
@@ -745,11 +1318,28 @@ C for the OS subtraction
         filename=pjoin(self.dir_path, 'Source', 'MODEL', 'get_mass_width_fcts.f')
         width_particles = [particle_dict[idd] for idd in os_ids]
         self.update_get_mass_width(width_particles, filename)
+        # and the routines which read the _keep widths from the param_card
+        # at run time
+        self.write_keep_widths_loader(width_particles, filename)
+        self.update_model_makefile(pjoin(self.dir_path, 'Source', 'MODEL', 'makefile'))
+        # and the table of the OS widths used at run time by treatcards,
+        # so that it does not need to import the UFO model
+        self.write_os_widths_table(width_particles, 
+                pjoin(self.dir_path, 'SubProcesses', 'madstr_os_widths.dat'))
+
+        self.update_build_cache()
+
+        # the OS subtraction counters are written at the end of the runs
+        for driver in ['driver_mintMC.f', 'driver_mintFO.f']:
+            self.update_driver_os_counts(pjoin(self.dir_path, 'SubProcesses', driver))
+
+        self.update_make_opts(pjoin(self.dir_path, 'Source', 'make_opts'))
 
         # replace the common_run_interface with the one from madstr_plugin
         internal = pjoin(self.dir_path, 'bin', 'internal')
-        files.mv(pjoin(internal, 'common_run_interface.py'), \
-                 pjoin(internal, 'common_run_interface_MG.py'))
+        if not os.path.exists(pjoin(internal, 'common_run_interface_MG.py')):
+            files.mv(pjoin(internal, 'common_run_interface.py'), \
+                     pjoin(internal, 'common_run_interface_MG.py'))
         files.cp(pjoin(plugin_path, 'common_run_interface.py'), internal)
 
 
@@ -759,7 +1349,14 @@ C for the OS subtraction
             # for MG5_aMC v2 only:
             # finally patch fks_singular so that it won't complain about negative 
             # weights for the real emission
-            subprocess.call('patch -p3 < %s' % pjoin(self.template_path, 'fks_singular_patch.txt'), cwd=self.dir_path, shell=True)
+            # (-N: nothing is done if it is already patched)
+            subprocess.call('patch -p3 -N -r - < %s' % pjoin(self.template_path, 'fks_singular_patch.txt'), cwd=self.dir_path, shell=True)
+
+
+    def has_lines(self, filename, marker):
+        """True if the lines with marker (case insensitive) have already
+        been added to filename, so that finalize can be done again"""
+        return os.path.exists(filename) and marker.upper() in open(filename).read().upper()
 
 
     def update_get_mass_width(self, width_particles, filename):
@@ -789,6 +1386,9 @@ C for the OS subtraction
         if len(width_particles)==0:
             iflines_width = 'if (.True.) then\n'
 
+        if self.has_lines(filename, 'FUNCTION GET_WIDTH_OS_FROM_ID'):
+            return
+
         outfile = writers.FortranWriter(filename, 'a')
 
         text = """
@@ -797,6 +1397,7 @@ IMPLICIT NONE
 INTEGER ID
 INCLUDE 'coupl.inc'
 
+CALL MADSTR_READ_KEEP_WIDTHS()
 %sELSE
 GET_WIDTH_OS_FROM_ID=0d0
 ENDIF
@@ -810,6 +1411,184 @@ END
         return
 
 
+    def write_os_widths_table(self, width_particles, filename):
+        """write the table with the pdg code and the width and mass
+        parameters of each particle which can go on shell"""
+        lines = ['# pdg code, width and mass parameters of the particles which can go',
+                 '# on shell, written by MadSTR and read by treatcards']
+        done_pdgs = []
+        for part in width_particles:
+            if part.get_pdg_code() in done_pdgs: 
+                continue
+            done_pdgs.append(part.get_pdg_code())
+            lines.append('%d %s %s' % (part.get_pdg_code(), part.get('width'), part.get('mass')))
+
+        out = open(filename, 'w')
+        out.write('\n'.join(lines) + '\n')
+        out.close()
+
+
+    def write_keep_widths_loader(self, width_particles, filename):
+        """append to filename (in MODEL) the routine which sets the _keep
+        widths from the DECAY lines of the param_card, at the first call.
+        This way, they can be changed without recompiling the code.
+        If the param_card or a DECAY line is not found, the code stops,
+        rather than silently using other widths than those of the run.
+        The first call is in a named critical section, so that with the
+        reentrant output the threads wait until the widths are set. It is
+        not written with FortranWriter, which would indent the OpenMP 
+        directives (and make them comments)"""
+
+        widths = []
+        pdgs = []
+        for part in width_particles:
+            if part.get('width') in widths or part.get('width').lower() == 'zero':
+                continue
+            widths.append(part.get('width'))
+            pdgs.append(abs(part.get_pdg_code()))
+
+        if widths:
+            set_lines = '\n'.join(['%s_KEEP = WIDTHS(%d)' % (w, i + 1) \
+                    for i, w in enumerate(widths)])
+            pdg_list = ', '.join(['%d' % pdg for pdg in pdgs])
+        else:
+            set_lines = ''
+            pdg_list = '0'
+
+        text = """
+      SUBROUTINE MADSTR_SET_KEEP_WIDTHS()
+C sets the widths of the particles which can go on shell (_keep) from
+C the param_card, see MADSTR_READ_KEEP_WIDTHS
+IMPLICIT NONE
+INCLUDE 'coupl.inc'
+INTEGER NWIDTHS
+PARAMETER (NWIDTHS=%(nwidths)d)
+INTEGER PDGS(NWIDTHS)
+DATA PDGS / %(pdgs)s /
+DOUBLE PRECISION WIDTHS(NWIDTHS)
+LOGICAL FOUND(NWIDTHS)
+INTEGER I
+
+DO I = 1, NWIDTHS
+WIDTHS(I) = 0D0
+ENDDO
+CALL MADSTR_READ_DECAYS(NWIDTHS, PDGS, WIDTHS, FOUND)
+DO I = 1, NWIDTHS
+IF (.NOT.FOUND(I).AND.PDGS(I).NE.0) THEN
+WRITE(*,*) 'ERROR in MADSTR_READ_KEEP_WIDTHS: no DECAY line for', PDGS(I)
+STOP 1
+ENDIF
+ENDDO
+%(set)s
+RETURN
+END
+
+
+      SUBROUTINE MADSTR_READ_DECAYS(N, PDGS, WIDTHS, FOUND)
+C reads the widths of the particles PDGS from the DECAY lines of the
+C param_card. FOUND(I) is false, and WIDTHS(I) unchanged, if the width
+C of PDGS(I) is not there. Stops if the param_card is not found
+IMPLICIT NONE
+INTEGER N, PDGS(N)
+DOUBLE PRECISION WIDTHS(N)
+LOGICAL FOUND(N)
+INTEGER IUNIT
+PARAMETER (IUNIT=97)
+INTEGER NCARDS
+PARAMETER (NCARDS=4)
+CHARACTER*40 CARDS(NCARDS)
+DATA CARDS(1) / 'param_card.dat' /
+DATA CARDS(2) / '../param_card.dat' /
+DATA CARDS(3) / '../../Cards/param_card.dat' /
+DATA CARDS(4) / '../../../Cards/param_card.dat' /
+CHARACTER*200 BUFF
+CHARACTER*5 KEY
+INTEGER I, J, IOS, PDG
+DOUBLE PRECISION W
+
+DO I = 1, N
+FOUND(I) = .FALSE.
+ENDDO
+DO J = 1, NCARDS
+OPEN(UNIT=IUNIT, FILE=CARDS(J), STATUS='OLD', IOSTAT=IOS)
+IF (IOS.EQ.0) GOTO 10
+ENDDO
+WRITE(*,*) 'ERROR in MADSTR_READ_DECAYS: param_card.dat not found'
+STOP 1
+
+10 CONTINUE
+DO WHILE (.TRUE.)
+READ(IUNIT, '(A)', IOSTAT=IOS) BUFF
+IF (IOS.NE.0) EXIT
+BUFF = ADJUSTL(BUFF)
+KEY = BUFF(1:5)
+DO I = 1, 5
+IF (KEY(I:I).GE.'a'.AND.KEY(I:I).LE.'z') THEN
+KEY(I:I) = CHAR(ICHAR(KEY(I:I))-32)
+ENDIF
+ENDDO
+IF (KEY.NE.'DECAY') CYCLE
+READ(BUFF(6:), *, IOSTAT=IOS) PDG, W
+IF (IOS.NE.0) CYCLE
+DO I = 1, N
+IF (ABS(PDG).EQ.PDGS(I)) THEN
+WIDTHS(I) = W
+FOUND(I) = .TRUE.
+ENDIF
+ENDDO
+ENDDO
+CLOSE(IUNIT)
+RETURN
+END
+""" % {'nwidths': max(len(widths), 1),
+       'pdgs': pdg_list,
+       'set': set_lines}
+
+        read_text = """
+      SUBROUTINE MADSTR_READ_KEEP_WIDTHS()
+C sets the _keep widths (MADSTR_SET_KEEP_WIDTHS) at the first call
+      IMPLICIT NONE
+      LOGICAL LOADED
+      DATA LOADED /.FALSE./
+      SAVE LOADED
+
+      IF (LOADED) RETURN
+!$OMP CRITICAL (MADSTR_KEEP_WIDTHS)
+      IF (.NOT.LOADED) THEN
+        CALL MADSTR_SET_KEEP_WIDTHS()
+!$OMP FLUSH
+        LOADED = .TRUE.
+      ENDIF
+!$OMP END CRITICAL (MADSTR_KEEP_WIDTHS)
+      RETURN
+      END
+"""
+
+        if self.has_lines(filename, 'SUBROUTINE MADSTR_READ_KEEP_WIDTHS'):
+            return
+        outfile = writers.FortranWriter(filename, 'a')
+        outfile.writelines(text)
+        outfile.close()
+        outfile = open(filename, 'a')
+        outfile.write(read_text)
+        outfile.close()
+
+
+    def update_model_makefile(self, makefile):
+        """with --reentrant=N (N>1), get_mass_width_fcts.f, where the _keep
+        widths are loaded in a critical section, is compiled with OpenMP.
+        The other objects of the model keep the flags of make_opts"""
+        if self.opt.get('madstr_max_threads', 1) <= 1 or \
+           self.has_lines(makefile, '# MadSTR --reentrant'):
+            return
+        out = open(makefile, 'a')
+        out.write("""
+# MadSTR --reentrant
+get_mass_width_fcts.o: FFLAGS := $(filter-out -fno-automatic,$(FFLAGS)) -fopenmp
+""")
+        out.close()
+
+
     def update_couplinc(self, widths, couplinc):
         """update coupl.inc by adding extra lines for the widths to keep"""
 
@@ -819,7 +1598,85 @@ END
         else:
             width_list = ','.join(['%s_keep' % w for w in widths])
         lines = '\n      double precision %s\n      common /keep_widths/%s\n' %(width_list, width_list)
+        if self.has_lines(couplinc, '/keep_widths/'):
+            return
         #outfile = open(couplincpjoin(self.dir_path, 'Source', 'coupl.inc'), 'a')
         outfile = writers.FortranWriter(couplinc, 'a')
         outfile.writelines(lines)
         outfile.close()
+
+
+
+class MadSTRStandaloneExporter(MadSTRExporter):
+    """Exporter for the standalone output (output ... --standalone).
+    On top of the usual output, each P* directory can be compiled into
+    a Python module (make madstr_py) which evaluates the OS-subtracted
+    real emissions on NumPy arrays of momenta, driven by
+    bin/internal/madstr_standalone.py
+    """
+
+    standalone_files = ['madstr_py.f', 'madstr_standalone.f']
+
+    def copy_fkstemplate(self, *args, **opts):
+        """copy also the Fortran files of the Python interface"""
+
+        super(MadSTRStandaloneExporter, self).copy_fkstemplate(*args, **opts)
+
+        for f in self.standalone_files:
+            shutil.copy(pjoin(self.template_path, 'SubProcesses', f),
+                        pjoin(self.dir_path, 'SubProcesses', f))
+
+
+    def generate_directories_fks(self, matrix_elements, fortran_model, *args):
+        """link the Fortran files of the Python interface in the P* directories"""
+        calls = super(MadSTRStandaloneExporter, self).generate_directories_fks(
+                                         matrix_elements, fortran_model, *args)
+
+        Pdir = pjoin(self.dir_path, 'SubProcesses', \
+                       "P%s" % matrix_elements.get('processes')[0].shell_string())
+        for f in self.standalone_files:
+            files.ln('../%s' % f, cwd=Pdir)
+        return calls
+
+
+    def update_fks_makefile(self, makefile):
+        """add the target for the Python module to the makefile
+        """
+        super(MadSTRStandaloneExporter, self).update_fks_makefile(makefile)
+
+        f2py = self.opt.get('f2py_compiler') or 'f2py'
+        # the MadSTR objects of the reentrant output need the OpenMP runtime
+        omp_lib = ' -lgomp' if self.opt.get('madstr_max_threads', 1) > 1 else ''
+        # only the routines in madstr_py.f are wrapped: f2py cannot
+        # deal with the common blocks used elsewhere
+        to_add = """
+# Python module with the OS-subtracted reals (standalone output)
+F2PY ?= %s
+PYMOD= $(FILES) madstr_standalone.o madstr_test_utils.o BinothLHADummy.o \\
+      cuts.o pythia_unlops.o recluster.o
+
+madstr_py: $(PYMOD) madstr_py.f
+	$(F2PY) -c -m madstr_py madstr_py.f $(PYMOD) $(APPLLIBS) $(LINKLIBS) $(FJLIBS)%s
+""" % (f2py, omp_lib)
+
+        out = open(makefile, 'a')
+        out.write(to_add)
+        out.close()
+
+
+    def get_make_opts_lines(self, make_opts):
+        """make sure also that the libraries are compiled as position-independent
+        code, to be linked in the module"""
+        lines = super(MadSTRStandaloneExporter, self).get_make_opts_lines(make_opts)
+        for i, line in enumerate(lines):
+            if line.startswith('GLOBAL_FLAG') and '-fPIC' not in line.split():
+                lines[i] = line.rstrip() + ' -fPIC'
+        return lines
+
+
+    def finalize(self, matrix_elements, history, mg5options, flaglist):
+        """copy the Python driver"""
+        super(MadSTRStandaloneExporter, self).finalize(matrix_elements, history, mg5options, flaglist)
+
+        files.cp(pjoin(plugin_path, 'madstr_standalone.py'),
+                 pjoin(self.dir_path, 'bin', 'internal'))
@@ -6,7 +6,9 @@
 #####################################################
 
 import copy
+import io
 import logging
+import six.moves.cPickle as cPickle
 
 import madgraph.core.base_objects as MG
 import madgraph.core.diagram_generation as diagram_generation
@@ -23,6 +25,154 @@ class MadSTRFKSError(MadGraph5Error):
     """ Error from the resummation interface. """
 
 
+class OSConfiguration(object):
+    """an on-shell resonance of a real-emission process: the pdg codes of
+    the mother and of the daughters (ids), the positions of the daughters
+    in the real process (daughter_pos), the real-emission diagrams with the
+    resonance (diagrams), the key of the amplitude of the on-shell process
+    in OSConfiguration.amplitudes and, once the HELAS objects have been
+    generated, the matrix element of the on-shell process.
+    If the on-shell process is the one of an earlier configuration of the
+    same real up to a permutation of identical final-state particles,
+    representative is the position of that configuration, whose matrix
+    element is evaluated with the momenta permuted: such configurations
+    have no matrix element of their own
+    """
+    __slots__ = ['ids', 'daughter_pos', 'diagrams', 'amp_key', 'matrix_element',
+                 'representative']
+
+    # the amplitudes of the on-shell processes, shared by all the 
+    # configurations with the same process definition and model object 
+    # (see release_os_amplitudes)
+    amplitudes = {}
+
+    def __init__(self, ids, daughter_pos, diagrams, amp_key, matrix_element=None,
+                 representative=None):
+        self.ids = tuple(ids)
+        self.daughter_pos = tuple(daughter_pos)
+        self.diagrams = tuple(diagrams)
+        self.amp_key = amp_key
+        self.matrix_element = matrix_element
+        self.representative = representative
+
+    @property
+    def amplitude(self):
+        """the DecayChainAmplitude of the on-shell process"""
+        try:
+            return OSConfiguration.amplitudes[self.amp_key]
+        except KeyError:
+            raise MadSTRFKSError('The amplitude of the on-shell process %s has been released ' % self.amp_key[1] + \
+                    '(output --low_footprint), the process has to be generated again')
+
+    def copy(self, matrix_element=None):
+        """a copy of the configuration, with matrix_element"""
+        return OSConfiguration(self.ids, self.daughter_pos, self.diagrams, 
+                               self.amp_key, matrix_element, self.representative)
+
+    def generate_matrix_element(self):
+        """sets the HELAS matrix element of the on-shell process (nothing
+        is done if the configuration has a representative)"""
+        if self.representative is not None:
+            return None
+        self.matrix_element = helas_objects.HelasDecayChainProcess(\
+                self.amplitude).combine_decay_chain_processes()[0]
+        return self.matrix_element
+
+    def add_processes(self, other):
+        """add to the matrix element the processes of the one of other
+        which are not already there"""
+        if self.matrix_element is None:
+            return
+        this_pdgs = set([tuple([leg['id'] for leg in proc['legs']]) \
+                for proc in self.matrix_element['processes']])
+        for oth_proc in other.matrix_element['processes']:
+            oth_pdgs = tuple([leg['id'] for leg in oth_proc['legs']])
+            if oth_pdgs not in this_pdgs:
+                self.matrix_element['processes'].append(oth_proc)
+                this_pdgs.add(oth_pdgs)
+
+    def __getstate__(self):
+        """the amplitude is pickled with the configuration only as long
+        as the matrix element has not been generated"""
+        amplitude = None
+        if self.matrix_element is None:
+            amplitude = OSConfiguration.amplitudes.get(self.amp_key)
+        return (self.ids, self.daughter_pos, self.diagrams, self.amp_key, 
+                self.matrix_element, self.representative, amplitude)
+
+    def __setstate__(self, state):
+        self.ids, self.daughter_pos, self.diagrams, self.amp_key, \
+                self.matrix_element, self.representative, amplitude = state
+        if amplitude is not None:
+            OSConfiguration.amplitudes.setdefault(self.amp_key, amplitude)
+
+
+def get_os_matrix_elements(real):
+    """the matrix elements of the on-shell processes of real (the released
+    ones are skipped)"""
+    return [conf.matrix_element for conf in real.os_configurations \
+            if conf.matrix_element is not None]
+
+
+def get_os_terms(real):
+    """the OS terms of real, as a list of (n, conf, nrep): n is the number
+    of the term (from 1) and nrep the one of the term whose matrix element
+    is evaluated for it, i.e. n unless conf has a representative. The
+    terms whose matrix element has been released are skipped"""
+    terms = []
+    for n, conf in enumerate(real.os_configurations):
+        nrep = n if conf.representative is None else conf.representative
+        if real.os_configurations[nrep].matrix_element is None:
+            continue
+        terms.append((n + 1, conf, nrep + 1))
+    return terms
+
+
+def release_os_amplitudes(model=None):
+    """releases the amplitudes of the on-shell processes, once the HELAS
+    matrix elements have been generated (or before a new generation). If
+    model is given, only those of other models (e.g. of a model which has
+    been imported again since) are released. Returns the number of 
+    amplitudes released"""
+    keys = [key for key in OSConfiguration.amplitudes \
+            if model is None or key[0] != id(model)]
+    namps = len([key for key in keys if OSConfiguration.amplitudes[key] is not None])
+    for key in keys:
+        del OSConfiguration.amplitudes[key]
+    return namps
+
+
+def dumps_without_model(obj):
+    """pickles obj, storing the models of the MG objects inside it (e.g.
+    the processes of the amplitudes and matrix elements) only by name.
+    Use loads_with_model to unpickle it"""
+    outfile = io.BytesIO()
+    pickler = cPickle.Pickler(outfile, 2)
+    def persistent_id(o):
+        if isinstance(o, MG.Model):
+            return 'model:%s' % o.get('name')
+        return None
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return outfile.getvalue()
+
+
+def loads_with_model(data, models):
+    """unpickles data written by dumps_without_model, binding the models
+    to the ones in models (a model or a list of models)"""
+    if isinstance(models, MG.Model):
+        models = [models]
+    models = dict(('model:%s' % m.get('name'), m) for m in models)
+    unpickler = cPickle.Unpickler(io.BytesIO(data))
+    def persistent_load(pid):
+        try:
+            return models[pid]
+        except KeyError:
+            raise MadSTRFKSError('Model %s is needed to unpickle the MadSTR data' % pid[6:])
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
 class FKSHelasMultiProcessWithOS(fks_helas.FKSHelasMultiProcess):
     """a class for FKS Helas processes with OS singularities
     """
@@ -36,17 +186,18 @@ class FKSHelasMultiProcessWithOS(fks_helas.FKSHelasMultiProcess):
         # requires no changes in the core fks stuff
         for born_me in self['matrix_elements']:
             for real_me in born_me.real_processes:
-                real_me.os_ids = []
-                real_me.os_daughter_pos = []
-                real_me.os_diagrams = []
-                real_me.os_matrix_elements = []
+                real_me.os_configurations = []
+        # the lorentz structures and couplings of the released OS 
+        # matrix elements, see release_os_matrix_elements
+        self.os_used_lorentz = []
+        self.os_used_couplings = []
 
         for born in fksmulti['born_processes']:
             # we need to use pdgs here because otherwise mirror processes are identified
             born_pdgs = [l['id'] for l in born.born_amp['process']['legs']]
             for real in born.real_amps:
                 real_pdgs = [l['id'] for l in real.process['legs']]
-                if not real.os_amplitudes:
+                if not real.os_configurations:
                     continue
                 #now we have to find the matching born and real 
                 # in the helas process
@@ -61,12 +212,9 @@ class FKSHelasMultiProcessWithOS(fks_helas.FKSHelasMultiProcess):
                         real_me_pdg_list = [[l['id'] for l in p['legs']] for p in real_me.matrix_element['processes']]
                         if not real_pdgs in real_me_pdg_list:
                             continue
-                        real_me.os_ids += real.os_ids
-                        real_me.os_daughter_pos += real.os_daughter_pos
-                        real_me.os_diagrams += real.os_diagrams
-                        real_me.os_matrix_elements += [\
-                            helas_objects.HelasDecayChainProcess(os_amp).combine_decay_chain_processes()[0]
-                            for os_amp in real.os_amplitudes]
+                        for conf in real.os_configurations:
+                            real_me.os_configurations.append(conf.copy())
+                            real_me.os_configurations[-1].generate_matrix_element()
 
 
     def get_used_lorentz(self):
@@ -76,8 +224,9 @@ class FKSHelasMultiProcessWithOS(fks_helas.FKSHelasMultiProcess):
         lorentz_list = super(FKSHelasMultiProcessWithOS, self).get_used_lorentz()
         for me in self.get('matrix_elements'): 
             for real in me.real_processes:
-                for os_real in real.os_matrix_elements:
+                for os_real in get_os_matrix_elements(real):
                     lorentz_list.extend(os_real.get_used_lorentz())
+        lorentz_list.extend(self.os_used_lorentz)
         return list(set(lorentz_list))
 
 
@@ -88,29 +237,203 @@ class FKSHelasMultiProcessWithOS(fks_helas.FKSHelasMultiProcess):
         coupl_list = super(FKSHelasMultiProcessWithOS, self).get_used_couplings()
         for me in self.get('matrix_elements'): 
             for real in me.real_processes:
-                for os_real in real.os_matrix_elements:
+                for os_real in get_os_matrix_elements(real):
                     coupl_list.extend(sum(os_real.get_used_couplings(),[]))
+        coupl_list.extend(self.os_used_couplings)
         return coupl_list    
 
 
+    def release_os_matrix_elements(self, me):
+        """releases the OS matrix elements of the reals of me, once its
+        directory has been written. Only their lorentz structures and
+        couplings are kept, for the HELAS routines and the model"""
+        for real_me in me.real_processes:
+            for conf in real_me.os_configurations:
+                if conf.matrix_element is None:
+                    continue
+                self.os_used_lorentz.extend(conf.matrix_element.get_used_lorentz())
+                self.os_used_couplings.extend(sum(conf.matrix_element.get_used_couplings(), []))
+                conf.matrix_element = None
+
+
     def add_process(self, other):
         """ add two processes
         Use the mother class, plus check the os matrix elements
         """
         super(FKSHelasMultiProcessWithOS, self).add_process(other)
-        # now the OS diagrams
+        # now the OS matrix elements. The reals may not be in the same
+        # order, they are matched by their matrix element (as done by the
+        # mother class), then the OS configurations by their ids and 
+        # daughter positions or, failing that, by their matrix element
+        this_mes = [real.matrix_element for real in self.real_processes]
         for oth_real in other.real_processes:
-            for oth_on_shell in oth_real.os_matrix_elements:
-                this_on_shell = this_real.os_matrix_elements[
-                        this_real.os_matrix_elements.index(oth_on_shell)]
-                this_pdgs = [[leg['id'] for leg in proc['legs']] \
-                    for proc in this_on_shell['processes']]
-                for oth_proc in oth_on_shell['processes']:
-                    oth_pdgs = [leg['id'] for leg in oth_proc['legs']]
-                    if oth_pdgs not in this_pdgs:
-                        this_on_shell['processes'].append(oth_proc)
-                        this_pdgs.append(oth_pdgs)
+            this_real = self.real_processes[this_mes.index(oth_real.matrix_element)]
+            this_confs = dict(((conf.ids, conf.daughter_pos), conf) \
+                    for conf in this_real.os_configurations)
+            for oth_conf in oth_real.os_configurations:
+                this_conf = this_confs.get((oth_conf.ids, oth_conf.daughter_pos))
+                if this_conf is None and oth_conf.matrix_element is not None:
+                    this_os_mes = [conf.matrix_element for conf in this_real.os_configurations]
+                    this_conf = this_real.os_configurations[this_os_mes.index(oth_conf.matrix_element)]
+                if this_conf is not None:
+                    this_conf.add_processes(oth_conf)
+
+
+
+def get_directory_cost(me):
+    """returns a dictionary with the numbers of diagrams, of real processes
+    and of OS terms of the FKSHelasProcess me (whose OS matrix elements
+    must have been set), and the cost of writing its P* directory. 
+    The cost is the number of diagrams to be written, where the
+    real-emission diagrams count twice if there are OS terms (they are 
+    written with and without the width of the resonances)
+    """
+    if hasattr(me, 'born_matrix_element'): # v2
+        born = me.born_matrix_element
+    else: # v3
+        born = me.born_me
+    cost = {'ndiagrams': len(born.get('diagrams')), 'nreals': 0, 'nos': 0}
+    weighted = cost['ndiagrams']
+    for real_me in me.real_processes:
+        nreal = len(real_me.matrix_element.get('diagrams'))
+        nos = sum([len(os_me.get('diagrams')) for os_me in get_os_matrix_elements(real_me)])
+        cost['nreals'] += 1
+        cost['nos'] += len(real_me.os_configurations)
+        cost['ndiagrams'] += nreal + nos
+        weighted += nos + nreal * (2 if real_me.os_configurations else 1)
+    if me.virt_matrix_element:
+        nvirt = len(me.virt_matrix_element.get('diagrams'))
+        cost['ndiagrams'] += nvirt
+        weighted += nvirt
+    cost['cost'] = weighted
+    return cost
+
+
+def estimate_directory_cost(me):
+    """the cost of the P* directory of the FKSHelasProcess me, as returned
+    by get_directory_cost, estimated before the directory is written and
+    without generating the amplitudes of the OS processes: the OS terms
+    are the splittings (see get_os_splittings) with resonant diagrams in
+    the real emission, and the diagrams of their matrix elements are
+    estimated by the resonant diagrams (counted once for the permutations
+    of the same splitting, which share the matrix element). Used to 
+    schedule the multicore output"""
+    if hasattr(me, 'born_matrix_element'): # v2
+        born = me.born_matrix_element
+    else: # v3
+        born = me.born_me
+    cost = {'ndiagrams': len(born.get('diagrams')), 'nreals': 0, 'nos': 0}
+    weighted = cost['ndiagrams']
+    for real_me in me.real_processes:
+        amplitude = real_me.matrix_element['base_amplitude']
+        nreal = len(real_me.matrix_element.get('diagrams'))
+        nos_terms = 0
+        nos = 0
+        done_splittings = []
+        for leg_2, leg_3, leg_1_part, inte in get_os_splittings(real_me.matrix_element['processes'][0]):
+            leg_1 = MG.Leg({'state' : True,
+                            'id' : leg_1_part.get_anti_pdg_code(),
+                            'number': leg_2['number']})
+            nresonant = len(find_os_diagrams(amplitude, [leg_1, leg_2, leg_3], True))
+            if not nresonant:
+                continue
+            nos_terms += 1
+            splitting = (leg_1['id'], tuple(sorted([leg_2['id'], leg_3['id']])))
+            if splitting not in done_splittings:
+                done_splittings.append(splitting)
+                nos += nresonant
+        cost['nreals'] += 1
+        cost['nos'] += nos_terms
+        cost['ndiagrams'] += nreal + nos
+        weighted += nos + nreal * (2 if nos_terms else 1)
+    if me.virt_matrix_element:
+        nvirt = len(me.virt_matrix_element.get('diagrams'))
+        cost['ndiagrams'] += nvirt
+        weighted += nvirt
+    cost['cost'] = weighted
+    return cost
+
+
+def get_os_survey(born):
+    """the OS subtraction terms of the reals of a FKS born process (at the
+    amplitude level, they are looked for if needed) with the estimates of
+    the number of Fortran files written by MadSTR (matrix_i.f for each
+    real, wrapper_matrix_i_os_j.f for each OS term and matrix_i_os_j.f for
+    each OS term without representative) and of the cost of the P directory, with the same weights as
+    get_directory_cost. Used by the os_survey command"""
+    survey = {'born': born.born_amp['process'].nice_string(),
+              'ndiagrams_born': len(born.born_amp['diagrams']),
+              'reals': []}
+    weighted = survey['ndiagrams_born']
+    nfiles = 0
+    for real in born.real_amps:
+        if not hasattr(real, 'os_configurations'):
+            find_os_divergences(real)
+        nreal = len(real.amplitude['diagrams'])
+        os_terms = [{'ids': list(conf.ids),
+                     'daughter_pos': list(conf.daughter_pos),
+                     'nresonant': len(conf.diagrams),
+                     'ndiagrams_os': conf.amplitude.get_number_of_diagrams() \
+                             if conf.representative is None else 0} \
+                for conf in real.os_configurations]
+        survey['reals'].append({'process': real.process.nice_string(),
+                                'ndiagrams': nreal, 'os': os_terms})
+        weighted += sum([os_term['ndiagrams_os'] for os_term in os_terms]) + \
+                nreal * (2 if os_terms else 1)
+        nfiles += 1 + len(os_terms) + len([conf for conf in real.os_configurations \
+                                            if conf.representative is None])
+    survey['nos'] = sum([len(real['os']) for real in survey['reals']])
+    survey['nresonant'] = sum([os_term['nresonant'] for real in survey['reals'] for os_term in real['os']])
+    survey['ndiagrams_os'] = sum([os_term['ndiagrams_os'] for real in survey['reals'] for os_term in real['os']])
+    survey['nfiles'] = nfiles
+    survey['cost'] = weighted
+    return survey
+
+
+def get_os_splittings(process):
+    """the splittings 1 -> 2 3 of the final-state legs of process which 
+    may go on shell: yields leg 2, leg 3 (copies of those of process), the
+    particle 1 and the interaction. One of legs 2 and 3 must be massless,
+    particle 1 must be massive, with a mass different from theirs, and not
+    among the forbidden particles of process"""
+    model = process['model']
+    forbidden = process['forbidden_particles']
+    # focus only on final state legs
+    final_legs = [copy.copy(l) for l in process['legs'] if l['state']]
+    for leg_2 in final_legs:
+        for leg_3 in [l for l in final_legs if l['number'] > leg_2['number']]:
+            # one of the two legs must be massless
+            if not leg_2['massless'] and not leg_3['massless']:
+                continue
+            leg_2_part = model.get('particle_dict')[leg_2['id']]
+            leg_3_part = model.get('particle_dict')[leg_3['id']]
+            interactions = [inte for inte in model.get('interaction_dict').values() \
+                            if len(inte['particles']) == 3 and \
+                                leg_2_part in inte['particles'] and \
+                                leg_3_part in inte['particles']]
 
+            for inte in interactions:
+                particles = [copy.copy(p) for p in inte['particles']]
+                try:
+                    particles.remove(leg_2_part)
+                    particles.remove(leg_3_part)
+                except ValueError:
+                    # this is when leg_2 and leg_3 are the same particle
+                    # and it appears only once in the interacion, so
+                    # the interaction has to be skipped
+                    continue
+                leg_1_part = particles[0]
+                # check that it is massive and its mass it is different from
+                # leg_2 and leg_3
+                if leg_1_part['mass'].lower() == 'zero' or \
+                   leg_1_part['mass'] == leg_2_part['mass'] or \
+                   leg_1_part['mass'] == leg_3_part['mass']:
+                    continue
+                # check that it is not among the forbidden particles
+                if leg_1_part.get_pdg_code() in forbidden or \
+                   leg_1_part.get_anti_pdg_code() in forbidden:
+                    continue
+                yield leg_2, leg_3, leg_1_part, inte
 
 
 def find_os_divergences(fksreal):
@@ -135,7 +458,6 @@ def find_os_divergences(fksreal):
         raise MadSTRFKSError("Unknown type of fksreal in find_os_divergences: " + type(fksreal))
 
     model = process['model']
-    forbidden = process['forbidden_particles']
     # take account of the orders for the on shell processes
     try:
         weighted_order = process['orders']['WEIGHTED']
@@ -146,156 +468,146 @@ def find_os_divergences(fksreal):
         sq_weighted_order = sum([process.get('model').get('order_hierarchy')[o] * v for \
                             (o, v) in process['squared_orders'].items()])
 
-    fksreal.os_amplitudes = []
-    fksreal.os_ids = []
-    fksreal.os_daughter_pos = []
-    fksreal.os_diagrams = []
+    fksreal.os_configurations = []
+    # the configurations with the same mother, daughters and orders have the
+    # same on-shell process up to a permutation of the final-state legs:
+    # only the first one (the representative) is generated
+    representatives = {}
 
     # this is a counter to be returned
     n_os = 0
 
-    # focus only on final state legs
-    final_legs = [copy.copy(l) for l in process['legs'] if l['state']]
-    for leg_2 in final_legs:
-        for leg_3 in [l for l in final_legs if l['number'] > leg_2['number']]:
-            # one of the two legs must be massless
-            if not leg_2['massless'] and not leg_3['massless']:
-                continue
-            # prepare the leglist for the 'on shell' process, which should
-            # not contain leg_2 and leg_3, but should contain their mother particle
-            # if it exists
-            other_legs = [copy.copy(l) for l in process['legs'] if \
-                    l != leg_2 and l != leg_3]
-            assert(len(other_legs) == (len(process['legs']) - 2))
-            leg_2_part = model.get('particle_dict')[leg_2['id']]
-            leg_3_part = model.get('particle_dict')[leg_3['id']]
-            interactions = [inte for inte in model.get('interaction_dict').values() \
-                            if len(inte['particles']) == 3 and \
-                                leg_2_part in inte['particles'] and \
-                                leg_3_part in inte['particles']]
-
-            for inte in interactions:
-                particles = [copy.copy(p) for p in inte['particles']]
-                try:
-                    particles.remove(leg_2_part)
-                    particles.remove(leg_3_part)
-                except ValueError:
-                    # this is when leg_2 and leg_3 are the same particle
-                    # and it appears only once in the interacion, so
-                    # the interaction has to be skipped
-                    continue
-                leg_1_part = particles[0]
-                # check that it is massive and its mass it is different from
-                # leg_2 and leg_3
-                if leg_1_part['mass'].lower() == 'zero' or \
-                   leg_1_part['mass'] == leg_2_part['mass'] or \
-                   leg_1_part['mass'] == leg_3_part['mass']:
-                    continue
-                # check that it is not among the forbidden particles
-                if leg_1_part.get_pdg_code() in forbidden or \
-                   leg_1_part.get_anti_pdg_code() in forbidden:
-                    continue
-                # this should be the final particle (take the antiparticle as
-                # it has to go "into" the interaction)
-
-                leg_1 = MG.Leg({'state' : True,
-                                'id' : leg_1_part.get_anti_pdg_code(),
-                                'number': leg_2['number']})
-
-                os_legs = [copy.copy(l) for l in other_legs]
-                os_legs.insert(leg_2['number'] - 1, leg_1)
-                assert(len(os_legs) == (len(process['legs']) - 1))
-                # count the occurences of leg 1 in the final state legs
-                # only one of them has to be decayed
-                nleg_1 = [l['id'] for l in os_legs].count(leg_1['id'])
-                # construct the decay chain and the process
-                # definition
-                leg_1_decay = MG.Leg({'id': leg_1['id'], 'state': False})
-                leg_2_decay = MG.Leg({'id': leg_2['id'], 'state': True})
-                leg_3_decay = MG.Leg({'id': leg_3['id'], 'state': True})
-                decay_chain_legs = MG.LegList(\
-                                   [leg_1_decay, leg_2_decay, leg_3_decay])
-                decay_chain = MG.Process(\
-                              {'model': model,
-                               'legs': MG.LegList(decay_chain_legs),
-                               'is_decay_chain': True})
-
-                # construct the 'trivial' decay chain to be used when leg_1
-                # occurs more than once in the final state legs
-                leg_1_decayed = MG.Leg({'id': leg_1['id'], 'state': True})
-                trivial_decay_chain_legs = MG.LegList(\
-                                   [leg_1_decay, leg_1_decayed])
-                trivial_decay_chain = MG.Process(\
-                              {'model': model,
-                               'legs': MG.LegList(trivial_decay_chain_legs),
-                               'is_decay_chain': True})
+    for leg_2, leg_3, leg_1_part, inte in get_os_splittings(process):
+        # prepare the leglist for the 'on shell' process, which should
+        # not contain leg_2 and leg_3, but should contain their mother particle
+        other_legs = [copy.copy(l) for l in process['legs'] if \
+                l != leg_2 and l != leg_3]
+        assert(len(other_legs) == (len(process['legs']) - 2))
+        # this should be the final particle (take the antiparticle as
+        # it has to go "into" the interaction)
+
+        leg_1 = MG.Leg({'state' : True,
+                        'id' : leg_1_part.get_anti_pdg_code(),
+                        'number': leg_2['number']})
+
+        os_legs = [copy.copy(l) for l in other_legs]
+        os_legs.insert(leg_2['number'] - 1, leg_1)
+        assert(len(os_legs) == (len(process['legs']) - 1))
+        # count the occurences of leg 1 in the final state legs
+        # only one of them has to be decayed
+        nleg_1 = [l['id'] for l in os_legs].count(leg_1['id'])
+        # construct the decay chain and the process
+        # definition
+        leg_1_decay = MG.Leg({'id': leg_1['id'], 'state': False})
+        leg_2_decay = MG.Leg({'id': leg_2['id'], 'state': True})
+        leg_3_decay = MG.Leg({'id': leg_3['id'], 'state': True})
+        decay_chain_legs = MG.LegList(\
+                           [leg_1_decay, leg_2_decay, leg_3_decay])
+        decay_chain = MG.Process(\
+                      {'model': model,
+                       'legs': MG.LegList(decay_chain_legs),
+                       'is_decay_chain': True})
+
+        # construct the 'trivial' decay chain to be used when leg_1
+        # occurs more than once in the final state legs
+        leg_1_decayed = MG.Leg({'id': leg_1['id'], 'state': True})
+        trivial_decay_chain_legs = MG.LegList(\
+                           [leg_1_decay, leg_1_decayed])
+        trivial_decay_chain = MG.Process(\
+                      {'model': model,
+                       'legs': MG.LegList(trivial_decay_chain_legs),
+                       'is_decay_chain': True})
                 
-                decay_chains = MG.ProcessList([decay_chain] + \
-                                    [trivial_decay_chain] * (nleg_1 - 1))
-
-                for leg in os_legs:
-                    leg['number'] = os_legs.index(leg) + 1
-
-                if weighted_order > 0 and sq_weighted_order == 0:
-                    # v2 type processes
-                    # the orders in os_procdef refer only to the production process
-                    # so the orders of the splitting have to be subtracted
-                    prod_weighted_order = weighted_order - \
-                            sum([v * model.get('order_hierarchy')[o] \
-                                 for o, v in inte['orders'].items()])
-                    # skip if prod_weighted_order is negative or zero
-                    # negative prod_weighted_order can lead to strange behaviours
-                    if prod_weighted_order < 0:
-                        continue
+        decay_chains = MG.ProcessList([decay_chain] + \
+                            [trivial_decay_chain] * (nleg_1 - 1))
+
+        for leg in os_legs:
+            leg['number'] = os_legs.index(leg) + 1
+
+        if weighted_order > 0 and sq_weighted_order == 0:
+            # v2 type processes
+            # the orders in os_procdef refer only to the production process
+            # so the orders of the splitting have to be subtracted
+            prod_weighted_order = weighted_order - \
+                    sum([v * model.get('order_hierarchy')[o] \
+                         for o, v in inte['orders'].items()])
+            # skip if prod_weighted_order is negative or zero
+            # negative prod_weighted_order can lead to strange behaviours
+            if prod_weighted_order < 0:
+                continue
 
-                    os_procdef =  MG.Process(\
-                                 {'model': model,
-                                  'legs': MG.LegList(os_legs),
-                                  'decay_chains': decay_chains,
-                                  'orders': {'WEIGHTED': prod_weighted_order}})
-                elif weighted_order == 0 and sq_weighted_order > 0:
-                    # v3 type processes
-                    # the orders in os_procdef refer only to the production process
-                    # so the orders of the splitting have to be subtracted
-                    prod_weighted_order = sq_weighted_order - \
-                            sum([2*v * model.get('order_hierarchy')[o] \
-                                 for o, v in inte['orders'].items()])
-                    # skip if prod_weighted_order is negative or zero
-                    # negative prod_weighted_order can lead to strange behaviours
-                    if prod_weighted_order < 0:
-                        continue
+            os_procdef =  MG.Process(\
+                         {'model': model,
+                          'legs': MG.LegList(os_legs),
+                          'decay_chains': decay_chains,
+                          'orders': {'WEIGHTED': prod_weighted_order}})
+        elif weighted_order == 0 and sq_weighted_order > 0:
+            # v3 type processes
+            # the orders in os_procdef refer only to the production process
+            # so the orders of the splitting have to be subtracted
+            prod_weighted_order = sq_weighted_order - \
+                    sum([2*v * model.get('order_hierarchy')[o] \
+                         for o, v in inte['orders'].items()])
+            # skip if prod_weighted_order is negative or zero
+            # negative prod_weighted_order can lead to strange behaviours
+            if prod_weighted_order < 0:
+                continue
 
-                    os_procdef =  MG.Process(\
-                                 {'model': model,
-                                  'legs': MG.LegList(os_legs),
-                                  'decay_chains': decay_chains,
-                                  'split_orders' : [o for o in model.get('coupling_orders')],
-                                  'squared_orders': {'WEIGHTED': prod_weighted_order},
-                                  'sqorders_types': {'WEIGHTED': '<='}})
-                # now generate the amplitude. 
-                # Do nothing if any InvalidCmd is raised (e.g. charge not conserved)
-                # or if no diagrams are there
-                # set the logger to CRITICAL in order not to warn about 1 -> 1
-                # (trivial) decay chains
+            os_procdef =  MG.Process(\
+                         {'model': model,
+                          'legs': MG.LegList(os_legs),
+                          'decay_chains': decay_chains,
+                          'split_orders' : [o for o in model.get('coupling_orders')],
+                          'squared_orders': {'WEIGHTED': prod_weighted_order},
+                          'sqorders_types': {'WEIGHTED': '<='}})
+        perm_key = (leg_1['id'], tuple(sorted([leg_2['id'], leg_3['id']])), 
+                    prod_weighted_order)
+        if perm_key in representatives:
+            nrep = representatives[perm_key]
+            n_os+= 1
+            fksreal.os_configurations.append(OSConfiguration(
+                    [leg_1['id'], leg_2['id'], leg_3['id']],
+                    [leg_2['number']-1, leg_3['number']-1],
+                    find_os_diagrams(amplitude, [leg_1, leg_2, leg_3], from_helas),
+                    fksreal.os_configurations[nrep].amp_key, 
+                    representative=nrep))
+            continue
+
+        # now generate the amplitude. 
+        # Do nothing if any InvalidCmd is raised (e.g. charge not conserved)
+        # or if no diagrams are there
+        # set the logger to CRITICAL in order not to warn about 1 -> 1
+        # (trivial) decay chains
                 
-                loglevel = logging.getLogger('madgraph.diagram_generation').level
-                logging.getLogger('madgraph.diagram_generation').setLevel(logging.CRITICAL)
-                try:
-                    os_amp = diagram_generation.DecayChainAmplitude(os_procdef)
-                except InvalidCmd:
-                    continue
-                logging.getLogger('madgraph.diagram_generation').setLevel(loglevel)
-                
-                if not all([amp['diagrams'] for amp in os_amp['amplitudes']]):
-                    continue
+        # the amplitude is generated only once for each process
+        # definition and model object, and shared among the reals
+        amp_key = (id(model), os_procdef.nice_string())
+        if amp_key not in OSConfiguration.amplitudes:
+            loglevel = logging.getLogger('madgraph.diagram_generation').level
+            logging.getLogger('madgraph.diagram_generation').setLevel(logging.CRITICAL)
+            try:
+                os_amp = diagram_generation.DecayChainAmplitude(os_procdef)
+            except InvalidCmd:
+                os_amp = None
+            logging.getLogger('madgraph.diagram_generation').setLevel(loglevel)
+
+            if os_amp is not None and \
+               not all([amp['diagrams'] for amp in os_amp['amplitudes']]):
+                os_amp = None
+            if os_amp is not None:
                 logger.info('Process %s has been generated for on-shell subtraction'
                         % os_procdef.input_string())
-                n_os+= 1
-                fksreal.os_amplitudes.append(os_amp)
-                fksreal.os_ids.append([leg_1['id'], leg_2['id'], leg_3['id']])
-                fksreal.os_daughter_pos.append([leg_2['number']-1, leg_3['number']-1])
-                fksreal.os_diagrams.append(find_os_diagrams(\
-                        amplitude, [leg_1, leg_2, leg_3], from_helas))
+            OSConfiguration.amplitudes[amp_key] = os_amp
+
+        if OSConfiguration.amplitudes[amp_key] is None:
+            continue
+        representatives[perm_key] = len(fksreal.os_configurations)
+        n_os+= 1
+        fksreal.os_configurations.append(OSConfiguration(
+                [leg_1['id'], leg_2['id'], leg_3['id']],
+                [leg_2['number']-1, leg_3['number']-1],
+                find_os_diagrams(amplitude, [leg_1, leg_2, leg_3], from_helas),
+                amp_key))
     return n_os
 
 
@@ -12,10 +12,15 @@ import itertools
 import sys
 import random
 import re
+import json
 import time
 import shutil
 import signal
+import gc
 import multiprocessing
+import multiprocessing.pool
+import threading
+import glob
 import six.moves.cPickle
 
 from madgraph import MadGraph5Error, InvalidCmd, MG5DIR
@@ -45,18 +50,131 @@ logger = logging.getLogger('MadSTR_plugin.Interface')
 pjoin = os.path.join
 
 
-def generate_directories_fks_async(i):
-    """generates directories in a multi-core way"""
-        
-    arglist = glob_directories_map[i]
-    
-    curr_exporter = arglist[0]
-    mefile = arglist[1]
-    curr_fortran_model = arglist[2]
-    ime = arglist[3]
-    nme = arglist[4]
-    path = arglist[5]
-    olpopts = arglist[6]
+# the exporter, the HELAS model and the options shared by all the tasks
+# of a worker of the pool which writes the directories
+glob_worker_state = {}
+
+def init_directories_worker(curr_exporter, curr_fortran_model, nme, path, olpopts):
+    """initializer of the workers of the pool which writes the directories:
+    the objects common to all tasks are set once per worker"""
+    # ctrl+c is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    glob_worker_state['exporter'] = curr_exporter
+    glob_worker_state['fortran_model'] = curr_fortran_model
+    glob_worker_state['nme'] = nme
+    glob_worker_state['path'] = path
+    glob_worker_state['olpopts'] = olpopts
+
+
+def generate_directories_fks_async(chunk):
+    """generates directories in a multi-core way. chunk is a list of
+    (index of the matrix element, file where it has been pickled).
+    The outputs are sent back pickled with the model stored by name (it is
+    referenced by the processes they contain), see load_directories_outputs.
+    At debug level, the size and load time of the full pickle are also 
+    measured, for comparison"""
+    outputs = []
+    for ime, mefile in chunk:
+        diroutput = generate_directory_fks(ime, mefile)
+        full_size, full_time = 0, 0.
+        if logger.isEnabledFor(logging.DEBUG):
+            data = six.moves.cPickle.dumps(diroutput, 2)
+            start = time.time()
+            six.moves.cPickle.loads(data)
+            full_size, full_time = len(data), time.time() - start
+        outputs.append((madstr_fks.dumps_without_model(diroutput), full_size, full_time))
+    return outputs
+
+
+def load_directories_outputs(outputs, model, checkpoint=None, compile_queue=None):
+    """unpickles the outputs of generate_directories_fks_async, binding 
+    them to model. The size and load time of the pickles, and the ones 
+    of the full pickles if measured, are appended to each output.
+    The directories are recorded in checkpoint, and their compilation is
+    started by compile_queue, if given"""
+    diroutputs = []
+    for data, full_size, full_time in outputs:
+        start = time.time()
+        diroutput = madstr_fks.loads_with_model(data, model)
+        if checkpoint:
+            checkpoint.add(diroutput[8], diroutput[5][0].nice_string(), 
+                           diroutput[1], diroutput[12], data)
+        if compile_queue:
+            compile_queue.add(diroutput[1])
+        diroutputs.append(diroutput + [len(data), time.time() - start, full_size, full_time])
+    return diroutputs
+
+
+def estimate_directory_cost_async(job):
+    """estimates the cost of the directory of job (index of the matrix
+    element, file where it has been pickled) with the cost model, before
+    it is written (the OS processes are not generated, see 
+    madstr_fks.estimate_directory_cost). Returns the index and the cost"""
+    ime, mefile = job
+    infile = open(mefile, 'rb')
+    me = six.moves.cPickle.load(infile)
+    infile.close()
+    cost = madstr_fks.estimate_directory_cost(me)
+    del me
+    return ime, cost
+
+
+def reset_peak_rss():
+    """reset the peak resident memory of the process (Linux only), so that
+    the peak of each task of a persistent worker can be measured"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def get_peak_rss():
+    """returns the peak resident memory of the process in MB, since the
+    last reset_peak_rss if it is supported"""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return float(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on mac
+    return maxrss / 1024.**2 if sys.platform == 'darwin' else maxrss / 1024.
+
+
+def get_rss():
+    """returns the current resident memory of the process in MB (on Linux,
+    elsewhere the peak one)"""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return float(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return get_peak_rss()
+
+
+def log_memory_checkpoint(phase, verbose=False):
+    """logs the resident memory at the end of phase of the output (at info
+    level if verbose, e.g. with --low_footprint)"""
+    log = logger.info if verbose else logger.debug
+    log('MadSTR memory checkpoint, %s: %.0f MB (peak %.0f MB)' % (phase, get_rss(), get_peak_rss()))
+
+
+def generate_directory_fks(ime, mefile):
+    """generates the directory of the ime-th matrix element, pickled in
+    mefile. Besides the information needed by export, returns the time
+    it took, the cost model of the directory, the peak memory (MB) and
+    the summary of the OS configurations for the checkpoint"""
+    start = time.time()
+    reset_peak_rss()
+    curr_exporter = glob_worker_state['exporter']
+    curr_fortran_model = glob_worker_state['fortran_model']
+    nme = glob_worker_state['nme']
+    path = glob_worker_state['path']
+    olpopts = glob_worker_state['olpopts']
     
     infile = open(mefile,'rb')
     me = six.moves.cPickle.load(infile)
@@ -67,12 +185,11 @@ def generate_directories_fks_async(i):
     os_lorentz = [] 
     for real_me in me.real_processes:
         madstr_fks.find_os_divergences(real_me)
-        real_me.os_matrix_elements = [\
-            helas_objects.HelasDecayChainProcess(os_amp).combine_decay_chain_processes()[0]
-            for os_amp in real_me.os_amplitudes]
+        os_matrix_elements = [conf.generate_matrix_element() for conf in real_me.os_configurations \
+                              if conf.representative is None]
 
-        os_couplings.extend(sum([c for osme in real_me.os_matrix_elements for c in osme.get_used_couplings()], []))
-        os_lorentz.extend(sum([osme.get_used_lorentz() for osme in real_me.os_matrix_elements], []))
+        os_couplings.extend(sum([c for osme in os_matrix_elements for c in osme.get_used_couplings()], []))
+        os_lorentz.extend(sum([osme.get_used_lorentz() for osme in os_matrix_elements], []))
 
     calls = curr_exporter.generate_directories_fks(me, curr_fortran_model, ime, nme, path, olpopts)
     nexternal = curr_exporter.proc_characteristic['nexternal']
@@ -84,8 +201,441 @@ def generate_directories_fks_async(i):
     if me.virt_matrix_element:
         max_loop_vertex_rank = me.virt_matrix_element.get_max_loop_vertex_rank()  
     
-    return [calls, curr_exporter.fksdirs, max_loop_vertex_rank, ninitial, nexternal, processes, os_couplings, os_lorentz]
-
+    diroutput = [calls, list(curr_exporter.fksdirs), max_loop_vertex_rank, ninitial, nexternal, 
+                 processes, os_couplings, os_lorentz, ime, time.time() - start, 
+                 madstr_fks.get_directory_cost(me), get_peak_rss(), get_os_configurations_summary(me)]
+    # the amplitudes of the on-shell processes are not shared with the
+    # next matrix elements done by the worker
+    madstr_fks.release_os_amplitudes()
+    return diroutput
+
+
+class MemoryBudget(object):
+    """admission control of the tasks of the multicore output: a task
+    (chunk of matrix elements) is started only if the estimated peak 
+    memory of the running tasks, including it, fits in the budget (in MB).
+    The peak memory of a matrix element is estimated as base + factor * 
+    size of its pickle, the factor is updated with the measured peaks"""
+
+    def __init__(self, budget, sizes, factor=10.):
+        self.budget = budget
+        self.sizes = sizes
+        self.factor = factor
+        self.base = None
+        self.running = {}
+
+    def estimate(self, chunk):
+        """the estimated peak memory (MB) of a chunk, whose matrix elements
+        are done one after the other"""
+        base = self.base if self.base is not None else 0.
+        return max([base + self.factor * self.sizes[ime] / 1024.**2 for ime, mefile in chunk])
+
+    def admit(self, chunk):
+        """returns True (and books the memory) if chunk can be started"""
+        estimate = self.estimate(chunk)
+        if self.running and sum(self.running.values()) + estimate > self.budget:
+            return False
+        self.running[id(chunk)] = estimate
+        return True
+
+    def release(self, chunk, diroutputs):
+        """frees the memory booked for chunk, and updates the estimator
+        with the measured peaks"""
+        del self.running[id(chunk)]
+        for diroutput in diroutputs:
+            size = self.sizes[diroutput[8]] / 1024.**2
+            if self.base is None:
+                # the memory of the worker before unpickling 
+                self.base = max(diroutput[11] - self.factor * size, 0.)
+            if size > 0:
+                self.factor = max(self.factor, (diroutput[11] - self.base) / size)
+
+
+def run_with_memory_budget(pool, chunks, budget, sizes, nprocs, model, checkpoint=None,
+                           compile_queue=None):
+    """runs the chunks on the pool, starting a new one only if it fits in 
+    the memory budget. Returns the outputs and the memory estimates"""
+    mem = MemoryBudget(budget, sizes)
+    pending = list(chunks)
+    running = []
+    diroutputmap = []
+    estimates = {}
+    while pending or running:
+        # start the largest chunks which fit in the budget
+        for chunk in list(pending):
+            if len(running) >= nprocs:
+                break
+            if mem.admit(chunk):
+                for ime, mefile in chunk:
+                    estimates[ime] = mem.estimate([(ime, mefile)])
+                pending.remove(chunk)
+                running.append((chunk, pool.apply_async(generate_directories_fks_async, (chunk,))))
+        running[0][1].wait(0.1)
+        for chunk, result in list(running):
+            if result.ready():
+                diroutputs = load_directories_outputs(result.get(), model, checkpoint, compile_queue)
+                mem.release(chunk, diroutputs)
+                diroutputmap.extend(diroutputs)
+                running.remove((chunk, result))
+    return diroutputmap, estimates
+
+
+def pack_directories_jobs(jobs, costs, nchunks):
+    """sort the jobs (index, file of the matrix element) most expensive 
+    first, according to the cost model of their directory (see
+    madstr_fks.estimate_directory_cost), and pack them into chunks of 
+    similar cost (nchunks in total). The most expensive matrix elements are
+    sent first, so that they do not end up last on a single core, and 
+    those more expensive than a chunk get a chunk of their own"""
+    jobs = sorted(jobs, key=lambda job: costs[job[0]]['cost'], reverse=True)
+    target = sum([cost['cost'] for cost in costs.values()]) / float(max(nchunks, 1))
+    chunks = []
+    chunk, chunk_cost = [], 0
+    for job in jobs:
+        chunk.append(job)
+        chunk_cost += costs[job[0]]['cost']
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk, chunk_cost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def report_directories_timing(diroutputmap, sizes, predicted, walltime, nprocs, nreport=5, estimates={}):
+    """report, after the multicore output, the slowest directories, with 
+    the time predicted from the cost model estimated before writing them
+    (predicted, used for the scheduling) and the one from the cost model
+    of the written directory, both normalised to the total time.
+    The directories with the largest peak memory are also reported, with
+    the estimate used for the memory budget if any"""
+    dirs = dict((diroutput[8], diroutput[1]) for diroutput in diroutputmap)
+    times = dict((diroutput[8], diroutput[9]) for diroutput in diroutputmap)
+    costs = dict((diroutput[8], diroutput[10]) for diroutput in diroutputmap)
+    tottime = sum(times.values())
+    totpredicted = float(sum([predicted[ime]['cost'] for ime in times])) or 1.
+    totcost = float(sum([c['cost'] for c in costs.values()])) or 1.
+    logger.info('Directories written in %.1fs (%.1fs of CPU on %d cores, %.0f%% efficiency)' % \
+            (walltime, tottime, nprocs, 100. * tottime / max(walltime * nprocs, 1e-9)))
+    slowest = sorted(times, key=lambda ime: times[ime], reverse=True)[:nreport]
+    for ime in slowest:
+        logger.info('  %s: %.1fs (predicted %.1fs, from the written diagrams %.1fs; %d reals, %d OS terms, %d diagrams)' % \
+                (', '.join(dirs[ime]), times[ime],
+                 tottime * predicted[ime]['cost'] / totpredicted, tottime * costs[ime]['cost'] / totcost,
+                 costs[ime]['nreals'], costs[ime]['nos'], costs[ime]['ndiagrams']))
+
+    peaks = dict((diroutput[8], diroutput[11]) for diroutput in diroutputmap)
+    for ime in sorted(peaks, key=lambda ime: peaks[ime], reverse=True)[:nreport]:
+        logger.info('  %s: peak memory %.0f MB%s (pickle %.1f MB, %d diagrams)' % \
+                (', '.join(dirs[ime]), peaks[ime], 
+                 ', estimated %.0f MB' % estimates[ime] if ime in estimates else '',
+                 sizes[ime] / 1024.**2, costs[ime]['ndiagrams']))
+
+    # the outputs are pickled without the model, see generate_directories_fks_async
+    outsize = sum([diroutput[13] for diroutput in diroutputmap]) / 1024.**2
+    outtime = sum([diroutput[14] for diroutput in diroutputmap])
+    logger.info('Outputs of the directories: %.2f MB, loaded in %.2fs' % (outsize, outtime))
+    fullsize = sum([diroutput[15] for diroutput in diroutputmap]) / 1024.**2
+    if fullsize:
+        logger.debug('  with the model pickled: %.2f MB, loaded in %.2fs' % \
+                (fullsize, sum([diroutput[16] for diroutput in diroutputmap])))
+
+
+
+class OutputCheckpoint(object):
+    """checkpoint of the output, which allows to resume it (output --resume)
+    if it has been interrupted. The manifest, madstr_checkpoint/manifest.jsonl
+    in SubProcesses, starts with a header with the process definition and
+    the sizes of the files in SubProcesses before the first P directory 
+    was written. Then a line is added for each completed P directory, with
+    its matrix element, OS configurations and files. What is needed to 
+    finalize the output without the directory is pickled beside it"""
+
+    def __init__(self, subproc_path):
+        self.subproc_path = subproc_path
+        self.path = pjoin(subproc_path, 'madstr_checkpoint')
+        self.manifest = pjoin(self.path, 'manifest.jsonl')
+        self.entries = {}
+
+    def write_record(self, record):
+        """appends record to the manifest, and syncs it to the disk"""
+        with open(self.manifest, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def start(self, info):
+        """starts the manifest of a new output"""
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.mkdir(self.path)
+        base_sizes = dict((name, os.path.getsize(pjoin(self.subproc_path, name))) \
+                for name in os.listdir(self.subproc_path) \
+                if os.path.isfile(pjoin(self.subproc_path, name)))
+        self.entries = {}
+        self.write_record({'info': info, 'base_sizes': base_sizes})
+
+    def resume(self, info):
+        """reads the manifest of an interrupted output of the same process.
+        The directories which are not complete are removed, as well as the
+        lines they appended to the files in SubProcesses (e.g. subproc.mg).
+        Returns the number of completed directories"""
+        if not os.path.exists(self.manifest):
+            raise MadSTRInvalidCmd('No checkpoint of an interrupted output in %s: nothing to resume' % \
+                    os.path.dirname(self.subproc_path))
+        records = [json.loads(l) for l in open(self.manifest) if l.strip()]
+        header = records[0]
+        if header['info'] != info:
+            raise MadSTRInvalidCmd('The interrupted output in %s is for a different process, it cannot be resumed' % \
+                    os.path.dirname(self.subproc_path))
+        self.entries = dict((entry['ime'], entry) for entry in records[1:] if self.is_complete(entry))
+
+        done = set(sum([entry['fksdirs'] for entry in self.entries.values()], []))
+        partial = [name for name in os.listdir(self.subproc_path) if name.startswith('P') and \
+                name not in done and os.path.isdir(pjoin(self.subproc_path, name))]
+        for name in partial:
+            shutil.rmtree(pjoin(self.subproc_path, name))
+        if partial:
+            pattern = re.compile((r'(?<!\w)(%s)(?!\w)' % '|'.join([re.escape(name) for name in partial])).encode())
+            for name in os.listdir(self.subproc_path):
+                filename = pjoin(self.subproc_path, name)
+                if not os.path.isfile(filename):
+                    continue
+                base_size = header['base_sizes'].get(name, 0)
+                content = open(filename, 'rb').read()
+                lines = content[base_size:].splitlines(True)
+                kept = [l for l in lines if not pattern.search(l)]
+                if len(kept) != len(lines):
+                    outfile = open(filename, 'wb')
+                    outfile.write(content[:base_size] + b''.join(kept))
+                    outfile.close()
+        return len(self.entries)
+
+    def is_complete(self, entry):
+        """checks that all the files of the directory of entry are there"""
+        if not os.path.exists(pjoin(self.path, entry['data'])):
+            return False
+        for name, size in entry['files'].items():
+            try:
+                if os.lstat(pjoin(self.subproc_path, name)).st_size != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def add(self, ime, key, fksdirs, os_configurations, data):
+        """records the completed directories fksdirs of the ime-th matrix
+        element (key is its process), whose OS configurations are the
+        [ids, daughter positions] of each real. data is what is needed to 
+        finalize, pickled with madstr_fks.dumps_without_model"""
+        dir_files = {}
+        for fksdir in fksdirs:
+            for root, dirs, filenames in os.walk(pjoin(self.subproc_path, fksdir)):
+                for name in filenames + [d for d in dirs if os.path.islink(pjoin(root, d))]:
+                    path = pjoin(root, name)
+                    dir_files[os.path.relpath(path, self.subproc_path)] = os.lstat(path).st_size
+        datafile = 'me_%d.pkl' % ime
+        outfile = open(pjoin(self.path, datafile + '.tmp'), 'wb')
+        outfile.write(data)
+        outfile.close()
+        os.rename(pjoin(self.path, datafile + '.tmp'), pjoin(self.path, datafile))
+        entry = {'ime': ime, 'key': key, 'fksdirs': list(fksdirs), 
+                 'os_configurations': os_configurations, 'files': dir_files, 
+                 'data': datafile}
+        self.write_record(entry)
+        self.entries[ime] = entry
+
+    def check_pickled_me(self, ime, mefile):
+        """checks that the ime-th matrix element, pickled in mefile (with
+        low_mem_multicore_nlo_generation), is the one of the entry recorded
+        for it. The matrix element is only loaded for the check"""
+        infile = open(mefile, 'rb')
+        me = six.moves.cPickle.load(infile)
+        infile.close()
+        key = me.born_matrix_element.get('processes')[0].nice_string()
+        del me
+        if self.entries[ime]['key'] != key:
+            raise MadSTRInvalidCmd('The matrix elements differ from the ones of the interrupted output')
+
+    def get_data(self, ime, model):
+        """the data recorded for the ime-th matrix element"""
+        return madstr_fks.loads_with_model(
+                open(pjoin(self.path, self.entries[ime]['data']), 'rb').read(), model)
+
+    def clean(self):
+        """removes the checkpoint, once the output is finalized"""
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+class CompilationQueue(object):
+    """compiles in the background the libraries in Source and the objects of
+    the P directories (target madstr_objects), with njobs make running at 
+    the same time. The log of each job is madstr_compile.log in its directory.
+    The compilation starts while the output is written: the objects whose
+    include files are already final are compiled as soon as their directory
+    is there (see add). Those which include files written when the output
+    is finalized (e.g. coupl.inc, from the model) are compiled afterwards, 
+    with the rest of the libraries and of the directories, largest first.
+    When all is done, the times of the phases of the output (output_times,
+    a list of (phase, time)) and of the compilation are summarised"""
+
+    # the include files written, or changed, when the output is finalized
+    late_includes = ['coupl.inc', 'input.inc', 'model_functions.inc', 'mp_coupl.inc', 
+                     'mp_coupl_same_name.inc', 'mp_input.inc', 'actualize_mp_ext_params.inc',
+                     'maxparticles.inc', 'maxconfigs.inc', 'orders.inc']
+    # the libraries of Source written when the output is finalized
+    late_libraries = ['MODEL', 'DHELAS']
+
+    def __init__(self, export_dir, njobs):
+        self.export_dir = export_dir
+        self.subproc_path = pjoin(export_dir, 'SubProcesses')
+        self.njobs = njobs
+        self.results = {}
+        self.early_results = {}
+        self.early_objects = {}
+        self.fksdirs = []
+        self.thread = None
+        self.make_opts = None
+        self.early_pool = None
+
+    def get_make_opts(self):
+        """the content of Source/make_opts, which sets the compilation flags"""
+        make_opts = pjoin(self.export_dir, 'Source', 'make_opts')
+        return open(make_opts).read() if os.path.exists(make_opts) else ''
+
+    def get_includes(self, directory, filename, done=None):
+        """the include files of filename in directory, also the nested ones.
+        Those which do not exist are returned as well"""
+        if done is None:
+            done = set()
+        path = pjoin(directory, filename)
+        if not os.path.exists(path):
+            return done
+        for line in open(path):
+            match = re.match(r"^\s+include\s+['\"]([^'\"]+)['\"]", line, re.I)
+            if match and match.group(1) not in done:
+                done.add(match.group(1))
+                self.get_includes(directory, match.group(1), done)
+        return done
+
+    def get_early_objects(self, directory):
+        """the objects in directory whose include files exist and are 
+        not changed when the output is finalized"""
+        objects = []
+        for source in sorted(glob.glob(pjoin(directory, '*.f'))):
+            includes = self.get_includes(directory, os.path.basename(source))
+            if all([inc not in self.late_includes and os.path.exists(pjoin(directory, inc)) \
+                    for inc in includes]):
+                objects.append(os.path.basename(source)[:-2] + '.o')
+        return objects
+
+    def start(self):
+        """starts the compilation of the libraries of Source which do not
+        depend on the model, the P directories are added while they are
+        written"""
+        logger.info('Compiling the output in the background while it is written (%d jobs)...' % \
+                self.njobs)
+        self.start_time = time.time()
+        self.make_opts = self.get_make_opts()
+        self.early_pool = multiprocessing.pool.ThreadPool(self.njobs)
+        source = pjoin(self.export_dir, 'Source')
+        for directory in [source] + sorted(glob.glob(pjoin(source, '*'))):
+            if os.path.basename(directory) in self.late_libraries or \
+                    not os.path.exists(pjoin(directory, 'makefile')):
+                continue
+            self.add_directory(os.path.relpath(directory, self.export_dir), directory)
+
+    def add(self, fksdirs):
+        """starts the compilation of the objects of the P directories
+        fksdirs, which have just been written, which can be compiled 
+        before the output is finalized"""
+        for fksdir in fksdirs:
+            if fksdir in self.fksdirs:
+                continue
+            self.fksdirs.append(fksdir)
+            self.add_directory(fksdir, pjoin(self.subproc_path, fksdir))
+
+    def add_directory(self, name, directory):
+        objects = self.get_early_objects(directory)
+        if not objects:
+            return
+        self.early_objects[name] = (directory, objects)
+        self.early_pool.apply_async(self.compile, ((name, directory, objects), self.early_results))
+
+    def finalize(self, output_times):
+        """to be called once the output is finalized: the remaining objects
+        are compiled in a thread. The thread is not a daemon, so that 
+        MG5_aMC waits for it before exiting"""
+        self.output_times = output_times
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def compile(self, job, results=None):
+        """runs make for job, (name, directory, targets)"""
+        name, cwd, targets = job
+        start = time.time()
+        with open(pjoin(cwd, 'madstr_compile.log'), 'a') as log:
+            try:
+                status = subprocess.call(['make'] + targets, cwd=cwd, stdout=log, 
+                                         stderr=subprocess.STDOUT)
+            except OSError as error:
+                log.write('%s\n' % error)
+                status = -1
+        (self.results if results is None else results)[name] = (status, time.time() - start)
+
+    def run(self):
+        self.early_pool.close()
+        self.early_pool.join()
+        early_time = time.time() - self.start_time
+        if self.get_make_opts() != self.make_opts:
+            # the flags have been changed when the output was finalized
+            logger.debug('make_opts changed, the objects compiled while writing the output are removed')
+            for directory, objects in self.early_objects.values():
+                for obj in objects:
+                    if os.path.exists(pjoin(directory, obj)):
+                        os.remove(pjoin(directory, obj))
+        # the objects of the directories need the include files of the
+        # libraries, e.g. the ones of the model
+        start = time.time()
+        self.compile(('Source', pjoin(self.export_dir, 'Source'), []))
+        def get_size(fksdir):
+            return sum([os.path.getsize(f) for f in glob.glob(pjoin(self.subproc_path, fksdir, '*.f'))])
+        self.jobs = [(fksdir, pjoin(self.subproc_path, fksdir), ['madstr_objects']) \
+                for fksdir in sorted(self.fksdirs, key=get_size, reverse=True)]
+        pool = multiprocessing.pool.ThreadPool(self.njobs)
+        pool.map(self.compile, self.jobs, chunksize=1)
+        pool.close()
+        pool.join()
+        self.report(early_time, time.time() - start)
+
+    def report(self, early_time, walltime, nreport=5):
+        """logs the timing summary"""
+        logger.info('MadSTR timing summary:')
+        for phase, phase_time in self.output_times:
+            logger.info('  %-35s %8.1fs' % (phase, phase_time))
+        logger.info('  %-35s %8.1fs' % ('compilation while writing', early_time))
+        logger.info('    %d objects in %d directories' % \
+                (sum([len(objects) for directory, objects in self.early_objects.values()]),
+                 len(self.early_objects)))
+        logger.info('  %-35s %8.1fs' % ('compilation after finalize', walltime))
+        logger.info('    Source: %.1fs, directories: %.1fs summed over %d directories' % \
+                (self.results['Source'][1], sum([self.results[job[0]][1] for job in self.jobs]), len(self.jobs)))
+        for job in sorted(self.jobs, key=lambda job: self.results[job[0]][1], reverse=True)[:nreport]:
+            logger.info('    %s: %.1fs' % (job[0], self.results[job[0]][1]))
+        # the objects which failed early are compiled again afterwards, 
+        # only the failures of the last phase matter
+        failed = [name for name, (status, job_time) in self.results.items() if status]
+        if failed:
+            logger.warning('The compilation failed in %s (see madstr_compile.log there),\n' % ', '.join(failed) + \
+                    '   it will be done again at launch')
+
+
+def get_os_configurations_summary(me):
+    """the [ids, daughter positions] of the OS configurations of each real
+    of me, as recorded in the checkpoint manifest"""
+    return [[[list(conf.ids), list(conf.daughter_pos)] for conf in real_me.os_configurations] \
+            for real_me in me.real_processes]
 
 
 class MadSTRInterfaceError(MadGraph5Error):
@@ -117,6 +667,13 @@ class MadSTRInterface(master_interface.MasterCmd):
                 "launched from within the process directory.")
 
 
+    def do_generate(self, line, *args, **opts):
+        """does the usual generate command, after releasing the amplitudes
+        of the on-shell processes of the previous generation"""
+        madstr_fks.release_os_amplitudes()
+        super(MadSTRInterface, self).do_generate(line, *args, **opts)
+
+
     def do_add(self, line, *args, **opts):
         """does the usual add command, then, if the output mode is NLO
         on-shell singularities are looked for
@@ -140,6 +697,136 @@ class MadSTRInterface(master_interface.MasterCmd):
         logger.info('Found %d on-shell contributions' % self.n_os)
 
 
+    def do_os_survey(self, line):
+        """os_survey [FILE]: looks for the on-shell resonances of the
+        generated process and reports, for each Born, the number of reals
+        and of OS terms, the resonant diagrams, the diagrams of the OS
+        matrix elements, the number of Fortran files written by MadSTR and
+        the relative cost of the P directory. Nothing is exported.
+        The report is also saved in FILE (default madstr_os_survey.json)
+        """
+        args = self.split_arg(line)
+        if len(args) > 1:
+            raise self.InvalidCmd('os_survey takes at most one argument, the report file')
+        filename = args[0] if args else 'madstr_os_survey.json'
+        if not hasattr(self, '_fks_multi_proc') or not self._fks_multi_proc:
+            raise self.InvalidCmd('No NLO process has been generated, please generate a process with [QCD]')
+
+        surveys = [madstr_fks.get_os_survey(born) for born in self._fks_multi_proc['born_processes']]
+        totcost = float(sum([survey['cost'] for survey in surveys])) or 1.
+        for survey in surveys:
+            survey['relative_cost'] = survey['cost'] / totcost
+
+        logger.info('MadSTR survey of the on-shell subtraction (P directories by decreasing cost):')
+        logger.info('  %-40s %6s %6s %10s %10s %6s %7s' % \
+                ('Born', 'reals', 'OS', 'resonant', 'OS diags', 'files', 'cost'))
+        for survey in sorted(surveys, key=lambda survey: survey['cost'], reverse=True):
+            logger.info('  %-40s %6d %6d %10d %10d %6d %6.1f%%' % \
+                    (survey['born'][:40], len(survey['reals']), survey['nos'], survey['nresonant'],
+                     survey['ndiagrams_os'], survey['nfiles'], 100. * survey['relative_cost']))
+        totals = dict((key, sum([survey[key] for survey in surveys])) for key in \
+                ['nos', 'nresonant', 'ndiagrams_os', 'nfiles', 'cost'])
+        totals['nreals'] = sum([len(survey['reals']) for survey in surveys])
+        logger.info('  %-40s %6d %6d %10d %10d %6d' % ('Total', totals['nreals'], totals['nos'],
+                totals['nresonant'], totals['ndiagrams_os'], totals['nfiles']))
+
+        outfile = open(filename, 'w')
+        json.dump({'model': self._curr_model.get('name'), 'generate': str(self._generate_info),
+                   'totals': totals, 'borns': surveys}, outfile, indent=1)
+        outfile.close()
+        logger.info('Survey saved in %s' % filename)
+
+
+    def get_madstr_output_options(self, args):
+        """parse (and remove from args) the options of the output command
+        which are specific to MadSTR:
+          --reentrant[=N]: the OS-subtracted matrix elements can be called
+             by up to N (default 64) OpenMP threads at the same time. For
+             N>1 the MadSTR objects are compiled with -fopenmp
+          --standalone: the P* directories can also be compiled into a
+             Python module which evaluates the OS-subtracted reals on
+             NumPy arrays (see bin/internal/madstr_standalone.py)
+          --mem_budget=SIZE: with low_mem_multicore_nlo_generation, the
+             directories are written only as long as their estimated
+             memory fits in SIZE (in MB, or with a M/G suffix)
+          --low_footprint: the amplitudes of the OS processes are released
+             once the HELAS matrix elements are generated, and these once
+             the directory has been written. The memory is logged after
+             each phase of the output
+          --resume: continue an interrupted output of the same process,
+             from the P directories recorded as complete in its checkpoint
+          --compile[=N]: the libraries and the objects of the P directories
+             are compiled in the background, with N (default nb_core) make
+             at the same time. Each directory is compiled once written, 
+             the objects which need the model once the output is finalized
+          --build_cache[=DIR]: the objects of the MadSTR files and of the
+             model are compiled through a cache in DIR (default 
+             ~/.cache/madstr_build), shared among the outputs using it
+        """
+        options = {'madstr_max_threads': 1,
+                   'madstr_standalone': False,
+                   'madstr_mem_budget': 0,
+                   'madstr_low_footprint': False,
+                   'madstr_resume': False,
+                   'madstr_compile': 0,
+                   'madstr_build_cache': ''}
+        for arg in list(args):
+            if arg == '--standalone':
+                options['madstr_standalone'] = True
+                args.remove(arg)
+                continue
+            if arg == '--resume':
+                options['madstr_resume'] = True
+                args.remove(arg)
+                continue
+            if arg == '--build_cache' or arg.startswith('--build_cache='):
+                value = arg.split('=', 1)[1] if '=' in arg else pjoin('~', '.cache', 'madstr_build')
+                if not value:
+                    raise self.InvalidCmd('Invalid build cache directory: %s' % arg)
+                options['madstr_build_cache'] = os.path.abspath(os.path.expanduser(value))
+                args.remove(arg)
+                continue
+            if arg == '--compile' or arg.startswith('--compile='):
+                value = arg.split('=', 1)[1] if '=' in arg else \
+                        str(self.options.get('nb_core') or multiprocessing.cpu_count())
+                try:
+                    options['madstr_compile'] = int(value)
+                except ValueError:
+                    raise self.InvalidCmd('Invalid number of compilation jobs: %s' % value)
+                if options['madstr_compile'] < 1:
+                    raise self.InvalidCmd('Invalid number of compilation jobs: %s' % value)
+                args.remove(arg)
+                continue
+            if arg == '--low_footprint':
+                options['madstr_low_footprint'] = True
+                args.remove(arg)
+                continue
+            if arg == '--reentrant' or arg.startswith('--reentrant='):
+                value = arg.split('=', 1)[1] if '=' in arg else '64'
+                try:
+                    options['madstr_max_threads'] = int(value)
+                except ValueError:
+                    raise self.InvalidCmd('Invalid number of threads: %s' % value)
+                if options['madstr_max_threads'] < 1:
+                    raise self.InvalidCmd('Invalid number of threads: %s' % value)
+                args.remove(arg)
+                continue
+            if arg == '--mem_budget' or arg.startswith('--mem_budget='):
+                if '=' not in arg:
+                    raise self.InvalidCmd('--mem_budget needs a size, e.g. --mem_budget=4G')
+                value = arg.split('=', 1)[1]
+                try:
+                    scale = {'M': 1, 'G': 1024}.get(value[-1:].upper(), None)
+                    options['madstr_mem_budget'] = \
+                        float(value[:-1]) * scale if scale else float(value)
+                except ValueError:
+                    raise self.InvalidCmd('Invalid memory budget: %s' % value)
+                if options['madstr_mem_budget'] <= 0:
+                    raise self.InvalidCmd('Invalid memory budget: %s' % value)
+                args.remove(arg)
+        return options
+
+
     def do_output(self, line):
         """output command: if no os divergences are there or if LO run has
         been generated nothing has to be done.
@@ -155,7 +842,13 @@ class MadSTRInterface(master_interface.MasterCmd):
             super(MadSTRInterface, self).do_output(line)
             return
 
+        # the amplitudes of the on-shell processes of other models 
+        # (e.g. imported again since the generation) are not used
+        madstr_fks.release_os_amplitudes(self._curr_model)
+
         args = self.split_arg(line)
+        # remove the options specific to MadSTR before the checks
+        madstr_options = self.get_madstr_output_options(args)
         # Check Argument validity
         self.check_output(args)
         
@@ -208,12 +901,22 @@ class MadSTRInterface(master_interface.MasterCmd):
             to_pass = dict(MadLoop_SA_options)
             to_pass['mp'] = len(self._fks_multi_proc.get_virt_amplitudes()) > 0
             to_pass['export_format'] = 'FKS5_optimized'
-            self._curr_exporter = madstr_exporter.MadSTRExporter(self._export_dir, to_pass)
+            to_pass.update(madstr_options)
+            if madstr_options['madstr_standalone']:
+                exporter_class = madstr_exporter.MadSTRStandaloneExporter
+            else:
+                exporter_class = madstr_exporter.MadSTRExporter
+            self._curr_exporter = exporter_class(self._export_dir, to_pass)
             
             self._curr_exporter.pass_information_from_cmd(self)
 
+        # the interrupted output is continued in place
+        resume = madstr_options['madstr_resume'] and self._export_format in ['NLO']
+        if resume and not os.path.isdir(self._export_dir):
+            raise MadSTRInvalidCmd('No output in %s to resume' % self._export_dir)
+
         # check if a dir with the same name already exists
-        if not force and not noclean and os.path.isdir(self._export_dir)\
+        if not resume and not force and not noclean and os.path.isdir(self._export_dir)\
                and self._export_format in ['NLO']:
             # Don't ask if user already specified force or noclean
             logger.info('INFO: directory %s already exists.' % self._export_dir)
@@ -225,11 +928,11 @@ class MadSTRInterface(master_interface.MasterCmd):
 
         # if one gets here either used -f or answered yes to the question about
         # removing the dir
-        if os.path.exists(self._export_dir):
+        if os.path.exists(self._export_dir) and not resume:
             shutil.rmtree(self._export_dir)
 
         # Make a Template Copy
-        if self._export_format in ['NLO']:
+        if self._export_format in ['NLO'] and not resume:
             version = misc.get_pkg_info()['version'].split('.')
             if int(version[0]) == 2:
                 self._curr_exporter.copy_fkstemplate()
@@ -239,19 +942,41 @@ class MadSTRInterface(master_interface.MasterCmd):
         # Reset _done_export, since we have new directory
         self._done_export = False
 
+        # with --compile, the directories are compiled while they are written
+        self._madstr_compile_queue = None
+        if madstr_options['madstr_compile'] and self._export_format in ['NLO']:
+            self._madstr_compile_queue = CompilationQueue(self._export_dir, madstr_options['madstr_compile'])
+            self._madstr_compile_queue.start()
+
         # Perform export and finalize right away
+        start = time.time()
         self.export(nojpeg, main_file_name, group_processes=group_processes)
+        output_times = [('writing the directories', time.time() - start)]
 
         # Pass potential new information generated during the export.
         self._curr_exporter.pass_information_from_cmd(self)
 
         # Automatically run finalize
+        start = time.time()
         self.finalize(nojpeg)
+        output_times.append(('finalize', time.time() - start))
+        log_memory_checkpoint('output finalized', madstr_options['madstr_low_footprint'])
+        # all the directories are there, the checkpoint is not needed any more
+        if getattr(self, '_madstr_checkpoint', None):
+            self._madstr_checkpoint.clean()
+            self._madstr_checkpoint = None
             
         # Generate the virtuals if from OLP
         if self.options['OLP']!='MadLoop':
             self._curr_exporter.generate_virtuals_from_OLP(
               self.born_processes_for_olp,self._export_dir,self.options['OLP'])
+
+        # the model (e.g. coupl.inc) is written by finalize, so the objects
+        # which include it are compiled only now
+        if self._madstr_compile_queue:
+            self._madstr_compile_queue.add(self._fks_directories)
+            self._madstr_compile_queue.finalize(output_times)
+            self._madstr_compile_queue = None
                 
         # Remember that we have done export
         self._done_export = (self._export_dir, self._export_format)
@@ -287,6 +1012,13 @@ class MadSTRInterface(master_interface.MasterCmd):
                                  madstr_fks.FKSHelasMultiProcessWithOS(\
                                     self._fks_multi_proc, 
                                     loop_optimized= self.options['loop_optimized_output'])
+                        log_memory_checkpoint('matrix elements generated', low_footprint)
+                        if low_footprint:
+                            # the diagram-level OS information is not needed
+                            # any more, only the HELAS matrix elements
+                            namps = madstr_fks.release_os_amplitudes()
+                            gc.collect()
+                            log_memory_checkpoint('%d OS amplitudes released' % namps, low_footprint)
                     
                         ndiags = sum([len(me.get('diagrams')) for \
                                       me in self._curr_matrix_elements.\
@@ -345,6 +1077,8 @@ class MadSTRInterface(master_interface.MasterCmd):
 
         # Start of the actual routine
 
+        low_footprint = self._curr_exporter.opt.get('madstr_low_footprint', False)
+        compile_queue = getattr(self, '_madstr_compile_queue', None)
         ndiags, cpu_time = generate_matrix_elements(self, group=group_processes)
         calls = 0
         splitorders = []
@@ -361,9 +1095,21 @@ class MadSTRInterface(master_interface.MasterCmd):
                 proc_charac[charac] = self._curr_matrix_elements[charac]
 
             # prepare for the generation
-            # glob_directories_map is for the new NLO generation
-            global glob_directories_map
-            glob_directories_map = []
+            # directories_jobs is for the new NLO generation
+            directories_jobs = []
+
+            # the completed directories are recorded, so that the output
+            # can be resumed if it is interrupted
+            nme = len(self._curr_matrix_elements.get('matrix_elements'))
+            checkpoint = OutputCheckpoint(path)
+            checkpoint_info = {'model': self._curr_model.get('name'), 
+                               'generate': str(self._generate_info), 'nme': nme}
+            if self._curr_exporter.opt.get('madstr_resume', False):
+                logger.info('Resuming the output: %d of %d matrix elements already written' % \
+                        (checkpoint.resume(checkpoint_info), nme))
+            else:
+                checkpoint.start(checkpoint_info)
+            self._madstr_checkpoint = checkpoint
 
             # Save processes instances generated
             self.born_processes_for_olp = []
@@ -374,48 +1120,100 @@ class MadSTRInterface(master_interface.MasterCmd):
                 version = misc.get_pkg_info()['version'].split('.')
                 if not self.options['low_mem_multicore_nlo_generation']:
                     #me is a FKSHelasProcessFromReals
-                    calls_dir = self._curr_exporter.generate_directories_fks(me, 
-                            self._curr_helas_model, 
-                            ime, len(self._curr_matrix_elements.get('matrix_elements')), 
-                            path,self.options['OLP'])
+                    if ime in checkpoint.entries:
+                        # written before the interruption
+                        if checkpoint.entries[ime]['key'] != me.get('processes')[0].nice_string():
+                            raise MadSTRInvalidCmd('The matrix elements differ from the ones of the interrupted output')
+                        data = checkpoint.get_data(ime, self._curr_model)
+                        calls_dir = data['calls']
+                        fksdirs = data['fksdirs']
+                        proc_charac['nexternal'] = max(proc_charac['nexternal'], data['nexternal'])
+                        proc_charac['ninitial'] = data['ninitial']
+                    else:
+                        calls_dir = self._curr_exporter.generate_directories_fks(me, 
+                                self._curr_helas_model, 
+                                ime, nme, path,self.options['OLP'])
+                        fksdirs = list(self._curr_exporter.fksdirs)
+                        checkpoint.add(ime, me.get('processes')[0].nice_string(), fksdirs,
+                                get_os_configurations_summary(me),
+                                madstr_fks.dumps_without_model({'calls': calls_dir, 'fksdirs': fksdirs, 
+                                    'nexternal': proc_charac['nexternal'], 'ninitial': proc_charac['ninitial']}))
                     if type(calls_dir) == int:
                         calls+= calls_dir
                     else:
                         calls+= calls_dir[0]
                         splitorders.extend(calls_dir[1])
-                    self._fks_directories.extend(self._curr_exporter.fksdirs)
+                    self._fks_directories.extend(fksdirs)
+                    if compile_queue:
+                        compile_queue.add(fksdirs)
+                    if low_footprint:
+                        self._curr_matrix_elements.release_os_matrix_elements(me)
                     if hasattr(me, 'born_matrix_element'):
                         self.born_processes_for_olp.append(me.born_matrix_element.get('processes')[0])
                         self.born_processes.append(me.born_matrix_element.get('processes'))
                     else:
                         self.born_processes_for_olp.append(me.born_me.get('processes')[0])
                         self.born_processes.append(me.born_me.get('processes'))
+                elif ime not in checkpoint.entries:
+                    # me is the file where the matrix element is pickled
+                    directories_jobs.append((ime, me))
                 else:
-                    glob_directories_map.append(\
-                            [self._curr_exporter, me, self._curr_helas_model, 
-                             ime, len(self._curr_matrix_elements.get('matrix_elements')), 
-                             path, self.options['OLP']])
+                    # written before the interruption
+                    checkpoint.check_pickled_me(ime, me)
 
             if self.options['low_mem_multicore_nlo_generation']:
                 # start the pool instance with a signal instance to catch ctr+c
                 logger.info('Writing directories...')
                 original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
                 if self.ncores_for_proc_gen < 0: # use all cores
-                    pool = multiprocessing.Pool(maxtasksperchild=1)
+                    nprocs = multiprocessing.cpu_count()
                 else:
-                    pool = multiprocessing.Pool(processes=self.ncores_for_proc_gen,maxtasksperchild=1)
+                    nprocs = self.ncores_for_proc_gen
+                # the workers are persistent: the exporter, the HELAS model
+                # and the options are set up once per worker by the 
+                # initializer, the tasks only carry the pickled matrix element
+                pool = multiprocessing.Pool(processes=nprocs,
+                        initializer=init_directories_worker,
+                        initargs=(self._curr_exporter, self._curr_helas_model,
+                                  len(self._curr_matrix_elements.get('matrix_elements')),
+                                  path, self.options['OLP']))
                 signal.signal(signal.SIGINT, original_sigint_handler)
+                # the matrix elements are sent most expensive first, the 
+                # cheap ones packed in chunks, a few chunks per worker so 
+                # that the load stays balanced. The sizes of the pickles
+                # are used for the memory budget
+                sizes = dict((ime, os.path.getsize(mefile)) for ime, mefile in directories_jobs)
+                diroutputmap = []
+                estimates = {}
+                mem_budget = self._curr_exporter.opt.get('madstr_mem_budget', 0)
+                start = time.time()
                 try:
-                    # the very large timeout passed to get is to be able to catch
-                    # KeyboardInterrupts
-                    diroutputmap = pool.map_async(generate_directories_fks_async,
-                                                  range(len(glob_directories_map))).get(9999999)
+                    costs = dict(pool.map(estimate_directory_cost_async, directories_jobs))
+                    logger.info('Cost of the directories estimated in %.1fs' % (time.time() - start))
+                    start = time.time()
+                    chunks = pack_directories_jobs(directories_jobs, costs, 4 * nprocs)
+                    if mem_budget:
+                        diroutputmap, estimates = run_with_memory_budget(
+                                pool, chunks, mem_budget, sizes, nprocs, self._curr_model, checkpoint,
+                                compile_queue)
+                    else:
+                        for outputs in pool.imap_unordered(generate_directories_fks_async, chunks):
+                            diroutputmap.extend(load_directories_outputs(outputs, self._curr_model, 
+                                                                         checkpoint, compile_queue))
                 except KeyboardInterrupt:
                     pool.terminate()
                     raise KeyboardInterrupt 
     
                 pool.close()
                 pool.join()
+                report_directories_timing(diroutputmap, sizes, costs, time.time() - start, nprocs, 
+                                          estimates=estimates)
+                # the directories written before the interruption
+                for ime in checkpoint.entries:
+                    if ime not in sizes:
+                        diroutputmap.append(checkpoint.get_data(ime, self._curr_model))
+                # restore the order of the matrix elements
+                diroutputmap.sort(key=lambda diroutput: diroutput[8])
                 
                 #clean up tmp files containing final matrix elements
                 for mefile in self._curr_matrix_elements.get('matrix_elements'):
@@ -459,6 +1257,8 @@ class MadSTRInterface(master_interface.MasterCmd):
                 max_loop_vertex_ranks = [me.get_max_loop_vertex_rank() for \
                                          me in self._curr_matrix_elements.get_virt_matrix_elements()]
 
+            log_memory_checkpoint('directories written', low_footprint)
+
             card_path = os.path.join(path, os.path.pardir, 'SubProcesses', \
                                      'procdef_mg5.dat')
             
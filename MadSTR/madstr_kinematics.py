@@ -0,0 +1,276 @@
+#####################################################
+#                                                   #
+#  Vectorised reference implementation of the       #
+#  momentum reshufflings of the MadSTR plugin       #
+#  (SubProcesses/transform_os.f)                    #
+#                                                   #
+#####################################################
+
+""" NumPy versions of the kernels of transform_os.f, acting on arrays of
+momenta of shape (npts, nexternal, 4), with components (E, px, py, pz).
+Particle positions (ip, jp, kp, idau1, idau2) start from 0, as the
+daughter_pos attribute of the OS configurations; masses are floats.
+Contrary to the Fortran, the consistency checks do not stop: use
+check_momenta to get the points which fail them.
+This module only depends on NumPy, so that it can be used outside of
+MG5_aMC (e.g. by madstr_kinematics_bench.py).
+"""
+
+import numpy
+
+# the strategies, as the values of istr, which use each reshuffling
+STRATEGIES = {'ident': (2,),
+              'init': (3, 4),
+              'final': (5, 6),
+              'spect': (7, 8)}
+
+
+def dot(p, q):
+    """ Minkowski product of (..., 4) arrays """
+    return p[..., 0] * q[..., 0] - p[..., 1] * q[..., 1] - \
+           p[..., 2] * q[..., 2] - p[..., 3] * q[..., 3]
+
+
+def threedot(p, q):
+    """ Euclidean product of the spatial components of (..., 4) arrays """
+    return p[..., 1] * q[..., 1] + p[..., 2] * q[..., 2] + p[..., 3] * q[..., 3]
+
+
+def madstr_lambda_tr(x, y, z):
+    """ the triangular (Kallen) function """
+    return x**2 + y**2 + z**2 - 2. * x * y - 2. * x * z - 2. * y * z
+
+
+def boostx(p, q):
+    """ boost p, given in the q rest frame, to the frame where q is given
+    (as boostx of HELAS) """
+    qq = threedot(q, q)
+    pq = threedot(p, q)
+    nonzero = qq != 0.
+    qq_safe = numpy.where(nonzero, qq, 1.)
+    m = numpy.sqrt(numpy.maximum(q[..., 0]**2 - qq, 1e-99))
+    lf = ((q[..., 0] - m) * pq / qq_safe + p[..., 0]) / m
+    pboost = numpy.empty(numpy.broadcast(p, q).shape)
+    pboost[..., 0] = (p[..., 0] * q[..., 0] + pq) / m
+    pboost[..., 1:] = p[..., 1:] + q[..., 1:] * lf[..., None]
+    return numpy.where(nonzero[..., None], pboost, p)
+
+
+def madstr_invboostx(p, q):
+    """ boost p to the q rest frame (the inverse of boostx) """
+    qq = threedot(q, q)
+    pq = threedot(p, q)
+    nonzero = qq != 0.
+    qq_safe = numpy.where(nonzero, qq, 1.)
+    m = numpy.sqrt(numpy.maximum(q[..., 0]**2 - qq, 1e-99))
+    lf = (-(q[..., 0] - m) * pq / qq_safe + p[..., 0]) / m
+    pboost = numpy.empty(numpy.broadcast(p, q).shape)
+    pboost[..., 0] = (p[..., 0] * q[..., 0] - pq) / m
+    pboost[..., 1:] = p[..., 1:] - q[..., 1:] * lf[..., None]
+    return numpy.where(nonzero[..., None], pboost, p)
+
+
+def put_on_shell_in_rest_frame(qi, qj, mass_i, mass_j, mass_ij):
+    """ rescale the spatial components of the back-to-back momenta qi, qj
+    so that they have masses mass_i, mass_j and sum to mass_ij """
+    msq_i, msq_j, msq_ij = mass_i**2, mass_j**2, mass_ij**2
+    resc = numpy.sqrt((((msq_ij - msq_i - msq_j) / 2.)**2 - msq_i * msq_j) /
+                      (threedot(qi, qi) * msq_ij))
+    qi = qi.copy()
+    qj = qj.copy()
+    qi[..., 1:] *= resc[..., None]
+    qj[..., 1:] *= resc[..., None]
+    qi[..., 0] = numpy.sqrt(msq_i + threedot(qi, qi))
+    qj[..., 0] = numpy.sqrt(msq_j + threedot(qj, qj))
+    return qi, qj
+
+
+def transform_os_ident(p):
+    """ no reshuffling (istr=2) """
+    return p.copy(), numpy.zeros(p.shape[0], dtype=int)
+
+
+def transform_os_init(p, ip, jp, mass_i, mass_j, mass_ij, nincoming=2):
+    """ put pi+pj on shell keeping its three-momentum fixed, and
+    compensate on the initial-state momenta (istr=3,4). The angles in
+    the pi+pj rest frame are not changed. It never fails (stat=0) """
+    q = p.copy()
+    pij = p[:, ip] + p[:, jp]
+
+    # go to the pij rest frame and put qi, qj on shell there
+    qi = madstr_invboostx(p[:, ip], pij)
+    qj = madstr_invboostx(p[:, jp], pij)
+    qi, qj = put_on_shell_in_rest_frame(qi, qj, mass_i, mass_j, mass_ij)
+
+    # qij has the same spatial components of pij
+    qij = pij.copy()
+    qij[:, 0] = numpy.sqrt(mass_ij**2 + threedot(pij, pij))
+    q[:, ip] = boostx(qi, qij)
+    q[:, jp] = boostx(qj, qij)
+
+    # initial state momenta: one knows the sum and the difference of
+    # energies (sum of z components of FS momenta)
+    etot = q[:, nincoming:, 0].sum(axis=1)
+    ztot = q[:, nincoming:, 3].sum(axis=1)
+    q[:, 0, :] = 0.
+    q[:, 1, :] = 0.
+    q[:, 0, 0] = (etot + ztot) / 2.
+    q[:, 0, 3] = numpy.copysign(numpy.abs(q[:, 0, 0]), p[:, 0, 3])
+    q[:, 1, 0] = (etot - ztot) / 2.
+    q[:, 1, 3] = numpy.copysign(numpy.abs(q[:, 1, 0]), p[:, 1, 3])
+    return q, numpy.zeros(p.shape[0], dtype=int)
+
+
+def transform_os_final(p, ip, jp, mass_i, mass_j, mass_ij, nincoming=2):
+    """ put pi+pj on shell compensating on all the other final-state
+    particles (istr=5,6). The angles in the pi+pj rest frame are not
+    changed. If there is not enough energy, the initial-state momenta
+    are rescaled, so that it never fails (stat=0) """
+    npts, nexternal = p.shape[:2]
+    msq_ij = mass_ij**2
+    shat = 2. * dot(p[:, 0], p[:, 1])
+
+    # boost the momenta in the partonic c.o.m. frame
+    pboost = p[:, 0] + p[:, 1]
+    pcom = madstr_invboostx(p, pboost[:, None, :])
+
+    # the recoil system (all FS particles which are not i and j)
+    recoil = [i for i in range(nincoming, nexternal) if i not in (ip, jp)]
+    preco = pcom[:, recoil].sum(axis=1)
+    msq_reco = dot(preco, preco)
+    pij = pcom[:, ip] + pcom[:, jp]
+
+    # if there is not enough energy, rescale shat and the initial momenta
+    rescale = numpy.sqrt(shat) < mass_ij + numpy.sqrt(msq_reco)
+    rescale_init = numpy.where(rescale,
+            (numpy.sqrt(msq_reco) + mass_ij) /
+            (numpy.sqrt(msq_reco) + numpy.sqrt(numpy.abs(dot(pij, pij)))), 1.)
+    pcom[:, :nincoming] *= rescale_init[:, None, None]
+    shat = shat * rescale_init**2
+
+    # qij gets the reshuffled mass and qreco keeps its invariant mass,
+    # with the same directions as pij and preco
+    sqrts = numpy.sqrt(shat)
+    qij = numpy.empty((npts, 4))
+    qreco = numpy.empty((npts, 4))
+    qij[:, 0] = sqrts / 2. * (1. + (msq_ij - msq_reco) / shat)
+    qreco[:, 0] = sqrts / 2. * (1. - (msq_ij - msq_reco) / shat)
+    qij[:, 1:] = pij[:, 1:] / numpy.sqrt(threedot(pij, pij))[:, None] * \
+            numpy.sqrt(qij[:, 0]**2 - msq_ij)[:, None]
+    qreco[:, 1:] = preco[:, 1:] / numpy.sqrt(threedot(preco, preco))[:, None] * \
+            numpy.sqrt(qreco[:, 0]**2 - msq_reco)[:, None]
+
+    # i and j: put them on shell in the pij rest frame
+    qi = madstr_invboostx(pcom[:, ip], pij)
+    qj = madstr_invboostx(pcom[:, jp], pij)
+    qi, qj = put_on_shell_in_rest_frame(qi, qj, mass_i, mass_j, mass_ij)
+
+    qcom = pcom.copy()
+    qcom[:, ip] = boostx(qi, qij)
+    qcom[:, jp] = boostx(qj, qij)
+    # the other recoiling particles: to the preco rest frame and
+    # back with qreco
+    if recoil:
+        qcom[:, recoil] = boostx(madstr_invboostx(pcom[:, recoil],
+                                                  preco[:, None, :]),
+                                 qreco[:, None, :])
+
+    # boost the momenta back to the original frame
+    q = boostx(qcom, pboost[:, None, :])
+    return q, numpy.zeros(npts, dtype=int)
+
+
+def transform_os_spect(p, ip, jp, kp, mass_i, mass_j, mass_k, mass_ij):
+    """ put pi+pj on shell compensating on the spectator kp, as in the
+    final-final CS dipoles (istr=7,8). One among i and j must be massless.
+    stat is 1 for the points where there is not enough energy in the
+    i+j+k system, and q is a copy of p there """
+    if mass_i != 0. and mass_j != 0.:
+        raise ValueError('transform_os_spect: I and J both massive %s %s' % \
+                         (mass_i, mass_j))
+    msq_i, msq_j, msq_k, msq_ij = mass_i**2, mass_j**2, mass_k**2, mass_ij**2
+
+    q = p.copy()
+    qtot = p[:, ip] + p[:, jp] + p[:, kp]
+    pij = p[:, ip] + p[:, jp]
+    qsq = dot(qtot, qtot)
+
+    stat = (numpy.sqrt(numpy.maximum(qsq, 0.)) < mass_ij + mass_k).astype(int)
+    ok = stat == 0
+    qsq = numpy.where(ok, qsq, 1.)
+
+    # the spectator
+    pk = p[:, kp]
+    fact = numpy.sqrt(madstr_lambda_tr(qsq, msq_ij, msq_k)) / \
+           numpy.sqrt(madstr_lambda_tr(qsq, dot(pij, pij), msq_k))
+    qk = fact[:, None] * (pk - (dot(qtot, pk) / qsq)[:, None] * qtot) + \
+         ((qsq + msq_k - msq_ij) / 2. / qsq)[:, None] * qtot
+    qij = qtot - qk
+
+    # the massless one among i and j keeps its direction
+    if mass_i == 0.:
+        im, io, msq_o = ip, jp, msq_j
+    else:
+        im, io, msq_o = jp, ip, msq_i
+    pm = p[:, im]
+    a = (msq_ij - msq_o) / 2. / \
+        (qij[:, 0] * numpy.sqrt(threedot(pm, pm)) - threedot(pm, qij))
+    qm = numpy.empty_like(pm)
+    qm[:, 1:] = a[:, None] * pm[:, 1:]
+    qm[:, 0] = numpy.sqrt(threedot(qm, qm))
+
+    q[:, kp] = numpy.where(ok[:, None], qk, p[:, kp])
+    q[:, im] = numpy.where(ok[:, None], qm, p[:, im])
+    q[:, io] = numpy.where(ok[:, None], qij - qm, p[:, io])
+    return q, stat
+
+
+def transform_os(p, istr, ip, jp, mass_i, mass_j, mass_ij, kp=None, mass_k=0.,
+                 nincoming=2):
+    """ dispatch to the reshuffling used by the strategy istr (2...8),
+    as in the OS wrappers. Returns q and stat """
+    if istr in STRATEGIES['ident']:
+        return transform_os_ident(p)
+    elif istr in STRATEGIES['init']:
+        return transform_os_init(p, ip, jp, mass_i, mass_j, mass_ij, nincoming)
+    elif istr in STRATEGIES['final']:
+        return transform_os_final(p, ip, jp, mass_i, mass_j, mass_ij, nincoming)
+    elif istr in STRATEGIES['spect']:
+        if kp is None:
+            raise ValueError('transform_os: istr=%d needs a spectator' % istr)
+        return transform_os_spect(p, ip, jp, kp, mass_i, mass_j, mass_k, mass_ij)
+    raise ValueError('transform_os: istr not implemented %s' % istr)
+
+
+def get_bw_ratio(p, mom_mass, mom_wdth, idau1, idau2, ibw):
+    """ ratio of the Breit-Wigner of the reconstructed mother with the
+    on-shell one: ibw=0 none (1.), ibw=1 standard, ibw=2 running """
+    pm = p[:, idau1] + p[:, idau2]
+    m2_reco = dot(pm, pm)
+    if ibw == 0:
+        return numpy.ones(p.shape[0])
+    elif ibw == 1:
+        return (mom_mass * mom_wdth)**2 / \
+               ((m2_reco - mom_mass**2)**2 + (mom_mass * mom_wdth)**2)
+    elif ibw == 2:
+        return m2_reco * mom_wdth**2 / \
+               ((m2_reco - mom_mass**2)**2 + m2_reco * mom_wdth**2)
+    raise ValueError('get_bw_ratio: not implemented %s' % ibw)
+
+
+def check_momenta(p, q, ip, jp, nincoming=2):
+    """ the checks of OS_check_momenta: i and j keep their mass and
+    momentum is conserved. Returns a boolean array, False for the points
+    where the Fortran code would stop """
+    ok = numpy.ones(p.shape[0], dtype=bool)
+    for i in (ip, jp):
+        msq_p = dot(p[:, i], p[:, i])
+        msq_q = dot(q[:, i], q[:, i])
+        ok &= numpy.abs(msq_q - msq_p) <= 1e-3 * numpy.maximum(msq_p, 1.)
+
+    sign = numpy.ones(p.shape[1])
+    sign[:nincoming] = -1.
+    a = numpy.abs((q * sign[None, :, None]).sum(axis=1))
+    b = numpy.abs(q).max(axis=1)
+    ok &= numpy.all(a <= 1e-6 * b, axis=1)
+    return ok
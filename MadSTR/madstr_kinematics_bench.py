@@ -0,0 +1,389 @@
+#! /usr/bin/env python3
+#####################################################
+#                                                   #
+#  Benchmark and cross-check of the momentum        #
+#  reshufflings of the MadSTR plugin: NumPy         #
+#  (madstr_kinematics.py) vs Fortran                #
+#  (SubProcesses/transform_os.f)                    #
+#                                                   #
+#####################################################
+
+""" Generate random RAMBO points, run the reshufflings (and the BW ratios)
+of madstr_kinematics.py on them, and compare with the Fortran kernels of
+transform_os.f, compiled standalone with gfortran. Throughput and the rate
+of stat=1 (or failed consistency checks) for each strategy are reported.
+
+   python3 madstr_kinematics_bench.py [--npts 1000000] [--energy 1000]
+          [--masses 0,0,173,80.4,0] [--ip 4] [--jp 5] [--kp 3]
+          [--mij 173] [--wij 1.5] [--json report.json]
+
+Positions on the command line start from 1, as in the Fortran code. The
+default configuration is the top resonance in g g > t t~ > t W- b~
+(t~ -> W- b~, with the top as spectator).
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import madstr_kinematics as kin
+
+pjoin = os.path.join
+
+transform_os_path = pjoin(os.path.dirname(os.path.realpath(__file__)),
+                          'MadSTRTemplate', 'SubProcesses', 'transform_os.f')
+
+# the kernels which are compared, and the strategies they correspond to
+KERNELS = ['init', 'final', 'spect']
+
+
+def rambo(npts, energy, masses, rng):
+    """ npts flat phase-space points for 2 -> len(masses)-2 in the partonic
+    c.o.m. frame with energy energy (vectorised RAMBO, with the masses
+    reinstated by Newton iterations). Returns an array (npts, nexternal, 4) """
+    masses = numpy.asarray(masses, dtype=float)
+    nfinal = len(masses) - 2
+    r = rng.random((4, npts, nfinal))
+    c = 2. * r[0] - 1.
+    s = numpy.sqrt(1. - c**2)
+    f = 2. * numpy.pi * r[1]
+    q = numpy.empty((npts, nfinal, 4))
+    q[..., 0] = -numpy.log(r[2] * r[3])
+    q[..., 1] = q[..., 0] * s * numpy.cos(f)
+    q[..., 2] = q[..., 0] * s * numpy.sin(f)
+    q[..., 3] = q[..., 0] * c
+
+    # massless momenta with total momentum (energy, 0, 0, 0)
+    rsum = q.sum(axis=1)
+    rmas = numpy.sqrt(kin.dot(rsum, rsum))
+    b = -rsum[:, 1:] / rmas[:, None]
+    g = rsum[:, 0] / rmas
+    a = 1. / (1. + g)
+    x = energy / rmas
+    bq = numpy.einsum('ij,ikj->ik', b, q[..., 1:])
+    p = numpy.empty_like(q)
+    p[..., 0] = x[:, None] * (g[:, None] * q[..., 0] + bq)
+    p[..., 1:] = x[:, None, None] * (q[..., 1:] + b[:, None, :] * \
+            (q[..., 0] + a[:, None] * bq)[..., None])
+
+    # rescale the three-momenta to reinstate the masses
+    m = masses[2:]
+    if numpy.any(m > 0.):
+        xi = numpy.full(npts, numpy.sqrt(1. - (m.sum() / energy)**2))
+        for _ in range(20):
+            e = numpy.sqrt(m[None, :]**2 + (xi[:, None] * p[..., 0])**2)
+            f0 = e.sum(axis=1) - energy
+            f1 = (xi[:, None] * p[..., 0]**2 / e).sum(axis=1)
+            xi = xi - f0 / f1
+        p[..., 1:] *= xi[:, None, None]
+        p[..., 0] = numpy.sqrt(m[None, :]**2 + threesq(p))
+
+    pin = numpy.zeros((npts, 2, 4))
+    pin[:, 0, 0] = pin[:, 0, 3] = energy / 2.
+    pin[:, 1, 0] = energy / 2.
+    pin[:, 1, 3] = -energy / 2.
+    return numpy.concatenate([pin, p], axis=1)
+
+
+def threesq(p):
+    return (p[..., 1:]**2).sum(axis=-1)
+
+
+fortran_harness = """
+      program madstr_kernels_bench
+C reads the momenta from input.dat, applies the reshufflings of
+C transform_os.f and the BW ratios, and writes them to output.dat
+      implicit none
+      include 'nexternal.inc'
+      integer npts, ip, jp, kp, ipt, ik
+      double precision mi, mj, mk, mij, wij
+      double precision, allocatable :: p(:,:,:), q(:,:,:,:), bw(:,:)
+      integer, allocatable :: stat(:,:)
+      real t0, t1
+
+      open(unit=11, file='input.dat', access='stream',
+     $ form='unformatted', status='old')
+      read(11) npts, ip, jp, kp, mi, mj, mk, mij, wij
+      allocate(p(0:3,nexternal,npts), q(0:3,nexternal,npts,3))
+      allocate(bw(npts,2), stat(npts,3))
+      read(11) p
+      close(11)
+      stat(:,:) = 0
+
+      call cpu_time(t0)
+      do ipt = 1, npts
+        call transform_os_init(p(0,1,ipt), q(0,1,ipt,1), ip, jp,
+     $   mi, mj, mij)
+      enddo
+      call cpu_time(t1)
+      write(*,*) 'TIME init', t1 - t0
+
+      call cpu_time(t0)
+      do ipt = 1, npts
+        call transform_os_final(p(0,1,ipt), q(0,1,ipt,2), ip, jp,
+     $   mi, mj, mij, stat(ipt,2))
+      enddo
+      call cpu_time(t1)
+      write(*,*) 'TIME final', t1 - t0
+
+      call cpu_time(t0)
+      do ipt = 1, npts
+        call transform_os_spect(p(0,1,ipt), q(0,1,ipt,3), ip, jp, kp,
+     $   mi, mj, mk, mij, stat(ipt,3))
+        if (stat(ipt,3).ne.0) q(:,:,ipt,3) = p(:,:,ipt)
+      enddo
+      call cpu_time(t1)
+      write(*,*) 'TIME spect', t1 - t0
+
+      call cpu_time(t0)
+      do ipt = 1, npts
+        do ik = 1, 2
+          call get_bw_ratio(p(0,1,ipt), mij, wij, ip, jp, ik,
+     $     bw(ipt,ik))
+        enddo
+      enddo
+      call cpu_time(t1)
+      write(*,*) 'TIME bw', t1 - t0
+
+      open(unit=12, file='output.dat', access='stream',
+     $ form='unformatted', status='replace')
+      write(12) q, stat, bw
+      close(12)
+      end
+
+
+C stubs for the MG5_aMC functions used by transform_os.f
+      double precision function dot(p1, p2)
+      implicit none
+      double precision p1(0:3), p2(0:3)
+      dot = p1(0)*p2(0) - p1(1)*p2(1) - p1(2)*p2(2) - p1(3)*p2(3)
+      end
+
+      double precision function threedot(p1, p2)
+      implicit none
+      double precision p1(0:3), p2(0:3)
+      threedot = p1(1)*p2(1) + p1(2)*p2(2) + p1(3)*p2(3)
+      end
+
+      double precision function sumdot(p1, p2, dsign)
+      implicit none
+      double precision p1(0:3), p2(0:3), dsign, ptot(0:3), dot
+      ptot(:) = p1(:) + dsign*p2(:)
+      sumdot = dot(ptot, ptot)
+      end
+
+      subroutine boostx(p, q, pboost)
+      implicit none
+      double precision p(0:3), q(0:3), pboost(0:3), pq, qq, m, lf
+      qq = q(1)**2 + q(2)**2 + q(3)**2
+      if (qq.ne.0d0) then
+        pq = p(1)*q(1) + p(2)*q(2) + p(3)*q(3)
+        m = dsqrt(max(q(0)**2 - qq, 1d-99))
+        lf = ((q(0) - m)*pq/qq + p(0))/m
+        pboost(0) = (p(0)*q(0) + pq)/m
+        pboost(1:3) = p(1:3) + q(1:3)*lf
+      else
+        pboost(:) = p(:)
+      endif
+      end
+
+      double precision function dlum()
+      dlum = 1d0
+      end
+
+C not used by the kernels which are tested, only needed to link
+      double precision function rho(p)
+      double precision p(0:3)
+      rho = dsqrt(p(1)**2 + p(2)**2 + p(3)**2)
+      end
+
+      subroutine boostm(p, q, m, pboost)
+      stop 'boostm not available'
+      end
+
+      subroutine boostwdir2(chybst, shybst, chybstmo, xd, xin, xout)
+      stop 'boostwdir2 not available'
+      end
+"""
+
+
+def compile_fortran(workdir, nexternal, fc='gfortran', fflags='-O2'):
+    """ write the include files, the harness, and compile them with
+    transform_os.f in workdir. Returns the path of the executable """
+    includes = {
+        'nexternal.inc': '      integer nexternal, nincoming\n'
+                         '      parameter (nexternal=%d, nincoming=2)\n' % nexternal,
+        'madstr_threads.inc': '      integer madstr_maxthreads\n'
+                              '      parameter (madstr_maxthreads=1)\n',
+        'coupl.inc': '      double precision G, MU_R\n'
+                     '      common /to_bench_coupl/ G, MU_R\n',
+        'run.inc': '      double precision xbk(2), ebeam(2), q2fact(2)\n'
+                   '      common /to_bench_run/ xbk, ebeam, q2fact\n'}
+    for name, text in includes.items():
+        with open(pjoin(workdir, name), 'w') as f:
+            f.write(text)
+    with open(pjoin(workdir, 'bench_kernels.f'), 'w') as f:
+        f.write(fortran_harness)
+    shutil.copy(transform_os_path, workdir)
+
+    exe = pjoin(workdir, 'bench_kernels')
+    subprocess.check_call([fc] + fflags.split() +
+                          ['-ffixed-line-length-132', '-o', exe,
+                           'bench_kernels.f', 'transform_os.f'], cwd=workdir)
+    return exe
+
+
+def run_fortran(exe, p, ip, jp, kp, mi, mj, mk, mij, wij):
+    """ run the Fortran kernels on p. Returns the reshuffled momenta
+    and stat for each kernel, the BW ratios and the timings """
+    workdir = os.path.dirname(exe)
+    npts, nexternal = p.shape[:2]
+    header = numpy.array([npts, ip + 1, jp + 1, kp + 1], dtype=numpy.int32)
+    masses = numpy.array([mi, mj, mk, mij, wij], dtype=numpy.float64)
+    with open(pjoin(workdir, 'input.dat'), 'wb') as f:
+        header.tofile(f)
+        masses.tofile(f)
+        numpy.ascontiguousarray(p).tofile(f)
+    out = subprocess.check_output([exe], cwd=workdir).decode()
+
+    times = {}
+    for line in out.split('\n'):
+        if line.split()[:1] == ['TIME']:
+            times[line.split()[1]] = float(line.split()[2])
+
+    data = open(pjoin(workdir, 'output.dat'), 'rb').read()
+    nq = 3 * npts * nexternal * 4
+    q = numpy.frombuffer(data, dtype=numpy.float64, count=nq)
+    stat = numpy.frombuffer(data, dtype=numpy.int32, count=3 * npts,
+                            offset=nq * 8)
+    bw = numpy.frombuffer(data, dtype=numpy.float64, count=2 * npts,
+                          offset=nq * 8 + 3 * npts * 4)
+    # Fortran order: q(0:3,nexternal,npts,3), stat(npts,3), bw(npts,2)
+    q = q.reshape((3, npts, nexternal, 4))
+    stat = stat.reshape((3, npts))
+    bw = bw.reshape((2, npts))
+    results = dict((k, (q[i], stat[i])) for i, k in enumerate(KERNELS))
+    return results, bw, times
+
+
+def max_rel_diff(a, b, mask):
+    """ the largest difference between a and b on the points in mask,
+    relative to the largest component of each point """
+    if not numpy.any(mask):
+        return 0.
+    scale = numpy.abs(a[mask]).max(axis=(1, 2))
+    return float((numpy.abs(a[mask] - b[mask]).max(axis=(1, 2)) / scale).max())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--npts', type=int, default=1000000)
+    parser.add_argument('--energy', type=float, default=1000.)
+    parser.add_argument('--masses', default='0,0,173,80.4,0')
+    parser.add_argument('--ip', type=int, default=4)
+    parser.add_argument('--jp', type=int, default=5)
+    parser.add_argument('--kp', type=int, default=3)
+    parser.add_argument('--mij', type=float, default=173.)
+    parser.add_argument('--wij', type=float, default=1.5)
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--chunk', type=int, default=100000,
+                        help='points per NumPy call')
+    parser.add_argument('--fc', default='gfortran')
+    parser.add_argument('--fflags', default='-O2')
+    parser.add_argument('--no-fortran', action='store_true',
+                        help='only time the NumPy kernels')
+    parser.add_argument('--json', default=None, help='write the report here')
+    args = parser.parse_args(argv)
+
+    masses = [float(m) for m in args.masses.split(',')]
+    ip, jp, kp = args.ip - 1, args.jp - 1, args.kp - 1
+    mi, mj, mk = masses[ip], masses[jp], masses[kp]
+    rng = numpy.random.default_rng(args.seed)
+
+    p = rambo(args.npts, args.energy, masses, rng)
+    print('Generated %d RAMBO points, sqrt(s) = %g' % (args.npts, args.energy))
+
+    # the NumPy kernels, in chunks to limit the memory
+    calls = {'init': lambda pp: kin.transform_os_init(pp, ip, jp, mi, mj, args.mij),
+             'final': lambda pp: kin.transform_os_final(pp, ip, jp, mi, mj, args.mij),
+             'spect': lambda pp: kin.transform_os_spect(pp, ip, jp, kp, mi, mj,
+                                                        mk, args.mij)}
+    report = {'npts': args.npts, 'energy': args.energy, 'masses': masses,
+              'ip': args.ip, 'jp': args.jp, 'kp': args.kp,
+              'mij': args.mij, 'wij': args.wij, 'kernels': {}}
+    np_results = {}
+    for name in KERNELS:
+        t0 = time.time()
+        out = [calls[name](p[i:i + args.chunk])
+               for i in range(0, args.npts, args.chunk)]
+        elapsed = time.time() - t0
+        q = numpy.concatenate([o[0] for o in out])
+        stat = numpy.concatenate([o[1] for o in out])
+        ok = kin.check_momenta(p, q, ip, jp)
+        np_results[name] = (q, stat)
+        report['kernels'][name] = {
+            'istr': list(kin.STRATEGIES[name]),
+            'numpy_time': elapsed,
+            'numpy_throughput': args.npts / elapsed,
+            'stat1_rate': float(stat.mean()),
+            'failed_checks_rate': float(((~ok) & (stat == 0)).mean())}
+
+    t0 = time.time()
+    np_bw = [kin.get_bw_ratio(p, args.mij, args.wij, ip, jp, ibw)
+             for ibw in (1, 2)]
+    elapsed = time.time() - t0
+    report['kernels']['bw'] = {'istr': [3, 4, 5, 6, 7, 8],
+                               'numpy_time': elapsed,
+                               'numpy_throughput': args.npts / elapsed}
+
+    if not args.no_fortran:
+        workdir = tempfile.mkdtemp(prefix='madstr_bench_')
+        try:
+            exe = compile_fortran(workdir, len(masses), args.fc, args.fflags)
+            f_results, f_bw, times = run_fortran(exe, p, ip, jp, kp, mi, mj,
+                                                 mk, args.mij, args.wij)
+        finally:
+            shutil.rmtree(workdir)
+        for name in KERNELS:
+            q, stat = np_results[name]
+            fq, fstat = f_results[name]
+            entry = report['kernels'][name]
+            entry['fortran_time'] = times[name]
+            entry['fortran_throughput'] = args.npts / max(times[name], 1e-9)
+            entry['stat_mismatches'] = int((stat != fstat).sum())
+            entry['max_rel_diff'] = max_rel_diff(q, fq, (stat == 0) & (fstat == 0))
+        entry = report['kernels']['bw']
+        entry['fortran_time'] = times['bw']
+        entry['fortran_throughput'] = args.npts / max(times['bw'], 1e-9)
+        entry['max_rel_diff'] = float(max(
+            (numpy.abs(np_bw[i] - f_bw[i]) / numpy.abs(f_bw[i])).max()
+            for i in range(2)))
+
+    print('%-6s %-10s %14s %14s %10s %10s %12s' % ('kernel', 'istr',
+          'numpy pts/s', 'fortran pts/s', 'stat=1', 'bad check', 'max rel diff'))
+    for name in KERNELS + ['bw']:
+        entry = report['kernels'][name]
+        print('%-6s %-10s %14.4g %14s %10s %10s %12s' % (name,
+              ','.join(str(i) for i in entry['istr']),
+              entry['numpy_throughput'],
+              '%.4g' % entry['fortran_throughput'] if 'fortran_throughput' in entry else '-',
+              '%.2e' % entry['stat1_rate'] if 'stat1_rate' in entry else '-',
+              '%.2e' % entry['failed_checks_rate'] if 'failed_checks_rate' in entry else '-',
+              '%.2e' % entry['max_rel_diff'] if 'max_rel_diff' in entry else '-'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#####################################################
+#                                                   #
+#  Python driver of the standalone output of the    #
+#  MadSTR plugin of MG5aMC. It is copied to         #
+#  bin/internal of the process directory.           #
+#                                                   #
+#####################################################
+
+""" Evaluate the OS-subtracted real-emission matrix elements of a P*
+directory on NumPy arrays of phase-space points.
+
+    from madstr_standalone import MadSTRRealME
+    me = MadSTRRealME('SubProcesses/P0_gg_ttx')
+    wgt, wgt_re, wgt_os = me.evaluate(p, nconf=1, istr=2)
+    wgt_str = me.evaluate_multi(p, nconf=1) # wgt for istr=0...8
+
+where p has shape (npts, nexternal, 4) (E, px, py, pz). The loop over the
+points is done in Fortran (madstr_py.f), hence there is no per-point
+Python overhead.
+The module is compiled with 'make madstr_py' inside the P* directory,
+or by calling MadSTRRealME.compile.
+"""
+
+import os
+import glob
+import subprocess
+import importlib.machinery
+import importlib.util
+
+import numpy
+
+pjoin = os.path.join
+
+class MadSTRStandaloneError(Exception):
+    """ Error from the MadSTR standalone driver. """
+
+
+class MadSTRRealME(object):
+    """ The OS-subtracted real-emission matrix elements of a P* directory.
+    Each instance loads its own copy of the madstr_py module, so that
+    different P* directories can be used in the same Python session.
+    """
+
+    def __init__(self, pdir, compile_if_needed=True):
+        self.pdir = os.path.realpath(pdir)
+        library = self.find_library()
+        if not library:
+            if not compile_if_needed:
+                raise MadSTRStandaloneError(
+                    'madstr_py module not found in %s' % self.pdir)
+            self.compile(self.pdir)
+            library = self.find_library()
+
+        loader = importlib.machinery.ExtensionFileLoader('madstr_py', library)
+        spec = importlib.util.spec_from_file_location('madstr_py', library,
+                                                      loader=loader)
+        self.module = importlib.util.module_from_spec(spec)
+        loader.exec_module(self.module)
+
+        # the Fortran code reads the cards from the current directory
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.pdir)
+            self.module.madstr_py_init()
+        finally:
+            os.chdir(cwd)
+        self.nexternal, self.nconfs, self.maxthreads, \
+                self.include_pdf, self.include_flux = self.module.madstr_py_info()
+
+
+    def find_library(self):
+        """ returns the path to the compiled module, if any """
+        libraries = glob.glob(pjoin(self.pdir, 'madstr_py*.so'))
+        return libraries[0] if libraries else None
+
+
+    @staticmethod
+    def compile(pdir):
+        """ compile the madstr_py module in pdir """
+        status = subprocess.call(['make', 'madstr_py'], cwd=pdir)
+        if status:
+            raise MadSTRStandaloneError(
+                'Compilation of madstr_py failed in %s' % pdir)
+
+
+    def evaluate(self, p, nconf, istr, x1=None, x2=None):
+        """ returns three arrays with the subtracted weight, the real
+        matrix element and the OS counterterm for each point in p
+        (shape (npts, nexternal, 4)), for the FKS configuration nconf
+        and the OS-subtraction strategy istr.
+        x1, x2 are the Bjorken x's of each point, needed if the
+        PDF/flux ratios are included (str_include_pdf/flux in the
+        run_card) for istr=3,4, since their reshuffling changes the
+        initial-state momenta.
+        """
+        if istr not in range(9):
+            raise MadSTRStandaloneError('Invalid istr %s (0...8)' % istr)
+        p, x1, x2 = self.check_input(p, nconf, x1, x2, istr in [3, 4])
+
+        # the transpose of a C-ordered (npts, nexternal, 4) array is the
+        # Fortran-ordered p(0:3,nexternal,npts), so no copy is made
+        return self.module.madstr_py_eval(nconf, istr, p.T, x1, x2)
+
+
+    def evaluate_multi(self, p, nconf, x1=None, x2=None):
+        """ returns an array of shape (npts, 9) with the subtracted weight
+        of each point in p for istr=0...8. The real and OS matrix
+        elements are evaluated only once for all the strategies, so
+        this is much faster than evaluate_all if only the subtracted
+        weights are needed. x1, x2 are needed as in evaluate for istr=3,4 """
+        p, x1, x2 = self.check_input(p, nconf, x1, x2, True)
+        return self.module.madstr_py_eval_multi(nconf, p.T, x1, x2).T
+
+
+    def check_input(self, p, nconf, x1, x2, need_x=False):
+        """ checks the shape of the momenta and the FKS configuration, and
+        that the Bjorken x's are given if need_x (the initial-state 
+        momenta are reshuffled) and the PDF/flux ratios are included. 
+        Otherwise they are not used, and set to 1.
+        Returns p, x1 and x2 as contiguous double-precision arrays """
+        p = numpy.ascontiguousarray(p, dtype=numpy.float64)
+        if p.ndim != 3 or p.shape[1:] != (self.nexternal, 4):
+            raise MadSTRStandaloneError(
+                'Momenta must have shape (npts, %d, 4), got %s' % \
+                (self.nexternal, p.shape))
+        if not 1 <= nconf <= self.nconfs:
+            raise MadSTRStandaloneError(
+                'Invalid FKS configuration %d (1...%d)' % (nconf, self.nconfs))
+
+        if need_x and (self.include_pdf or self.include_flux) and \
+                (x1 is None or x2 is None):
+            raise MadSTRStandaloneError(
+                'x1 and x2 are needed with the PDF/flux ratios (str_include_pdf/flux ' + \
+                'in the run_card) and istr=3,4')
+
+        npts = p.shape[0]
+        x1 = numpy.ones(npts) if x1 is None else \
+                numpy.ascontiguousarray(x1, dtype=numpy.float64)
+        x2 = numpy.ones(npts) if x2 is None else \
+                numpy.ascontiguousarray(x2, dtype=numpy.float64)
+        return p, x1, x2
+
+
+    def evaluate_all(self, p, nconf, istrs=range(9), x1=None, x2=None):
+        """ returns a dictionary istr: (wgt, wgt_re, wgt_os) with the
+        results of evaluate for all the strategies in istrs """
+        return dict((istr, self.evaluate(p, nconf, istr, x1, x2)) \
+                    for istr in istrs)